@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""重いルートの同時実行数の制限（アドミッション制御）
+
+アップロードや注釈の保存のようにPyMuPDFでPDF全体を処理するルートは、
+ルートごとに同時に実行できる数を決め、それを超えたリクエストは上限付きの
+待ち行列で順番を待たせる。待ち行列も一杯の場合や、待ち時間の上限を
+過ぎた場合はすぐに断る（503と Retry-After）。
+
+制限のないルート（ビューアの表示や静的ファイル）はここを通らないため、
+重いリクエストが集中してもスレッドを使い切られることはない。
+
+制限はプロセスごと（gunicornのワーカーごと）に数える。
+"""
+import threading
+import time
+
+# 待ち時間の上限の既定値（秒）
+DEFAULT_TIMEOUT = 10.0
+
+
+class AdmissionRejected(Exception):
+    """混雑のため受け付けなかった
+
+    Attributes:
+        reason: 'full'（待ち行列が一杯）または 'timeout'（待ち時間の上限を過ぎた）
+        retry_after: 再試行までの目安（秒）
+    """
+
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionLimit:
+    """1つのルートの同時実行数と待ち行列
+
+    Args:
+        concurrency: 同時に実行できる数
+        max_waiting: 順番を待てる数（0の場合は待たせずに断る）
+        timeout: 順番を待つ時間の上限（秒）
+        on_change: 実行中・待機中の数が変わったときに (実行中, 待機中) で呼ばれる
+    """
+
+    def __init__(self, concurrency, max_waiting=0, timeout=DEFAULT_TIMEOUT, on_change=None):
+        if concurrency < 1:
+            raise ValueError('同時実行数は1以上である必要があります')
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.on_change = on_change
+        self.running = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+        self._average = None  # 処理時間の指数移動平均（秒）
+
+    def _notify(self):
+        if self.on_change:
+            self.on_change(self.running, self.waiting)
+
+    def retry_after(self):
+        """待っているリクエストが捌けるまでの目安（秒、1以上の整数）"""
+        average = self._average or 1.0
+        return max(1, round(average * (self.waiting + 1) / self.concurrency))
+
+    def acquire(self):
+        """実行枠を確保する
+
+        Returns:
+            float: 順番を待った秒数
+
+        Raises:
+            AdmissionRejected: 待ち行列が一杯、または待ち時間の上限を過ぎた
+        """
+        start = time.perf_counter()
+        with self._condition:
+            if self.running < self.concurrency and self.waiting == 0:
+                self.running += 1
+                self._notify()
+                return 0.0
+            if self.waiting >= self.max_waiting:
+                raise AdmissionRejected('サーバーが混雑しています', 'full', self.retry_after())
+            self.waiting += 1
+            self._notify()
+            try:
+                admitted = self._condition.wait_for(lambda: self.running < self.concurrency, self.timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self._notify()
+                raise AdmissionRejected('混雑のため処理を開始できませんでした', 'timeout', self.retry_after())
+            self.running += 1
+            self._notify()
+        return time.perf_counter() - start
+
+    def release(self, seconds=None):
+        """実行枠を返す（secondsは処理にかかった時間で、Retry-Afterの見積もりに使う）"""
+        with self._condition:
+            self.running -= 1
+            if seconds is not None:
+                self._average = seconds if self._average is None else 0.8 * self._average + 0.2 * seconds
+            self._notify()
+            self._condition.notify()
+
+
+class AdmissionController:
+    """ルートごとのAdmissionLimitを管理する
+
+    Args:
+        limits: ルート（URLルールのテンプレート）-> (同時実行数, 待ち行列の長さ)
+        timeout: 順番を待つ時間の上限（秒）
+        on_change: 実行中・待機中の数が変わったときに (ルート, 実行中, 待機中) で呼ばれる
+    """
+
+    def __init__(self, limits, timeout=DEFAULT_TIMEOUT, on_change=None):
+        self.timeout = timeout
+        self.on_change = on_change
+        self._limits = {
+            route: AdmissionLimit(concurrency, max_waiting, timeout, on_change=self._callback(route))
+            for route, (concurrency, max_waiting) in limits.items()
+        }
+
+    def _callback(self, route):
+        if self.on_change is None:
+            return None
+        return lambda running, waiting: self.on_change(route, running, waiting)
+
+    def __contains__(self, route):
+        return route in self._limits
+
+    def acquire(self, route):
+        """ルートの実行枠を確保する（制限のないルートはNone）
+
+        Returns:
+            float | None: 順番を待った秒数
+        """
+        limit = self._limits.get(route)
+        if limit is None:
+            return None
+        return limit.acquire()
+
+    def release(self, route, seconds=None):
+        limit = self._limits.get(route)
+        if limit is None:
+            return
+        limit.release(seconds)
+
+    def stats(self):
+        """ルートごとの実行中・待機中の数"""
+        return {route: {'concurrency': limit.concurrency, 'running': limit.running, 'waiting': limit.waiting}
+                for route, limit in self._limits.items()}
+
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""PDFに含まれている注釈をビューアの注釈（JSON）として取り出す
+
+ページを一定数ずつに分けてレンダリングサービスのワーカープロセスで注釈を
+読み取り、ビューアと同じ形式（ページ左上が原点のポイント座標、1始まりの
+ページ番号）にそろえる。取り出した注釈には ``'source': 'pdf'`` を付ける。
+元のPDFにすでに含まれているため、注釈の適用時には追加し直さない。
+
+結果はPDFの内容のハッシュ（SHA-256）をキーとしてディスクに保存する。
+アップロードのたびにファイル名は変わるが、同じPDFを開き直した場合は
+ページを調べ直さずに保存済みの結果を返せる。
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from render_service import worker_document
+
+CACHE_VERSION = 1
+
+# 1回の投入で調べるページ数
+PAGES_PER_TASK = 50
+
+# 注釈の種類（annot.type[0]）-> ビューアの種類
+_TYPES = {
+    0: 'text',       # Text（付箋）
+    2: 'text',       # FreeText
+    4: 'rect',       # Square
+    8: 'highlight',  # Highlight
+}
+
+
+def _hex(color, default='#ffff00'):
+    if not color or len(color) != 3:
+        return default
+    return '#' + ''.join(f'{max(0, min(255, round(v * 255))):02x}' for v in color)
+
+
+def _rect(rect):
+    return {'x': round(rect.x0, 2), 'y': round(rect.y0, 2),
+            'width': round(rect.width, 2), 'height': round(rect.height, 2)}
+
+
+def to_viewer(annot, page_number):
+    """注釈をビューアの注釈のリストにする（未対応の種類は空のリスト）
+
+    複数行のハイライトは行（QuadPoints）ごとに1つの注釈に分ける。
+    """
+    kind = _TYPES.get(annot.type[0])
+    if kind is None:
+        return []
+    info = annot.info
+    colors = annot.colors
+    base = {
+        # 注釈名（NM）はページ内でしか一意でないことがあるため、xref番号から作る
+        'id': f'pdf_{annot.xref}',
+        'type': kind,
+        'page': page_number + 1,
+        'color': _hex(colors.get('stroke') or colors.get('fill')),
+        'source': 'pdf',
+    }
+    contents = info.get('content') or ''
+
+    if kind == 'text':
+        return [dict(base, x=round(annot.rect.x0, 2), y=round(annot.rect.y0, 2),
+                     width='auto', height='auto', text=contents)]
+
+    base['opacity'] = annot.opacity if 0 <= annot.opacity < 1 else (0.3 if kind == 'highlight' else 1)
+    if contents:
+        base['text'] = contents
+    if kind == 'rect':
+        fill = bool(colors.get('fill'))
+        stroke = bool(colors.get('stroke'))
+        base['rectStyle'] = 'both' if fill and stroke else 'fill' if fill else 'outline'
+        return [dict(base, **_rect(annot.rect))]
+
+    # ハイライトは4点ずつの頂点（QuadPoints）から行ごとの矩形を作る
+    vertices = annot.vertices or []
+    rects = []
+    for i in range(0, len(vertices) - 3, 4):
+        xs = [p[0] for p in vertices[i:i + 4]]
+        ys = [p[1] for p in vertices[i:i + 4]]
+        rects.append((min(xs), min(ys), max(xs), max(ys)))
+    if len(rects) <= 1:
+        return [dict(base, **_rect(annot.rect))]
+    return [
+        dict(base, id=f'{base["id"]}_{i}', x=round(x0, 2), y=round(y0, 2),
+             width=round(x1 - x0, 2), height=round(y1 - y0, 2))
+        for i, (x0, y0, x1, y1) in enumerate(rects)
+    ]
+
+
+def extract_pages(path, page_numbers):
+    """ワーカーで指定ページの注釈を取り出す"""
+    found = []
+    with worker_document(path) as doc:
+        for page_number in page_numbers:
+            page = doc[page_number]
+            for annot in page.annots():
+                found.extend(to_viewer(annot, page_number))
+    return found
+
+
+def extract_annotations(service, path, page_count, pages_per_task=PAGES_PER_TASK):
+    """全ページの注釈をワーカーに分散して取り出す
+
+    Returns:
+        list: ページ順のビューアの注釈
+    """
+    path = os.path.abspath(path)
+    chunks = (
+        (path, list(range(start, min(start + pages_per_task, page_count))))
+        for start in range(0, page_count, pages_per_task)
+    )
+    found = []
+    for chunk_result in service.map(extract_pages, chunks):
+        found.extend(chunk_result)
+    return found
+
+
+def content_hash(path, chunk_size=1024 * 1024):
+    """ファイルの内容のSHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AnnotationCache:
+    """取り出した注釈を内容のハッシュごとにディスクに保存する
+
+    ハッシュはファイルを読み直さないよう (パス, 更新日時, サイズ) ごとにプロセス内で覚えておく。
+    """
+
+    def __init__(self, max_hashes=256):
+        self.max_hashes = max_hashes
+        self._lock = threading.Lock()
+        self._hashes = OrderedDict()  # (パス, 更新日時, サイズ) -> ハッシュ
+
+    def digest(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._hashes.get(key)
+            if digest is not None:
+                self._hashes.move_to_end(key)
+                return digest
+        digest = content_hash(path)
+        with self._lock:
+            self._hashes[key] = digest
+            while len(self._hashes) > self.max_hashes:
+                self._hashes.popitem(last=False)
+        return digest
+
+    @staticmethod
+    def load(cache_dir, digest):
+        """保存済みの注釈（なければNone）"""
+        try:
+            with open(os.path.join(cache_dir, f'{digest}.json'), encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        if data.get('version') != CACHE_VERSION:
+            return None
+        return data['annotations']
+
+    @staticmethod
+    def store(cache_dir, digest, annotations):
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f'{digest}.json')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': CACHE_VERSION, 'annotations': annotations}, f,
+                      ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
@@ -1,21 +1,137 @@
 ﻿# -*- coding: utf-8 -*-
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory, abort
+from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory, abort, g, Response, stream_with_context, has_request_context
 import os
+import io
+import re
 import json
 from werkzeug.utils import secure_filename
 import fitz  # PyMuPDF
 import uuid
 import datetime
 import logging
-from logging.handlers import RotatingFileHandler
+import time
 from werkzeug.exceptions import RequestEntityTooLarge, BadRequest
+from metrics import REGISTRY, SIZE_BUCKETS, COUNT_BUCKETS
+from profiling import ProfilerMiddleware, ProfileStore, ensure_request_id
+from log_pipeline import QueueLogging
+from admission import AdmissionController, AdmissionRejected
+from save_queue import SaveCoalescer
+from collab import CollabLogs, OperationError, StreamSlots
+from doc_pool import DocumentPool
+import render_service
+from render_service import create_render_service, render_workers_per_process, RenderBusy, RenderTimeout, PageNotFound
+from page_export import parse_page_range, iter_zip_chunks
+from jobs import BackgroundJobs, PENDING
+from search_index import IndexCache, index_path_for, write_index
+from word_index import WordIndex
+from fast_web_view import write_fast_web_copy, current_fast_web_copy, find_qpdf
+from output_profiles import PROFILES as OUTPUT_PROFILES, save_with_profile, format_report
+from thumbnails import thumbs_dir_for, write_thumbnails, load_index as load_thumbnail_index, INDEX_NAME as THUMBNAIL_INDEX_NAME
+from bulk_highlight import MAX_TERMS, normalize_terms, find_occurrences, add_highlights, summarize
+from chunked_upload import ChunkedUploads, UploadError, UploadNotFound, UploadIncomplete, UploadConflict, DEFAULT_CHUNK_SIZE
+from annotation_extract import AnnotationCache, extract_annotations
+from xfdf import FORMATS as ANNOTATION_FORMATS, XFDF_MIMETYPE, FDF_MIMETYPE, export_annotations, import_annotations, merge_annotations
+from storage import create_storage, ReadCache, StorageFolder
+
+if __name__ == '__main__':
+    # python app.py [serve ...] は serve.py をメインのスクリプトにして起動し直す。
+    # レンダリングとバックグラウンドジョブのワーカープロセス（spawn）はメインのスクリプトを
+    # __mp_main__ として読み込み直すため、app.py のままだとワーカーごとにログ・保存先・
+    # フォルダの初期化が実行される。ワーカーが使う関数はすべて別のモジュールにある
+    import runpy
+    import sys
+    serve_args = sys.argv[2:] if sys.argv[1:2] == ['serve'] else ['--dev'] + sys.argv[1:]
+    sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')] + serve_args
+    runpy.run_path(sys.argv[0], run_name='__main__')
+    sys.exit(0)
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'temp'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 最大16MBまで
 app.config['ANNOTATION_FOLDER'] = 'annotations'
+# PDFと注釈データの保存先（未設定: 上の2つのフォルダだけ / fs: 共有ディレクトリ / s3: S3互換ストレージ / memory: プロセス内）
+# 設定した場合は上の2つのフォルダを作業用のキャッシュとして使い、ないファイルは保存先から取得する
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', '')
+app.config['STORAGE_ROOT'] = os.environ.get('STORAGE_ROOT')  # fs
+app.config['STORAGE_BUCKET'] = os.environ.get('STORAGE_BUCKET')  # s3
+app.config['STORAGE_PREFIX'] = os.environ.get('STORAGE_PREFIX', '')  # s3
+app.config['STORAGE_ENDPOINT_URL'] = os.environ.get('STORAGE_ENDPOINT_URL')  # s3（MinIOなど）
+# 保存先から取得してローカルに置いておくファイルの合計サイズの上限（超えたら使われていない順に削除）
+app.config['STORAGE_CACHE_MAX_BYTES'] = int(os.environ.get('STORAGE_CACHE_MAX_MB', '2048')) * 1024 * 1024
+# 分割アップロード（/uploads）で受け付ける上限と、勧めるチャンクの大きさ、未完了のまま残す秒数
+app.config['CHUNKED_UPLOAD_MAX_BYTES'] = int(os.environ.get('CHUNKED_UPLOAD_MAX_MB', '1024')) * 1024 * 1024
+app.config['CHUNKED_UPLOAD_CHUNK_BYTES'] = DEFAULT_CHUNK_SIZE
+app.config['CHUNKED_UPLOAD_TTL'] = int(os.environ.get('CHUNKED_UPLOAD_TTL', str(24 * 60 * 60)))
+# 分割アップロードのセッションを置くフォルダ（既定はノードのディスク上の temp/.uploads）
+# 複数のノードに振り分ける場合は共有ディレクトリを指定するか、/uploads/* をスティッキーに振り分けること
+app.config['CHUNKED_UPLOAD_FOLDER'] = os.environ.get('CHUNKED_UPLOAD_FOLDER')
 app.config['ALLOWED_EXTENSIONS'] = {'pdf'}
+# メモリ上の注釈付きPDFをレスポンスとして送るときの1回の大きさ
+app.config['PDF_STREAM_CHUNK_BYTES'] = 1024 * 1024
+# 開いたPDFを使い回すプールの上限（ドキュメント数と合計ファイルサイズ）
+app.config['DOCUMENT_POOL_SIZE'] = int(os.environ.get('DOCUMENT_POOL_SIZE', '8'))
+app.config['DOCUMENT_POOL_MAX_BYTES'] = int(os.environ.get('DOCUMENT_POOL_MAX_MB', '512')) * 1024 * 1024
+# PDFの開き方（path: MuPDFがファイルから読み込む / mmap: メモリマップしてワーカー間でページキャッシュを共有）
+app.config['PDF_OPEN_MODE'] = os.environ.get('PDF_OPEN_MODE', 'path')
+# ページレンダリング用のワーカープロセス（0の場合はリクエストスレッドで実行）
+# 既定値はCPUコア数をWebのワーカープロセス数（WEB_CONCURRENCY、serveでは --workers）で分けた数
+app.config['RENDER_WORKERS'] = int(os.environ.get('RENDER_WORKERS') or
+                                   render_workers_per_process(int(os.environ.get('WEB_CONCURRENCY', '1'))))
+app.config['RENDER_MAX_PENDING'] = int(os.environ.get('RENDER_MAX_PENDING', '0'))  # 0の場合はワーカー数の4倍
+app.config['RENDER_TIMEOUT'] = float(os.environ.get('RENDER_TIMEOUT', '30'))  # 秒
+app.config['RENDER_CACHE_SIZE'] = 4  # ワーカーごとに開いたままにするPDFの数
+# サムネイルのスプライト画像をブラウザにキャッシュさせる秒数（作り直すとURLが変わる）
+app.config['THUMBNAIL_MAX_AGE'] = 365 * 24 * 60 * 60
+# 注釈付きPDFの既定の出力プロファイル（default / balanced / compact）
+# （default以外はプールのハンドルをコピーせず、プール外のハンドルに直接保存する）
+app.config['OUTPUT_PROFILE'] = os.environ.get('OUTPUT_PROFILE', 'balanced')
+# ビューア用のPDFを線形化するqpdfのパス（見つからない場合は最適化のみ行う）
+app.config['QPDF_PATH'] = os.environ.get('QPDF_PATH') or find_qpdf()
+# アップロード後の索引作成などを行うバックグラウンドのワーカープロセス数（0の場合はスレッドで実行）
+app.config['BACKGROUND_WORKERS'] = int(os.environ.get('BACKGROUND_WORKERS', '2'))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or uuid.uuid4().hex
+# 共同編集: 1回のイベントストリームを開いておく秒数（切れたらブラウザが続きから再接続する）と、
+# 操作ログをスナップショットにまとめる件数
+app.config['COLLAB_STREAM_SECONDS'] = float(os.environ.get('COLLAB_STREAM_SECONDS', '30'))
+app.config['COLLAB_HEARTBEAT_SECONDS'] = 15
+# ワーカーごとのイベントストリームの同時接続数の上限（1本がリクエストのスレッドを1つ使い続けるため、
+# gunicornの --threads より小さくしてほかのリクエストのスレッドを残す。超えた接続には503を返す）
+app.config['COLLAB_MAX_SUBSCRIBERS'] = int(os.environ.get('COLLAB_MAX_SUBSCRIBERS', '2'))
+app.config['COLLAB_COMPACT_EVERY'] = int(os.environ.get('COLLAB_COMPACT_EVERY', '500'))
+# 共同編集の操作ログを置くフォルダ（既定はノードのディスク上の annotations/collab）
+# 複数のノードに振り分ける場合は共有ディレクトリ（flockが使えるもの）を指定するか、/collab/<filename>/* をスティッキーに振り分けること
+app.config['COLLAB_FOLDER'] = os.environ.get('COLLAB_FOLDER')
+# 重いルートの同時実行数と待ち行列の長さ（プロセスごと）。これを超えたリクエストは503を返す
+app.config['ADMISSION_CONCURRENCY'] = int(os.environ.get('ADMISSION_CONCURRENCY', '2'))
+app.config['ADMISSION_QUEUE'] = int(os.environ.get('ADMISSION_QUEUE', '8'))
+app.config['ADMISSION_TIMEOUT'] = float(os.environ.get('ADMISSION_TIMEOUT', '10'))  # 順番を待つ秒数の上限
+app.config['ADMISSION_LIMITS'] = {
+    route: (app.config['ADMISSION_CONCURRENCY'], app.config['ADMISSION_QUEUE'])
+    for route in ('/upload', '/uploads/<upload_id>/complete', '/save-annotations', '/collab/<filename>/save',
+                  '/import-annotations/<filename>', '/merged/<filename>', '/highlight-terms')
+}
+# 保存のルートはリクエストの受け付け時ではなく、まとめた保存を実行するときに枠を確保する
+# （同じPDFへの保存を待っているリクエストは枠を使わないので、ほかのPDFの保存を妨げない）
+app.config['ADMISSION_AT_SAVE'] = ('/save-annotations', '/collab/<filename>/save')
+# 管理用エンドポイントのトークン（未設定の場合は管理用エンドポイントを無効化）
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+# 複数のワーカープロセスのメトリクスを合算するためのディレクトリ（未設定: プロセスごとの値、serveでは自動で作成）
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+
+# プロファイラの設定
+app.config['PROFILING_ENABLED'] = os.environ.get('PROFILING_ENABLED') == '1'
+app.config['PROFILE_HEADER'] = 'X-Profile'  # このヘッダーと正しいX-Admin-Tokenがあるリクエストは必ず計測
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+app.config['PROFILE_MIN_DURATION'] = float(os.environ.get('PROFILE_MIN_DURATION', '0'))  # これより速いリクエストは保存しない（秒）
+app.config['PROFILE_SAMPLE_INTERVAL'] = 0.001  # スタックサンプリング間隔（秒）
+app.config['PROFILE_FOLDER'] = 'profiles'
+app.config['PROFILE_MAX_FILES'] = 100
+
+# ログの設定（JSONで1行1件、書き込みとローテーションは専用のスレッドで行う）
+app.config['LOG_FILE'] = os.environ.get('LOG_FILE', 'logs/app.log')
+app.config['LOG_MAX_BYTES'] = int(os.environ.get('LOG_MAX_MB', '50')) * 1024 * 1024
+app.config['LOG_BACKUP_COUNT'] = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+app.config['LOG_QUEUE_SIZE'] = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))  # 溢れた分は捨てる
 
 # アップロードフォルダとアノテーションフォルダが存在しない場合は作成
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
@@ -25,16 +141,296 @@ if not os.path.exists(app.config['ANNOTATION_FOLDER']):
     os.makedirs(app.config['ANNOTATION_FOLDER'])
 
 # ロガーのセットアップ
-if not os.path.exists('logs'):
-    os.makedirs('logs')
+os.makedirs(os.path.dirname(app.config['LOG_FILE']) or '.', exist_ok=True)
+
+def _log_context():
+    """ログに付けるリクエストの情報（リクエストの処理中でなければNone）"""
+    if not has_request_context():
+        return None
+    return {
+        'request_id': g.get('request_id'),
+        'route': g.get('metrics_route'),
+        'method': request.method,
+        'document': g.get('document') or (request.view_args or {}).get('filename'),
+    }
 
 logger = logging.getLogger('pdf_annotator')
 logger.setLevel(logging.INFO)
-handler = RotatingFileHandler('logs/app.log', maxBytes=10000, backupCount=3)
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-))
-logger.addHandler(handler)
+LOG_PIPELINE = QueueLogging(
+    logger, app.config['LOG_FILE'],
+    max_bytes=app.config['LOG_MAX_BYTES'],
+    backup_count=app.config['LOG_BACKUP_COUNT'],
+    queue_size=app.config['LOG_QUEUE_SIZE'],
+    context=_log_context
+)
+
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app.config, logger)
+
+# メトリクスの定義（METRICS_DIRを指定した場合は全ワーカーの値を合算して返す）
+if app.config['METRICS_DIR']:
+    REGISTRY.set_directory(app.config['METRICS_DIR'])
+REQUEST_LATENCY = REGISTRY.histogram(
+    'pdf_annotator_request_duration_seconds', 'ルートごとのリクエスト処理時間',
+    ('route', 'method', 'status'))
+REQUESTS_IN_PROGRESS = REGISTRY.gauge(
+    'pdf_annotator_requests_in_progress', 'ルートごとの処理中リクエスト数',
+    ('route',))
+UPLOAD_SIZE = REGISTRY.histogram(
+    'pdf_annotator_upload_size_bytes', 'アップロードされたPDFのサイズ',
+    buckets=SIZE_BUCKETS)
+FITZ_OPEN_SECONDS = REGISTRY.histogram(
+    'pdf_annotator_fitz_open_seconds', 'fitz.openにかかった時間',
+    ('operation',))
+RENDER_SECONDS = REGISTRY.histogram(
+    'pdf_annotator_render_seconds', 'ページのレンダリングにかかった時間（待ち時間を含む）',
+    ('format',))
+RENDER_QUEUE_DEPTH = REGISTRY.gauge(
+    'pdf_annotator_render_queue_depth', 'レンダリングの実行中と待機中のリクエスト数')
+RENDER_REJECTED = REGISTRY.counter(
+    'pdf_annotator_render_rejected_total', '待ち行列が一杯またはタイムアウトで失敗したレンダリング',
+    ('reason',))
+BACKGROUND_QUEUE_DEPTH = REGISTRY.gauge(
+    'pdf_annotator_background_queue_depth', '未完了のバックグラウンドジョブ数')
+SEARCH_SECONDS = REGISTRY.histogram(
+    'pdf_annotator_search_seconds', '全文検索にかかった時間（索引の読み込みを含む）')
+SNAP_SECONDS = REGISTRY.histogram(
+    'pdf_annotator_snap_seconds', '矩形を単語に吸着させるのにかかった時間（単語の抽出を含む）')
+DOCUMENT_POOL_CHECKOUTS = REGISTRY.counter(
+    'pdf_annotator_document_pool_checkouts_total', 'ドキュメントプールの貸し出し結果（hit/miss/busy/private）',
+    ('result',))
+APPLY_SECONDS = REGISTRY.histogram(
+    'pdf_annotator_apply_annotations_seconds', 'apply_annotations_to_pdfの段階別処理時間',
+    ('phase',))
+BULK_HIGHLIGHT_SECONDS = REGISTRY.histogram(
+    'pdf_annotator_bulk_highlight_seconds', '一括ハイライトの段階別処理時間',
+    ('phase',))
+OUTPUT_SIZE_RATIO = REGISTRY.histogram(
+    'pdf_annotator_output_size_ratio', '注釈付きPDFのサイズと元のPDFのサイズの比',
+    ('profile',), buckets=(0.1, 0.25, 0.5, 0.75, 0.9, 1.0, 1.1, 1.25, 1.5, 2.0))
+EXTRACT_SECONDS = REGISTRY.histogram(
+    'pdf_annotator_extract_annotations_seconds', 'PDFに含まれる注釈の取り出しにかかった時間',
+    ('result',))
+ADMISSION_RUNNING = REGISTRY.gauge(
+    'pdf_annotator_admission_running', '同時実行数を制限しているルートの実行中リクエスト数',
+    ('route',))
+ADMISSION_WAITING = REGISTRY.gauge(
+    'pdf_annotator_admission_waiting', '同時実行数を制限しているルートで順番を待っているリクエスト数',
+    ('route',))
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    'pdf_annotator_admission_wait_seconds', '実行枠が空くまで待った時間',
+    ('route',))
+ADMISSION_REJECTED = REGISTRY.counter(
+    'pdf_annotator_admission_rejected_total', '混雑のため断ったリクエスト（full/timeout）',
+    ('route', 'reason'))
+COLLAB_OPERATIONS = REGISTRY.counter(
+    'pdf_annotator_collab_operations_total', '共同編集の操作ログに追記された操作',
+    ('op',))
+COLLAB_SUBSCRIBERS = REGISTRY.gauge(
+    'pdf_annotator_collab_subscribers', '共同編集のイベントストリームの接続数')
+SAVES_COALESCED = REGISTRY.counter(
+    'pdf_annotator_saves_coalesced_total', '同じドキュメントへの後続の保存にまとめられて実行されなかった保存')
+ANNOTATIONS_PER_SAVE = REGISTRY.histogram(
+    'pdf_annotator_annotations_per_save', '1回の保存に含まれる注釈数',
+    buckets=COUNT_BUCKETS)
+
+def _route_label():
+    """メトリクス用のルート名（URLルールのテンプレート）を返す"""
+    if request.url_rule is not None:
+        return request.url_rule.rule
+    return 'unmatched'
+
+# 開いたPDFのプール（プロセスごと）
+DOCUMENT_POOL = DocumentPool(
+    max_documents=app.config['DOCUMENT_POOL_SIZE'],
+    max_bytes=app.config['DOCUMENT_POOL_MAX_BYTES'],
+    on_open=lambda seconds, pooled: FITZ_OPEN_SECONDS.observe(
+        seconds, operation='pooled' if pooled else 'private'),
+    on_checkout=lambda result: DOCUMENT_POOL_CHECKOUTS.inc(result=result),
+    open_mode=app.config['PDF_OPEN_MODE']
+)
+
+# 重いルートの同時実行数の制限
+def _admission_changed(route, running, waiting):
+    ADMISSION_RUNNING.set(running, route=route)
+    ADMISSION_WAITING.set(waiting, route=route)
+
+ADMISSION = AdmissionController(
+    app.config['ADMISSION_LIMITS'],
+    timeout=app.config['ADMISSION_TIMEOUT'],
+    on_change=_admission_changed
+)
+
+# 同じドキュメントへの保存の直列化とまとめ実行（プロセスごと）
+SAVE_COALESCER = SaveCoalescer(on_coalesce=SAVES_COALESCED.inc)
+
+# PDFと注釈データの保存先（Noneの場合はローカルフォルダだけを使う）
+STORAGE = create_storage(app.config)
+
+# 保存先から取得したファイルの使われた順と合計サイズ（プロセスごと）
+STORAGE_CACHE = ReadCache(app.config['STORAGE_CACHE_MAX_BYTES'])
+
+# アップロードされたPDF・注釈付きPDF（UPLOAD_FOLDER）と注釈データ（ANNOTATION_FOLDER）の保存先
+def documents():
+    return StorageFolder(STORAGE, app.config['UPLOAD_FOLDER'], 'documents/', STORAGE_CACHE)
+
+def annotation_files():
+    return StorageFolder(STORAGE, app.config['ANNOTATION_FOLDER'], 'annotations/', STORAGE_CACHE)
+
+# PDFのローカルのパス（ローカルになければ保存先から取得する。どこにもなければNone）
+def document_path(filename):
+    return documents().local_path(filename)
+
+# 共同編集の操作ログ（COLLAB_FOLDER/<ファイル名>/に置く。ストレージバックエンドには置かない）
+COLLAB_LOGS = CollabLogs(compact_every=app.config['COLLAB_COMPACT_EVERY'])
+
+# イベントストリームの同時接続数（プロセスごと）
+COLLAB_STREAMS = StreamSlots()
+
+# ページレンダリング用のワーカープロセスプール（最初の利用時に起動）
+RENDER_SERVICE = create_render_service(app.config, on_queue_change=lambda depth: RENDER_QUEUE_DEPTH.set(depth))
+
+# アップロード後の重い処理を実行するバックグラウンドジョブ（最初の利用時に起動）
+BACKGROUND_JOBS = BackgroundJobs(
+    workers=app.config['BACKGROUND_WORKERS'],
+    logger=logger,
+    on_queue_change=lambda depth: BACKGROUND_QUEUE_DEPTH.set(depth)
+)
+
+# 読み込んだ検索索引のキャッシュ（プロセスごと）
+SEARCH_INDEXES = IndexCache()
+
+# ページごとの単語矩形のキャッシュ（プロセスごと）
+WORD_INDEX = WordIndex()
+
+# PDFに含まれる注釈の取り出し結果（内容のハッシュごとにANNOTATION_FOLDER/extracted/に保存）
+EXTRACTED_ANNOTATIONS = AnnotationCache()
+
+# 検索索引の作成をバックグラウンドで開始
+def schedule_search_index(pdf_path):
+    pdf_path = os.path.abspath(pdf_path)
+    return BACKGROUND_JOBS.submit(
+        ('index', pdf_path), write_index, pdf_path,
+        callback=lambda result: logger.info(f"検索索引作成完了: {result['path']}, 単語数: {result['words']}")
+    )
+
+# サムネイルのスプライト画像の作成をバックグラウンドで開始
+def schedule_thumbnails(pdf_path):
+    pdf_path = os.path.abspath(pdf_path)
+    return BACKGROUND_JOBS.submit(
+        ('thumbnails', pdf_path), write_thumbnails, pdf_path,
+        callback=lambda result: logger.info(f"サムネイル作成完了: {result['path']}, スプライト数: {result['sheets']}")
+    )
+
+# ビューア用に最適化（線形化）したコピーの作成をバックグラウンドで開始
+def schedule_fast_web_copy(pdf_path):
+    pdf_path = os.path.abspath(pdf_path)
+    
+    def log_result(result):
+        if result['path']:
+            logger.info(f"ビューア用コピー作成完了: {result['path']}, 線形化: {result['linearized']}, "
+                        f"サイズ: {result['input_bytes']} -> {result['output_bytes']}")
+        else:
+            logger.info(f'ビューア用コピーは作成しません（効果なし）: {pdf_path}')
+    
+    return BACKGROUND_JOBS.submit(
+        ('fast-web', pdf_path), write_fast_web_copy, pdf_path, None, app.config['QPDF_PATH'],
+        callback=log_result
+    )
+
+# アップロードされたPDFに対するバックグラウンド処理を開始
+def schedule_upload_jobs(pdf_path):
+    # ビューアの表示に関わるものから順に投入する
+    schedule_fast_web_copy(pdf_path)
+    schedule_thumbnails(pdf_path)
+    schedule_search_index(pdf_path)
+
+@app.before_request
+def assign_request_id():
+    g.request_id = ensure_request_id(request.environ)
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.metrics_route = _route_label()
+    REQUESTS_IN_PROGRESS.inc(route=g.metrics_route)
+    g.in_progress = True
+
+@app.before_request
+def admit_request():
+    route = g.metrics_route
+    if route not in ADMISSION or route in app.config['ADMISSION_AT_SAVE']:
+        return None
+    try:
+        waited = ADMISSION.acquire(route)
+    except AdmissionRejected as e:
+        return admission_rejected(route, e)
+    ADMISSION_WAIT_SECONDS.observe(waited, route=route)
+    g.admitted_at = time.perf_counter()
+    return None
+
+# 混雑のため断ったリクエストへの応答（503とRetry-After）
+def admission_rejected(route, e):
+    ADMISSION_REJECTED.inc(route=route, reason=e.reason)
+    logger.warning(f'混雑のためリクエストを断りました: {route} ({e.reason})')
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+# 実行枠を確保してfuncを実行する（リクエストの受け付け時に枠を確保しないルート用）
+def run_admitted(route, func, *args):
+    waited = ADMISSION.acquire(route)
+    if waited is not None:
+        ADMISSION_WAIT_SECONDS.observe(waited, route=route)
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        ADMISSION.release(route, time.perf_counter() - start)
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' in g:
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - g.request_start,
+            route=g.metrics_route, method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def log_request(response):
+    if 'request_start' in g:
+        logger.info(f'{request.method} {request.path} {response.status_code}', extra={
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.request_start) * 1000, 2),
+        })
+    return response
+
+@app.after_request
+def add_request_id_header(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # 保持されたコンテキスト（テストクライアントなど）ではteardownが2回呼ばれることがある
+    if g.pop('in_progress', False):
+        REQUESTS_IN_PROGRESS.dec(route=g.metrics_route)
+
+@app.teardown_request
+def release_admission(exc):
+    # 保持されたコンテキスト（テストクライアントなど）ではteardownが2回呼ばれることがある
+    admitted_at = g.pop('admitted_at', None)
+    if admitted_at is not None:
+        ADMISSION.release(g.metrics_route, time.perf_counter() - admitted_at)
+
+# 管理用エンドポイントの認可チェック
+def require_admin():
+    token = app.config.get('ADMIN_TOKEN')
+    if not token:
+        abort(404)  # 管理機能が無効
+    if request.headers.get('X-Admin-Token') != token:
+        logger.warning(f'管理用エンドポイントへの不正なアクセス: {request.path}')
+        abort(403)  # Forbidden
 
 # ファイルの拡張子チェック
 def allowed_file(filename):
@@ -43,7 +439,35 @@ def allowed_file(filename):
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template(
+        'index.html',
+        max_upload_bytes=app.config['MAX_CONTENT_LENGTH'],
+        chunked_upload_max_bytes=app.config['CHUNKED_UPLOAD_MAX_BYTES']
+    )
+
+# アップロードされたファイルの保存名（ファイル名の衝突を避けるためにタイムスタンプを追加）
+def upload_filename(original):
+    filename = secure_filename(original)
+    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    name, ext = os.path.splitext(filename)
+    return f"{name}_{timestamp}{ext}"
+
+# アップロードしたPDFを検証し、バックグラウンドの処理を開始する（不正なPDFは削除してFalseを返す）
+def validate_upload(file_path):
+    filename = os.path.basename(file_path)
+    try:
+        # 検証で開いたハンドルはプールに残し、続くページ数の確認や単語の取得で再利用する
+        with DOCUMENT_POOL.checkout(file_path) as doc:
+            page_count = len(doc)
+        logger.info(f'PDFファイル検証成功: {filename}, ページ数: {page_count}')
+        schedule_upload_jobs(file_path)
+        return True
+    except Exception as e:
+        # 不正なPDFファイルの場合は削除する
+        DOCUMENT_POOL.invalidate(file_path)
+        os.remove(file_path)
+        logger.error(f'不正なPDFファイル: {str(e)}')
+        return False
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -66,30 +490,20 @@ def upload_file():
             return jsonify({'error': 'PDFファイルのみアップロード可能です'}), 400
         
         # セキュアなファイル名を生成
-        filename = secure_filename(file.filename)
-        
-        # ファイル名の衝突を避けるためにタイムスタンプを追加
-        timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-        name, ext = os.path.splitext(filename)
-        filename = f"{name}_{timestamp}{ext}"
+        filename = upload_filename(file.filename)
+        g.document = filename
         
         # ファイル保存
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
+        UPLOAD_SIZE.observe(os.path.getsize(file_path))
         
         logger.info(f'ファイルアップロード成功: {filename}')
         
         # PDFファイルの検証
-        try:
-            doc = fitz.open(file_path)
-            page_count = len(doc)
-            doc.close()
-            logger.info(f'PDFファイル検証成功: {filename}, ページ数: {page_count}')
-        except Exception as e:
-            # 不正なPDFファイルの場合は削除する
-            os.remove(file_path)
-            logger.error(f'不正なPDFファイル: {str(e)}')
+        if not validate_upload(file_path):
             return jsonify({'error': '不正なPDFファイルです'}), 400
+        documents().publish(filename)
         
         return redirect(url_for('view_pdf', filename=filename))
     
@@ -101,10 +515,91 @@ def upload_file():
         logger.error(f'アップロードエラー: {str(e)}')
         return jsonify({'error': f'アップロード中にエラーが発生しました: {str(e)}'}), 500
 
+# 分割アップロードのセッション（状態は CHUNKED_UPLOAD_FOLDER に置く。ストレージバックエンドには置かない）
+def chunked_uploads():
+    return ChunkedUploads(
+        app.config['CHUNKED_UPLOAD_FOLDER'] or os.path.join(app.config['UPLOAD_FOLDER'], '.uploads'),
+        max_size=app.config['CHUNKED_UPLOAD_MAX_BYTES'],
+        chunk_size=app.config['CHUNKED_UPLOAD_CHUNK_BYTES'],
+        ttl=app.config['CHUNKED_UPLOAD_TTL']
+    )
+
+# 分割アップロードの開始（ファイル名・サイズ・任意で全体のSHA-256）
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename') or ''
+    if not allowed_file(filename):
+        return jsonify({'error': 'PDFファイルのみアップロード可能です'}), 400
+    try:
+        upload = chunked_uploads().create(filename, data.get('size'), data.get('sha256'))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    logger.info(f'分割アップロード開始: {filename} ({upload["size"]}バイト, {upload["upload_id"]})')
+    upload['upload_url'] = url_for('upload_chunk', upload_id=upload['upload_id'])
+    return jsonify(upload), 201
+
+# チャンクの受信（?offset=<開始位置>、X-Chunk-SHA256ヘッダーでハッシュを照合）と状態の問い合わせ
+@app.route('/uploads/<upload_id>', methods=['PUT', 'GET', 'DELETE'])
+def upload_chunk(upload_id):
+    uploads = chunked_uploads()
+    try:
+        if request.method == 'GET':
+            return jsonify(uploads.status(upload_id))
+        if request.method == 'DELETE':
+            uploads.discard(upload_id)
+            return '', 204
+        
+        offset = request.args.get('offset', type=int)
+        if offset is None or request.content_length is None:
+            return jsonify({'error': 'offsetとContent-Lengthを指定してください'}), 400
+        status = uploads.write_chunk(
+            upload_id, offset, request.stream, request.content_length,
+            sha256=request.headers.get('X-Chunk-SHA256')
+        )
+    except UploadNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadError as e:
+        logger.warning(f'チャンクの受信エラー: {upload_id}: {str(e)}')
+        return jsonify({'error': str(e)}), 400
+    # 受信済みの範囲のリストは大きくなり得るので、チャンクごとの応答には含めない
+    return jsonify({key: status[key] for key in ('upload_id', 'size', 'received_bytes', 'complete')})
+
+# 分割アップロードの完了（PDFとしての検証を行い、ビューアのURLを返す）
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    uploads = chunked_uploads()
+    try:
+        original = uploads.status(upload_id)['filename']
+        filename = upload_filename(original)
+        g.document = filename
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        uploads.finalize(upload_id, file_path)
+    except UploadNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadIncomplete as e:
+        return jsonify({'error': str(e), 'missing': uploads.status(upload_id)['missing']}), 409
+    except UploadConflict as e:
+        # 同じアップロードの完了要求が並行した場合、先に確保した1つ以外
+        return jsonify({'error': str(e)}), 409
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    UPLOAD_SIZE.observe(os.path.getsize(file_path))
+    logger.info(f'ファイルアップロード成功: {filename}（分割アップロード）')
+    if not validate_upload(file_path):
+        return jsonify({'error': '不正なPDFファイルです'}), 400
+    documents().publish(filename)
+    
+    return jsonify({
+        'filename': filename,
+        'view_url': url_for('view_pdf', filename=filename)
+    })
+
 @app.route('/view/<filename>')
 def view_pdf(filename):
     # ファイル名の検証
-    if not allowed_file(filename) or not os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+    if not allowed_file(filename) or document_path(filename) is None:
         logger.warning(f'無効なファイル名またはファイルが存在しません: {filename}')
         return render_template('error.html', message='指定されたPDFファイルが見つかりません'), 404
     
@@ -122,12 +617,273 @@ def serve_pdf(filename):
         logger.warning(f'パストラバーサルの試み検出: {filename}')
         abort(403)  # Forbidden
     
-    if not os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+    pdf_path = document_path(filename)
+    if pdf_path is None:
         logger.warning(f'ファイルが存在しません: {filename}')
         abort(404)  # Not Found
     
+    # ビューア用に最適化したコピーができていればそちらを配信する（Rangeリクエストにも対応）
+    fast_web_copy = current_fast_web_copy(pdf_path)
+    if fast_web_copy:
+        return send_from_directory(app.config['UPLOAD_FOLDER'], os.path.basename(fast_web_copy))
+    
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+# ページを画像としてレンダリング（ページ番号は1始まり）
+@app.route('/render/<filename>/<int:page_number>')
+def render_page(filename, page_number):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename)
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    
+    fmt = request.args.get('format', 'png')
+    if fmt not in render_service.FORMATS:
+        return jsonify({'error': '未対応の画像形式です'}), 400
+    dpi = request.args.get('dpi', 96, type=int)
+    
+    try:
+        with RENDER_SECONDS.time(format=fmt):
+            data = RENDER_SERVICE.render(pdf_path, page_number - 1, dpi=dpi, fmt=fmt)
+    except PageNotFound:
+        abort(404)  # Not Found
+    except RenderBusy:
+        RENDER_REJECTED.inc(reason='busy')
+        logger.warning(f'レンダリングの待ち行列が一杯です: {filename}')
+        response = jsonify({'error': 'サーバーが混雑しています'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    except RenderTimeout:
+        RENDER_REJECTED.inc(reason='timeout')
+        logger.error(f'レンダリングがタイムアウトしました: {filename} ページ{page_number}')
+        return jsonify({'error': 'レンダリングがタイムアウトしました'}), 504
+    
+    response = Response(data, mimetype=render_service.FORMATS[fmt])
+    # アップロードされたファイルは名前ごとに不変なので長期間キャッシュできる
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+# 全ページ（または指定範囲）を画像にしてZIPでダウンロード
+@app.route('/export-images/<filename>')
+def export_images(filename):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename)
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    
+    fmt = request.args.get('format', 'png')
+    if fmt not in render_service.FORMATS:
+        return jsonify({'error': '未対応の画像形式です'}), 400
+    dpi = request.args.get('dpi', 150, type=int)
+    
+    with DOCUMENT_POOL.checkout(pdf_path) as doc:
+        page_count = len(doc)
+    try:
+        pages = parse_page_range(request.args.get('pages'), page_count)
+    except ValueError:
+        return jsonify({'error': 'ページ指定が不正です'}), 400
+    
+    def generate():
+        # レスポンスの送信中に発生したエラーはステータスを変えられないため記録して打ち切る
+        try:
+            for chunk in iter_zip_chunks(RENDER_SERVICE, pdf_path, pages, dpi=dpi, fmt=fmt):
+                yield chunk
+            logger.info(f'画像書き出し完了: {filename}, {len(pages)}ページ')
+        except Exception as e:
+            logger.error(f'画像書き出しエラー: {filename}: {str(e)}')
+            raise
+    
+    base_name = os.path.splitext(filename)[0]
+    response = Response(stream_with_context(generate()), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{base_name}_pages.zip"'
+    return response
+
+# 全文検索（索引はアップロード後にバックグラウンドで作成される）
+@app.route('/search/<filename>')
+def search_pdf(filename):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename) if allowed_file(filename) else None
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '検索語を指定してください'}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    
+    index_path = index_path_for(os.path.abspath(pdf_path))
+    with SEARCH_SECONDS.time():
+        index = SEARCH_INDEXES.get(index_path)
+        if index is None:
+            # 索引がまだない場合（作成中、または再起動などで失われた場合）は作成を開始して後で再試行させる
+            if BACKGROUND_JOBS.status(('index', os.path.abspath(pdf_path))) != PENDING:
+                schedule_search_index(pdf_path)
+            response = jsonify({'status': 'indexing', 'message': '検索索引を作成中です'})
+            response.headers['Retry-After'] = '2'
+            return response, 202
+        results, total = index.search_with_total(query, limit=limit)
+    
+    # total_pagesは一致したページの総数（limitで切り詰めた場合はresultsより多い）
+    return jsonify({
+        'query': query,
+        'total_pages': total,
+        'truncated': total > len(results),
+        'results': results
+    })
+
+# ページ一覧用のサムネイルの索引（スプライト画像のURLと各ページの位置）
+@app.route('/thumbnails/<filename>')
+def thumbnail_index(filename):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename) if allowed_file(filename) else None
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    pdf_path = os.path.abspath(pdf_path)
+    
+    thumbs_dir = thumbs_dir_for(pdf_path)
+    index = load_thumbnail_index(thumbs_dir)
+    if index is None:
+        # まだない場合（作成中、または再起動などで失われた場合）は作成を開始して後で再試行させる
+        if BACKGROUND_JOBS.status(('thumbnails', pdf_path)) != PENDING:
+            schedule_thumbnails(pdf_path)
+        response = jsonify({'status': 'generating', 'message': 'サムネイルを作成中です'})
+        response.headers['Retry-After'] = '2'
+        return response, 202
+    
+    # 作り直した場合にブラウザのキャッシュを使わないよう、索引の更新日時をURLに含める
+    version = os.stat(os.path.join(thumbs_dir, THUMBNAIL_INDEX_NAME)).st_mtime_ns
+    index['sheets'] = [
+        url_for('thumbnail_sprite', filename=filename, sheet=sheet, v=version)
+        for sheet in index['sheets']
+    ]
+    return jsonify(index)
+
+# サムネイルのスプライト画像（長期間キャッシュさせる）
+@app.route('/thumbnails/<filename>/<sheet>')
+def thumbnail_sprite(filename, sheet):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename or '..' in sheet or '/' in sheet:
+        logger.warning(f'パストラバーサルの試み検出: {filename}/{sheet}')
+        abort(403)  # Forbidden
+    
+    thumbs_dir = thumbs_dir_for(os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], filename)))
+    if not sheet.startswith('sprite_') or not os.path.isfile(os.path.join(thumbs_dir, sheet)):
+        logger.warning(f'ファイルが存在しません: {filename}/{sheet}')
+        abort(404)  # Not Found
+    
+    response = send_from_directory(thumbs_dir, sheet, max_age=app.config['THUMBNAIL_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# ドラッグした矩形を覆われた単語の行ごとの矩形に吸着させる
+@app.route('/snap/<filename>/<int:page_number>')
+def snap_to_text(filename, page_number):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename) if allowed_file(filename) else None
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    pdf_path = os.path.abspath(pdf_path)
+    
+    # 矩形はPDF座標（ポイント）で指定する
+    x = request.args.get('x', type=float)
+    y = request.args.get('y', type=float)
+    width = request.args.get('width', type=float)
+    height = request.args.get('height', type=float)
+    if None in (x, y, width, height):
+        return jsonify({'error': '矩形（x, y, width, height）を指定してください'}), 400
+    
+    def load_words():
+        with DOCUMENT_POOL.checkout(pdf_path) as doc:
+            if page_number < 1 or page_number > len(doc):
+                raise PageNotFound(f'ページが存在しません: {page_number}')
+            return doc[page_number - 1].get_text('words')
+    
+    stat = os.stat(pdf_path)
+    key = (pdf_path, stat.st_mtime_ns, stat.st_size, page_number)
+    try:
+        with SNAP_SECONDS.time():
+            lines = WORD_INDEX.snap(key, load_words, (x, y, x + width, y + height))
+    except PageNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    
+    return jsonify({
+        'page': page_number,
+        'lines': lines
+    })
+
+# PDFにすでに含まれている注釈をビューアの形式で返す（結果は内容のハッシュごとに保存）
+@app.route('/annotations/<filename>')
+def existing_annotations(filename):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename) if allowed_file(filename) else None
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    
+    cache_dir = os.path.join(app.config['ANNOTATION_FOLDER'], 'extracted')
+    start = time.perf_counter()
+    digest = EXTRACTED_ANNOTATIONS.digest(pdf_path)
+    annotations = EXTRACTED_ANNOTATIONS.load(cache_dir, digest)
+    cached = annotations is not None
+    if not cached:
+        try:
+            with DOCUMENT_POOL.checkout(pdf_path) as doc:
+                page_count = len(doc)
+            # ページ範囲ごとにワーカープロセスへ分散する
+            annotations = extract_annotations(RENDER_SERVICE, pdf_path, page_count)
+        except RenderBusy as e:
+            RENDER_REJECTED.inc(reason='busy')
+            response = jsonify({'error': str(e)})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        except RenderTimeout as e:
+            RENDER_REJECTED.inc(reason='timeout')
+            return jsonify({'error': str(e)}), 504
+        EXTRACTED_ANNOTATIONS.store(cache_dir, digest, annotations)
+        logger.info(f'注釈の取り出し完了: {filename} ({len(annotations)}件)')
+    EXTRACT_SECONDS.observe(time.perf_counter() - start, result='hit' if cached else 'miss')
+    
+    return jsonify({
+        'hash': digest,
+        'cached': cached,
+        'annotations': annotations
+    })
+
+# 注釈付きPDFの受け取り方
+#   file:   UPLOAD_FOLDERに保存してダウンロードURLを返す（従来どおり）
+#   stream: ディスクに保存せず、レスポンスとしてPDFをそのまま返す
+DELIVERY_MODES = ('file', 'stream')
+
 @app.route('/save-annotations', methods=['POST'])
 def save_annotations():
     try:
@@ -144,6 +900,7 @@ def save_annotations():
             return jsonify({'success': False, 'error': '必須フィールドが不足しています'}), 400
         
         filename = data['filename']
+        g.document = filename
         
         # パストラバーサル対策
         if '..' in filename or '/' in filename:
@@ -151,51 +908,430 @@ def save_annotations():
             return jsonify({'success': False, 'error': '無効なファイル名です'}), 400
         
         # PDFファイルのパス
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        pdf_path = document_path(filename)
         
         # ファイルの存在確認
-        if not os.path.isfile(pdf_path):
+        if pdf_path is None:
             logger.warning(f'ファイルが存在しません: {filename}')
             return jsonify({'success': False, 'error': 'PDFファイルが見つかりません'}), 404
         
-        # 注釈データの保存
-        annotations = data['annotations']
+        # 出力プロファイル
+        profile = data.get('profile') or app.config['OUTPUT_PROFILE']
+        if profile not in OUTPUT_PROFILES:
+            return jsonify({'success': False, 'error': f'未対応の出力プロファイルです: {profile}'}), 400
         
+        delivery = data.get('delivery') or 'file'
+        if delivery not in DELIVERY_MODES:
+            return jsonify({'success': False, 'error': f'未対応の受け取り方です: {delivery}'}), 400
+        
+        return save_document(filename, pdf_path, data['annotations'], profile, delivery, 'api')
+    
+    except Exception as e:
+        logger.error(f'注釈保存エラー: {str(e)}')
+        return jsonify({'success': False, 'error': f'注釈の保存中にエラーが発生しました: {str(e)}'}), 500
+
+# 注釈データと注釈付きPDFを保存してレスポンスを返す（/save-annotations と /collab/<filename>/save で共通）
+# sourceは保存の出どころ（'api' / 'collab'）。出どころが違う保存はまとめない
+def save_document(filename, pdf_path, annotations, profile, delivery, source):
+    ANNOTATIONS_PER_SAVE.observe(len(annotations))
+    
+    def save(annotations):
         # 重複を避けるためのタイムスタンプ
-        timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        timestamp = save_timestamp()
         base_name = os.path.splitext(filename)[0]
         
-        # 注釈ファイルの生成
-        annotation_filename = f"{base_name}_annotations_{timestamp}.json"
-        annotation_path = os.path.join(app.config['ANNOTATION_FOLDER'], annotation_filename)
-        
-        with open(annotation_path, 'w', encoding='utf-8') as f:
-            json.dump(annotations, f, ensure_ascii=False, indent=2)
+        # 注釈ファイルの生成（ダウンロードするだけのstreamでは書かない。ビューアの注釈は
+        # fileでの保存で、共同編集の注釈は操作ログに残っている）
+        if delivery == 'file':
+            write_annotations(filename, annotations, timestamp)
         
         # 注釈付きPDFの生成
         output_filename = f"annotated_{base_name}_{timestamp}.pdf"
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
+        if delivery == 'stream':
+            # メモリ上に書き出してそのまま返す（一時ファイルもダウンロード用のファイルも残さない）
+            output_path = io.BytesIO()
+        else:
+            output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
         
-        # PDF注釈の適用
+        report = apply_annotations_to_pdf(pdf_path, annotations, output_path, profile)
+        if delivery == 'file':
+            documents().publish(output_filename)
+        logger.info(f'注釈の適用成功: {output_filename} ({format_report(report)})')
+        return output_filename, output_path if delivery == 'stream' else None, report
+    
+    # 同じPDFへの同じ出どころの保存は1つずつ実行し、待っている間に届いた保存は最新の内容で1回にまとめる。
+    # 操作ログの状態とビューアが送った一覧は別の内容なので、片方がもう片方を置き換えないようにキーを分ける。
+    # 実行枠はまとめた保存を実行するときだけ確保する（まとめられたリクエストは枠を使わない）
+    route = g.metrics_route
+    try:
+        (output_filename, buffer, report), coalesced = SAVE_COALESCER.submit(
+            (source, os.path.abspath(pdf_path), profile, delivery), annotations,
+            lambda annotations: run_admitted(route, save, annotations))
+    except AdmissionRejected as e:
+        return admission_rejected(route, e)
+    except Exception as e:
+        logger.error(f'注釈適用エラー: {str(e)}')
+        return jsonify({'success': False, 'error': f'注釈の適用中にエラーが発生しました: {str(e)}'}), 500
+    if coalesced > 1:
+        logger.info(f'{coalesced}件の保存をまとめて実行しました: {filename}')
+    
+    if delivery == 'stream':
+        return send_pdf_buffer(buffer, f"annotated_{filename}", report)
+    
+    # ダウンロードURLの生成
+    download_url = url_for('download_file', filename=output_filename)
+    
+    return jsonify({
+        'success': True,
+        'message': '注釈が保存されました',
+        'download_url': download_url,
+        'output': report,
+        'coalesced': coalesced
+    })
+
+# メモリ上に書き出した注釈付きPDFをレスポンスとして返す
+# 保存をまとめた場合は同じバッファを複数のレスポンスで返すため、バッファはコピーも変更もせず、
+# 各レスポンスがそのビューから少しずつ取り出して送る
+def send_pdf_buffer(buffer, download_name, report):
+    view = buffer.getbuffer()
+    chunk_size = app.config['PDF_STREAM_CHUNK_BYTES']
+    
+    def generate():
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+    
+    response = Response(generate(), mimetype='application/pdf')
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.content_length = len(view)
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = 0
+    response.headers['X-Output-Profile'] = report['profile']
+    response.headers['X-Output-Bytes'] = str(report['output_bytes'])
+    return response
+
+# 保存するファイル名に付けるタイムスタンプ（同じ秒の保存で名前が重ならないようマイクロ秒まで含める）
+def save_timestamp():
+    return datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+# 注釈データ（ビューアのJSON）を保存する
+def write_annotations(filename, annotations, timestamp=None):
+    timestamp = timestamp or save_timestamp()
+    base_name = os.path.splitext(filename)[0]
+    annotation_filename = f"{base_name}_annotations_{timestamp}.json"
+    annotation_path = os.path.join(app.config['ANNOTATION_FOLDER'], annotation_filename)
+    with open(annotation_path, 'w', encoding='utf-8') as f:
+        json.dump(annotations, f, ensure_ascii=False, indent=2)
+    annotation_files().publish(annotation_filename)
+    return annotation_path
+
+# 最後に保存した注釈データを読み込む（保存されていなければNone）
+def load_latest_annotations(filename):
+    base_name = os.path.splitext(filename)[0]
+    pattern = re.compile(re.escape(base_name) + r'_annotations_\d{14}(\d{6})?\.json')
+    store = annotation_files()
+    names = sorted(name for name in store.names(f'{base_name}_annotations_') if pattern.fullmatch(name))
+    path = store.local_path(names[-1]) if names else None
+    if path is None:
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+# 各ページのPDF座標からビューアの座標への変換行列（XFDF / FDFの座標の変換に使う）
+def page_matrices(pdf_path):
+    with DOCUMENT_POOL.checkout(pdf_path) as doc:
+        return [page.transformation_matrix for page in doc]
+
+# 共同編集の操作ログ（初回は最後に保存した注釈から始める。PDFに含まれている注釈は各ビューアが読み込む）
+# コンパクションで書き出したスナップショットは注釈データとしても保存する
+def collab_log(filename):
+    def seed():
+        return [a for a in load_latest_annotations(filename) or [] if a.get('source') != 'pdf']
+    
+    def snapshot(seq, annotations):
+        write_annotations(filename, annotations)
+        logger.info(f'共同編集のスナップショットを保存しました: {filename} (seq={seq}, {len(annotations)}件)')
+    
+    folder = app.config['COLLAB_FOLDER'] or os.path.join(app.config['ANNOTATION_FOLDER'], 'collab')
+    return COLLAB_LOGS.get(os.path.join(folder, filename), seed, snapshot)
+
+# 共同編集の対象のPDFを検証する
+def check_collab_document(filename):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    if document_path(filename) is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+
+# 共同編集の現在の状態（スナップショット + ログを適用した注釈の一覧と通し番号）
+@app.route('/collab/<filename>/state')
+def collab_state(filename):
+    check_collab_document(filename)
+    seq, annotations = collab_log(filename).state()
+    return jsonify({'seq': seq, 'annotations': annotations})
+
+# 注釈の操作（add / update / delete / replace）を操作ログに追記する
+@app.route('/collab/<filename>/ops', methods=['POST'])
+def collab_operations(filename):
+    check_collab_document(filename)
+    data = request.get_json(silent=True) or {}
+    try:
+        records = collab_log(filename).append(data.get('ops'), client=data.get('client'))
+    except OperationError as e:
+        return jsonify({'error': str(e)}), 400
+    for record in records:
+        COLLAB_OPERATIONS.inc(op=record['op'])
+    return jsonify({'seq': records[-1]['seq'], 'count': len(records)})
+
+# 操作ログの現在の状態から注釈データと注釈付きPDFを保存する（ビューアの保存・ダウンロード）
+# 本文は任意で {"profile", "delivery"}（/save-annotations と同じ）
+@app.route('/collab/<filename>/save', methods=['POST'])
+def collab_save(filename):
+    check_collab_document(filename)
+    g.document = filename
+    data = request.get_json(silent=True) or {}
+    profile = data.get('profile') or app.config['OUTPUT_PROFILE']
+    if profile not in OUTPUT_PROFILES:
+        return jsonify({'success': False, 'error': f'未対応の出力プロファイルです: {profile}'}), 400
+    delivery = data.get('delivery') or 'file'
+    if delivery not in DELIVERY_MODES:
+        return jsonify({'success': False, 'error': f'未対応の受け取り方です: {delivery}'}), 400
+    seq, annotations = collab_log(filename).state()
+    response = save_document(filename, document_path(filename), annotations, profile, delivery, 'collab')
+    response = app.make_response(response)
+    response.headers['X-Collab-Seq'] = str(seq)
+    return response
+
+# 操作ログをServer-Sent Eventsで配信する
+# 再接続時はブラウザが送るLast-Event-ID（通し番号）の続きから送る。
+# コンパクションで続きの操作が失われている場合は reset イベントで現在の状態を送る。
+# 1本がリクエストのスレッドを1つ使い続けるため、COLLAB_MAX_SUBSCRIBERSを超えた接続は503で断る
+@app.route('/collab/<filename>/events')
+def collab_events(filename):
+    check_collab_document(filename)
+    log = collab_log(filename)
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        since = None
+    stream_seconds = app.config['COLLAB_STREAM_SECONDS']
+    heartbeat = app.config['COLLAB_HEARTBEAT_SECONDS']
+    
+    def event(name, data, event_id=None):
+        lines = [f'id: {event_id}'] if event_id is not None else []
+        lines += [f'event: {name}', 'data: ' + json.dumps(data, ensure_ascii=False, separators=(',', ':'))]
+        return '\n'.join(lines) + '\n\n'
+    
+    def generate():
+        COLLAB_SUBSCRIBERS.inc()
         try:
-            apply_annotations_to_pdf(pdf_path, annotations, output_path)
-            logger.info(f'注釈の適用成功: {output_filename}')
-        except Exception as e:
-            logger.error(f'注釈適用エラー: {str(e)}')
-            return jsonify({'success': False, 'error': f'注釈の適用中にエラーが発生しました: {str(e)}'}), 500
-        
-        # ダウンロードURLの生成
-        download_url = url_for('download_file', filename=output_filename)
-        
-        return jsonify({
-            'success': True,
-            'message': '注釈が保存されました',
-            'download_url': download_url
-        })
+            seq = since
+            yield 'retry: 1000\n\n'
+            if seq is None:
+                seq, annotations = log.state()
+                yield event('reset', {'seq': seq, 'annotations': annotations}, seq)
+            deadline = time.monotonic() + stream_seconds
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                records = log.wait(seq, min(heartbeat, remaining))
+                if records is None:
+                    seq, annotations = log.state()
+                    yield event('reset', {'seq': seq, 'annotations': annotations}, seq)
+                elif records:
+                    for record in records:
+                        yield event('op', record, record['seq'])
+                    seq = records[-1]['seq']
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            COLLAB_SUBSCRIBERS.dec()
     
+    if not COLLAB_STREAMS.acquire(app.config['COLLAB_MAX_SUBSCRIBERS']):
+        logger.warning(f'イベントストリームの接続数が上限に達しています: {filename}')
+        response = jsonify({'error': '共同編集の接続数が上限に達しています。しばらくしてから再接続してください'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(max(1, int(app.config['COLLAB_STREAM_SECONDS'])))
+        return response
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginxのバッファリングを無効化
+    # ストリームを読み始める前に切断された場合も含め、閉じたときに枠を返す
+    response.call_on_close(COLLAB_STREAMS.release)
+    return response
+
+# 保存済みの注釈だけをXFDF / FDFで書き出す
+@app.route('/export-annotations/<filename>')
+def export_annotation_layer(filename):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename)
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    
+    fmt = request.args.get('format', 'xfdf')
+    if fmt not in ANNOTATION_FORMATS:
+        return jsonify({'error': f'未対応の形式です: {fmt}'}), 400
+    
+    annotations = load_latest_annotations(filename)
+    if annotations is None:
+        return jsonify({'error': '保存された注釈がありません'}), 404
+    
+    data = export_annotations(annotations, page_matrices(pdf_path), fmt, pdf_name=filename)
+    base_name = os.path.splitext(filename)[0]
+    response = Response(data, mimetype=XFDF_MIMETYPE if fmt == 'xfdf' else FDF_MIMETYPE)
+    response.headers['Content-Disposition'] = f'attachment; filename="{base_name}.{fmt}"'
+    return response
+
+# XFDF / FDFの注釈を読み込み、保存済みの注釈に統合する（PDFは書き換えない）
+@app.route('/import-annotations/<filename>', methods=['POST'])
+def import_annotation_layer(filename):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename)
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    
+    # multipartの'file'、またはリクエスト本文そのものを受け付ける
+    upload = request.files.get('file')
+    data = upload.read() if upload else request.get_data()
+    try:
+        fmt, imported, skipped = import_annotations(data, page_matrices(pdf_path))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    # 同じIDの注釈は置き換え、その他は既存の注釈に追加する
+    replace = request.args.get('replace') == '1'
+    annotations = imported if replace else merge_annotations(load_latest_annotations(filename) or [], imported)
+    write_annotations(filename, annotations)
+    logger.info(f'注釈の読み込み成功: {filename} ({fmt}, {len(imported)}件, 読み飛ばし{skipped}件)')
+    
+    return jsonify({
+        'success': True,
+        'format': fmt,
+        'imported': len(imported),
+        'skipped': skipped,
+        'annotations': annotations,
+        'download_url': url_for('download_merged', filename=filename)
+    })
+
+# 保存済みの注釈を元のPDFに適用して返す（要求されたときにだけPDFを作る）
+@app.route('/merged/<filename>')
+def download_merged(filename):
+    # パストラバーサル対策として、ファイル名を検証
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        abort(403)  # Forbidden
+    
+    pdf_path = document_path(filename)
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        abort(404)  # Not Found
+    
+    profile = request.args.get('profile') or app.config['OUTPUT_PROFILE']
+    if profile not in OUTPUT_PROFILES:
+        return jsonify({'error': f'未対応の出力プロファイルです: {profile}'}), 400
+    
+    annotations = load_latest_annotations(filename)
+    if annotations is None:
+        return jsonify({'error': '保存された注釈がありません'}), 404
+    
+    buffer = io.BytesIO()
+    report = apply_annotations_to_pdf(pdf_path, annotations, buffer, profile)
+    logger.info(f'注釈の統合成功: {filename} ({format_report(report)})')
+    return send_pdf_buffer(buffer, f"annotated_{filename}", report)
+
+# 検索語の出現箇所をすべてハイライトした注釈付きPDFを作成
+@app.route('/highlight-terms', methods=['POST'])
+def highlight_terms():
+    if not request.is_json:
+        logger.warning('リクエストがJSONではありません')
+        return jsonify({'success': False, 'error': 'JSONデータが必要です'}), 400
+    
+    data = request.get_json()
+    filename = data.get('filename', '')
+    g.document = filename
+    terms = data.get('terms')
+    if isinstance(terms, str):
+        terms = [terms]
+    if not filename or not isinstance(terms, list):
+        logger.warning('必須フィールドがありません')
+        return jsonify({'success': False, 'error': '必須フィールドが不足しています'}), 400
+    
+    terms = normalize_terms(str(term) for term in terms)
+    if not terms or len(terms) > MAX_TERMS:
+        return jsonify({'success': False, 'error': f'検索語は1～{MAX_TERMS}個指定してください'}), 400
+    
+    profile = data.get('profile') or app.config['OUTPUT_PROFILE']
+    if profile not in OUTPUT_PROFILES:
+        return jsonify({'success': False, 'error': f'未対応の出力プロファイルです: {profile}'}), 400
+    
+    color = data.get('color', '#ffff00')
+    if not isinstance(color, str) or not re.fullmatch(r'#[0-9a-fA-F]{6}', color):
+        return jsonify({'success': False, 'error': f'色は #rrggbb の形式で指定してください: {color}'}), 400
+    
+    # パストラバーサル対策
+    if '..' in filename or '/' in filename:
+        logger.warning(f'パストラバーサルの試み検出: {filename}')
+        return jsonify({'success': False, 'error': '無効なファイル名です'}), 400
+    
+    pdf_path = document_path(filename)
+    if pdf_path is None:
+        logger.warning(f'ファイルが存在しません: {filename}')
+        return jsonify({'success': False, 'error': 'PDFファイルが見つかりません'}), 404
+    
+    timestamp = save_timestamp()
+    base_name = os.path.splitext(filename)[0]
+    output_filename = f"annotated_{base_name}_{timestamp}.pdf"
+    output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
+    
+    try:
+        # 変更して保存するため、プール外のハンドルを使う
+        with DOCUMENT_POOL.checkout(pdf_path, private=True) as pdf_document:
+            # 検索はワーカープロセスに分散し、結果をまとめて1回で保存する
+            with BULK_HIGHLIGHT_SECONDS.time(phase='search'):
+                occurrences = find_occurrences(RENDER_SERVICE, pdf_path, len(pdf_document), terms)
+            with BULK_HIGHLIGHT_SECONDS.time(phase='annotate'):
+                add_highlights(pdf_document, occurrences, hex_to_rgb(color))
+            with BULK_HIGHLIGHT_SECONDS.time(phase='save'):
+                report = save_with_profile(pdf_document, output_path, profile, in_place=True)
+            OUTPUT_SIZE_RATIO.observe(report['ratio'], profile=profile)
+        documents().publish(output_filename)
+    except RenderBusy as e:
+        RENDER_REJECTED.inc(reason='busy')
+        response = jsonify({'success': False, 'error': str(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    except RenderTimeout as e:
+        RENDER_REJECTED.inc(reason='timeout')
+        return jsonify({'success': False, 'error': str(e)}), 504
     except Exception as e:
-        logger.error(f'注釈保存エラー: {str(e)}')
-        return jsonify({'success': False, 'error': f'注釈の保存中にエラーが発生しました: {str(e)}'}), 500
+        logger.error(f'一括ハイライトエラー: {str(e)}')
+        return jsonify({'success': False, 'error': f'一括ハイライト中にエラーが発生しました: {str(e)}'}), 500
+    
+    result = summarize(occurrences, terms)
+    logger.info(f'一括ハイライト成功: {output_filename} ({result["pages"]}ページ)')
+    return jsonify({
+        'success': True,
+        'message': 'ハイライトを追加しました',
+        'matches': result['matches'],
+        'pages': result['pages'],
+        'download_url': url_for('download_file', filename=output_filename),
+        'output': report
+    })
 
 @app.route('/download/<filename>')
 def download_file(filename):
@@ -204,7 +1340,7 @@ def download_file(filename):
         logger.warning(f'パストラバーサルの試み検出: {filename}')
         abort(403)  # Forbidden
     
-    if not os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+    if document_path(filename) is None:
         logger.warning(f'ファイルが存在しません: {filename}')
         abort(404)  # Not Found
     
@@ -214,11 +1350,26 @@ def download_file(filename):
         as_attachment=True
     )
 
-# PDFに注釈を適用する関数
-def apply_annotations_to_pdf(pdf_path, annotations, output_path):
-    # PDFを開く
-    pdf_document = fitz.open(pdf_path)
+# PDFに注釈を適用する関数（保存結果のサイズと所要時間を返す）
+def apply_annotations_to_pdf(pdf_path, annotations, output_path, profile=None):
+    profile = profile or app.config['OUTPUT_PROFILE']
+    # PDFを開く（プールのハンドルは読み取り専用のため、保存ごとにプール外のハンドルを開いてそのまま保存する）
+    open_start = time.perf_counter()
+    with DOCUMENT_POOL.checkout(pdf_path, private=True) as pdf_document:
+        APPLY_SECONDS.observe(time.perf_counter() - open_start, phase='open')
+        
+        with APPLY_SECONDS.time(phase='annotate'):
+            add_annotations_to_document(pdf_document, annotations)
+        
+        # 変更を出力プロファイルのオプションで保存
+        with APPLY_SECONDS.time(phase='save'):
+            report = save_with_profile(pdf_document, output_path, profile, in_place=True)
     
+    OUTPUT_SIZE_RATIO.observe(report['ratio'], profile=profile)
+    return report
+
+# 開いているPDFに注釈を追加する関数
+def add_annotations_to_document(pdf_document, annotations):
     # ページごとの注釈をグループ化
     page_annotations = {}
     for annotation in annotations:
@@ -245,24 +1396,16 @@ def apply_annotations_to_pdf(pdf_path, annotations, output_path):
         page = pdf_document[page_num]
         
         for annotation in annotations_list:
+            # 元のPDFから取り出した注釈はすでに含まれているので追加しない
+            if annotation.get('source') == 'pdf':
+                continue
             try:
                 anno_type = annotation.get('type')
                 x = annotation.get('x', 0)
                 y = annotation.get('y', 0)
                 width = annotation.get('width', 0)
                 height = annotation.get('height', 0)
-                color_str = annotation.get('color', '#ffff00')  # デフォルト黄色
-                
-                # 16進カラーコードをRGBに変換（RGBの順序はPDFの仕様に合わせる）
-                if color_str.startswith('#'):
-                    color_str = color_str[1:]  # 先頭の#を削除
-                    r = int(color_str[0:2], 16) / 255.0
-                    g = int(color_str[2:4], 16) / 255.0
-                    b = int(color_str[4:6], 16) / 255.0
-                    color = (r, g, b)
-                else:
-                    # デフォルトカラー（黄色）
-                    color = (1, 1, 0)
+                color = hex_to_rgb(annotation.get('color', '#ffff00'))  # デフォルト黄色
                 
                 # アノテーションのタイプに応じて処理
                 if anno_type == 'highlight':
@@ -273,21 +1416,63 @@ def apply_annotations_to_pdf(pdf_path, annotations, output_path):
                 elif anno_type == 'rect':
                     # 矩形注釈を追加
                     rect = fitz.Rect(x, y, x + width, y + height)
-                    page.add_rect_annot(rect, color=color)
+                    annot = page.add_rect_annot(rect)
+                    annot.set_colors(stroke=color)
+                    annot.update()
                 
                 elif anno_type == 'text':
                     # テキスト注釈を追加
                     text = annotation.get('text', '')
                     point = fitz.Point(x, y)
-                    page.add_text_annot(point, text, color=color)
+                    annot = page.add_text_annot(point, text)
+                    annot.set_colors(stroke=color)
+                    annot.update()
             
             except Exception as e:
                 logger.error(f'注釈適用エラー: {str(e)}')
                 continue
+
+# 16進カラーコードをRGBに変換する関数（RGBの順序はPDFの仕様に合わせる）
+def hex_to_rgb(color_str):
+    if color_str.startswith('#'):
+        color_str = color_str[1:]  # 先頭の#を削除
+        r = int(color_str[0:2], 16) / 255.0
+        g = int(color_str[2:4], 16) / 255.0
+        b = int(color_str[4:6], 16) / 255.0
+        return (r, g, b)
+    # デフォルトカラー（黄色）
+    return (1, 1, 0)
+
+# Prometheus形式のメトリクス
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# 保存済みプロファイルの一覧
+@app.route('/admin/profiles')
+def list_profiles():
+    require_admin()
+    store = ProfileStore(app.config['PROFILE_FOLDER'], app.config['PROFILE_MAX_FILES'])
+    return jsonify({'profiles': store.list()})
+
+# 保存済みプロファイルの取得（pstats / collapsed / txt）
+@app.route('/admin/profiles/<profile_id>.<fmt>')
+def get_profile(profile_id, fmt):
+    require_admin()
+    store = ProfileStore(app.config['PROFILE_FOLDER'], app.config['PROFILE_MAX_FILES'])
+    path = store.path(profile_id, fmt)
+    if path is None:
+        abort(404)  # Not Found
+    
+    if fmt == 'txt':
+        return Response(store.render_text(profile_id), mimetype=ProfileStore.FORMATS[fmt])
     
-    # 変更を保存
-    pdf_document.save(output_path)
-    pdf_document.close()
+    return send_from_directory(
+        os.path.abspath(store.folder),
+        os.path.basename(path),
+        mimetype=ProfileStore.FORMATS[fmt],
+        as_attachment=(fmt == 'pstats')
+    )
 
 # エラーハンドラ
 @app.errorhandler(404)
@@ -309,7 +1494,3 @@ def request_entity_too_large(e):
 def handle_bad_request(e):
     logger.warning(f'不正なリクエスト: {str(e)}')
     return render_template('error.html', message='不正なリクエストです'), 400
-
-if __name__ == '__main__':
-    print('PDF Annotator Server starting...')
-    app.run(host='0.0.0.0', port=5000, debug=True)
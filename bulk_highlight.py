@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""検索語の出現箇所をすべてハイライトする
+
+ページを一定数ずつに分けてレンダリングサービスのワーカープロセスで
+page.search_for を実行し、集めた結果を1つのドキュメントにまとめて
+追加してから1回だけ保存する。ワーカーは自分用のドキュメントキャッシュを
+持っているため、同じPDFを分割して投入しても開き直しは各ワーカー1回で済む。
+
+CLI:
+    python bulk_highlight.py manual.pdf -t PN-1234 -t PN-5678 -o manual_highlighted.pdf
+"""
+import argparse
+import os
+import sys
+
+import fitz  # PyMuPDF
+
+from output_profiles import PROFILES as OUTPUT_PROFILES, DEFAULT_PROFILE, save_with_profile, format_report
+from render_service import RenderService, worker_document
+
+# 1回の投入で検索するページ数
+PAGES_PER_TASK = 25
+
+# 1回の要求で受け付ける検索語の上限
+MAX_TERMS = 50
+
+
+def normalize_terms(terms):
+    """検索語の前後の空白を除き、空の語と重複を取り除く"""
+    result = []
+    for term in terms:
+        term = term.strip()
+        if term and term not in result:
+            result.append(term)
+    return result
+
+
+def search_pages(path, page_numbers, terms):
+    """ワーカーで指定ページの検索語を探す
+
+    Returns:
+        list: [(page_number, term, [[x0, y0, x1, y1, x2, y2, x3, y3], ...]), ...]
+    """
+    found = []
+    with worker_document(path) as doc:
+        for page_number in page_numbers:
+            page = doc[page_number]
+            for term in terms:
+                quads = page.search_for(term, quads=True)
+                if quads:
+                    found.append((page_number, term, [
+                        [q.ul.x, q.ul.y, q.ur.x, q.ur.y, q.ll.x, q.ll.y, q.lr.x, q.lr.y] for q in quads
+                    ]))
+    return found
+
+
+def find_occurrences(service, path, page_count, terms, pages_per_task=PAGES_PER_TASK):
+    """全ページの検索語の出現箇所をワーカーに分散して探す
+
+    Returns:
+        list: ページ順の [(page_number, term, quads), ...]
+    """
+    path = os.path.abspath(path)
+    chunks = (
+        (path, list(range(start, min(start + pages_per_task, page_count))), terms)
+        for start in range(0, page_count, pages_per_task)
+    )
+    found = []
+    for chunk_result in service.map(search_pages, chunks):
+        found.extend(chunk_result)
+    return found
+
+
+def add_highlights(document, occurrences, color=(1, 1, 0)):
+    """出現箇所をページ・検索語ごとに1つのハイライト注釈として追加する
+
+    Returns:
+        int: 追加した注釈の数
+    """
+    count = 0
+    for page_number, term, quads in occurrences:
+        page = document[page_number]
+        annot = page.add_highlight_annot(quads=[fitz.Quad(q[0:2], q[2:4], q[4:6], q[6:8]) for q in quads])
+        annot.set_colors(stroke=color)
+        annot.set_info(content=term)
+        annot.update()
+        count += 1
+    return count
+
+
+def highlight_terms(pdf_path, terms, output_path, color=(1, 1, 0), workers=None, profile=DEFAULT_PROFILE):
+    """PDFの検索語をすべてハイライトして保存する
+
+    Returns:
+        dict: 検索語ごとの出現数、ハイライトしたページ数、保存結果
+    """
+    terms = normalize_terms(terms)
+    with fitz.open(pdf_path) as doc:
+        service = RenderService(workers=workers)
+        try:
+            occurrences = find_occurrences(service, pdf_path, len(doc), terms)
+        finally:
+            service.shutdown()
+        add_highlights(doc, occurrences, color)
+        report = save_with_profile(doc, output_path, profile, in_place=True)
+    return dict(summarize(occurrences, terms), output=report)
+
+
+def summarize(occurrences, terms):
+    """検索語ごとの出現数とハイライトしたページ数"""
+    counts = {term: 0 for term in terms}
+    for _, term, quads in occurrences:
+        counts[term] += len(quads)
+    return {
+        'matches': counts,
+        'pages': len({page_number for page_number, _, _ in occurrences})
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PDFの検索語をすべてハイライトする')
+    parser.add_argument('pdf', help='入力PDF')
+    parser.add_argument('-t', '--term', action='append', required=True, help='検索語（複数指定可）')
+    parser.add_argument('-o', '--output', help='出力PDF（省略時は <入力名>_highlighted.pdf）')
+    parser.add_argument('--workers', type=int, help='ワーカープロセス数（省略時はCPUコア数）')
+    parser.add_argument('--profile', choices=sorted(OUTPUT_PROFILES), default=DEFAULT_PROFILE, help='出力プロファイル')
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.splitext(args.pdf)[0] + '_highlighted.pdf'
+    result = highlight_terms(args.pdf, args.term, output, workers=args.workers, profile=args.profile)
+    for term, count in result['matches'].items():
+        print(f'{term}: {count}件')
+    print(f'{result["pages"]}ページをハイライトしました: {output}')
+    print(format_report(result['output']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""再開可能な分割アップロード
+
+MAX_CONTENT_LENGTH を超える大きなPDFを、チャンクごとのリクエストで送れるようにする。
+
+1. 開始: ファイル名とサイズを受け取り、アップロードIDを発行して
+   保存先のファイルを最終的なサイズで作成する
+2. チャンク: オフセットとSHA-256（必須）を指定して送られたチャンクを、ハッシュを
+   計算しながら一時領域（chunk_size まではメモリ、超えた分は一時ファイル）に受け取り、
+   ハッシュが一致した場合だけ保存先のファイルの該当位置へ書き込んで受信済みとして記録する。
+   壊れたチャンクを送り直しても、受信済みの範囲を上書きしない
+3. 完了: セッションのディレクトリの名前を変えて確保し（renameはアトミックなので、
+   同じアップロードの完了要求が並行しても進むのは1つだけ。ほかは UploadConflict）、
+   すべての範囲を受信済みなら（全体のハッシュが指定されていれば照合して）
+   アップロードフォルダへ移動する。PDFとしての検証は呼び出し側で行う
+
+途中で接続が切れた場合は、状態の問い合わせで受信済みの範囲を取得し、
+残りのチャンクだけを送り直せばよい。
+
+状態はすべてディスクに置く（``<フォルダ>/<アップロードID>/``）ため、
+同じノードの複数のワーカープロセスにリクエストが分散しても、サーバーを再起動しても続きから送れる。
+複数のノードで受け付ける場合は、フォルダを共有ディレクトリに置くか、同じアップロードへの
+リクエストを同じノードに振り分ける（スティッキーセッション）必要がある。
+受信済みのチャンクは ``<オフセット>-<長さ>`` という名前の空ファイルで記録するので、
+同じアップロードへのチャンクを並列に送ってもロックは要らない。
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+# クライアントに勧めるチャンクの大きさ（MAX_CONTENT_LENGTHより小さくする）
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+META_NAME = 'meta.json'
+DATA_NAME = 'data.part'
+CHUNKS_DIR = 'chunks'
+# 完了処理中のセッションのディレクトリに付ける接尾辞
+FINALIZING_SUFFIX = '.finalizing'
+
+_UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+_COPY_BUFFER = 1024 * 1024
+
+
+class UploadError(ValueError):
+    """アップロードの要求が不正"""
+
+
+class UploadNotFound(UploadError):
+    """アップロードIDが存在しない（期限切れを含む）"""
+
+
+class ChunkHashMismatch(UploadError):
+    """チャンクのハッシュが一致しない"""
+
+
+class UploadIncomplete(UploadError):
+    """受信していない範囲が残っている"""
+
+
+class UploadConflict(UploadError):
+    """別のリクエストが完了処理中"""
+
+
+def merge_ranges(ranges):
+    """[開始, 終了) の範囲のリストを重なりと隣接をまとめて並べる"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_ranges(received, size):
+    """受信済みの範囲から、まだ受信していない範囲を求める"""
+    missing = []
+    position = 0
+    for start, end in received:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+
+class ChunkedUploads:
+    """分割アップロードのセッション
+
+    Args:
+        folder: セッションを置くディレクトリ
+        max_size: 受け付けるファイルサイズの上限（バイト）
+        chunk_size: クライアントに勧めるチャンクの大きさ
+        ttl: 最後にチャンクを受け取ってから破棄するまでの秒数
+    """
+
+    def __init__(self, folder, max_size, chunk_size=DEFAULT_CHUNK_SIZE, ttl=24 * 60 * 60):
+        self.folder = folder
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+
+    def _session_dir(self, upload_id):
+        if not _UPLOAD_ID.fullmatch(upload_id or ''):
+            raise UploadNotFound('アップロードIDが不正です')
+        path = os.path.join(self.folder, upload_id)
+        if not os.path.isfile(os.path.join(path, META_NAME)):
+            if os.path.isdir(path + FINALIZING_SUFFIX):
+                raise UploadConflict('このアップロードは別のリクエストで完了処理中です')
+            raise UploadNotFound('アップロードが見つかりません（期限切れの可能性があります）')
+        return path
+
+    def _meta(self, session_dir):
+        with open(os.path.join(session_dir, META_NAME), encoding='utf-8') as f:
+            return json.load(f)
+
+    def create(self, filename, size, sha256=None):
+        """アップロードを開始する
+
+        Returns:
+            dict: アップロードID、ファイルサイズ、勧めるチャンクの大きさ
+        """
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('ファイルサイズが不正です')
+        if size > self.max_size:
+            raise UploadError(f'ファイルサイズは{self.max_size // (1024 * 1024)}MB以下である必要があります')
+        if sha256 is not None and not re.fullmatch(r'[0-9a-fA-F]{64}', sha256):
+            raise UploadError('SHA-256の形式が不正です')
+        self.purge_expired()
+
+        upload_id = uuid.uuid4().hex
+        session_dir = os.path.join(self.folder, upload_id)
+        os.makedirs(os.path.join(session_dir, CHUNKS_DIR))
+        # 最終的なサイズで作成しておき、チャンクは届いた順に該当位置へ書き込む
+        with open(os.path.join(session_dir, DATA_NAME), 'wb') as f:
+            f.truncate(size)
+        meta = {
+            'filename': filename,
+            'size': size,
+            'sha256': sha256.lower() if sha256 else None,
+            'created': time.time(),
+        }
+        # meta.json を最後に書き、これがあるディレクトリだけを有効なセッションとする
+        with open(os.path.join(session_dir, META_NAME), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return {'upload_id': upload_id, 'size': size, 'chunk_size': self.chunk_size}
+
+    def write_chunk(self, upload_id, offset, stream, length, sha256=None):
+        """チャンクを保存先のファイルの該当位置に書き込む
+
+        Args:
+            stream: チャンクの内容を読み出すファイルオブジェクト（リクエスト本文）
+            length: チャンクの長さ
+            sha256: チャンクのSHA-256（16進数、必須）。一致しなければ記録しない
+
+        Returns:
+            dict: 状態（status() と同じ）
+        """
+        session_dir = self._session_dir(upload_id)
+        size = self._meta(session_dir)['size']
+        if offset < 0 or length <= 0 or offset + length > size:
+            raise UploadError(f'チャンクの範囲が不正です: {offset}+{length} (サイズ {size})')
+        if not sha256 or not re.fullmatch(r'[0-9a-fA-F]{64}', sha256):
+            raise UploadError('チャンクのSHA-256（X-Chunk-SHA256）が必要です')
+
+        # ハッシュを確かめるまで保存先のファイルには書き込まない
+        digest = hashlib.sha256()
+        received = 0
+        with tempfile.SpooledTemporaryFile(max_size=self.chunk_size, dir=session_dir) as spool:
+            while received < length:
+                block = stream.read(min(_COPY_BUFFER, length - received))
+                if not block:
+                    break
+                digest.update(block)
+                spool.write(block)
+                received += len(block)
+            if received != length:
+                raise UploadError(f'チャンクが途中で切れています: {received}/{length}バイト')
+            if digest.hexdigest() != sha256.lower():
+                raise ChunkHashMismatch(f'チャンクのハッシュが一致しません: オフセット {offset}')
+
+            spool.seek(0)
+            with open(os.path.join(session_dir, DATA_NAME), 'r+b') as f:
+                f.seek(offset)
+                shutil.copyfileobj(spool, f, _COPY_BUFFER)
+
+        open(os.path.join(session_dir, CHUNKS_DIR, f'{offset}-{length}'), 'wb').close()
+        return self.status(upload_id)
+
+    def status(self, upload_id):
+        """受信済みの範囲とまだ受信していない範囲"""
+        return self._status(self._session_dir(upload_id), upload_id)
+
+    def _status(self, session_dir, upload_id):
+        meta = self._meta(session_dir)
+        ranges = []
+        for name in os.listdir(os.path.join(session_dir, CHUNKS_DIR)):
+            start, length = (int(v) for v in name.split('-'))
+            ranges.append((start, start + length))
+        received = merge_ranges(ranges)
+        missing = missing_ranges(received, meta['size'])
+        return {
+            'upload_id': upload_id,
+            'filename': meta['filename'],
+            'size': meta['size'],
+            'chunk_size': self.chunk_size,
+            'received_bytes': sum(end - start for start, end in received),
+            'received': received,
+            'missing': missing,
+            'complete': not missing,
+        }
+
+    def finalize(self, upload_id, dest_path):
+        """すべて受信済みのファイルを保存先に移動してセッションを削除する
+
+        Returns:
+            str: 元のファイル名
+        """
+        session_dir = self._session_dir(upload_id)
+        # 完了要求が並行した場合に1つだけが進むよう、ディレクトリの名前を変えて確保する
+        claimed = session_dir + FINALIZING_SUFFIX
+        try:
+            os.rename(session_dir, claimed)
+        except FileNotFoundError:
+            raise UploadConflict('このアップロードは別のリクエストで完了処理中です')
+        status = self._status(claimed, upload_id)
+        if not status['complete']:
+            # 続きを送れるように元の名前に戻す
+            os.rename(claimed, session_dir)
+            raise UploadIncomplete(f'未受信の範囲があります: {status["missing"][:5]}')
+        meta = self._meta(claimed)
+        data_path = os.path.join(claimed, DATA_NAME)
+        if meta['sha256']:
+            digest = hashlib.sha256()
+            with open(data_path, 'rb') as f:
+                for block in iter(lambda: f.read(_COPY_BUFFER), b''):
+                    digest.update(block)
+            if digest.hexdigest() != meta['sha256']:
+                shutil.rmtree(claimed, ignore_errors=True)
+                raise ChunkHashMismatch('ファイル全体のハッシュが一致しません')
+        # フォルダを共有ディレクトリに置いた場合は別のファイルシステムへの移動になる
+        shutil.move(data_path, dest_path)
+        shutil.rmtree(claimed, ignore_errors=True)
+        return meta['filename']
+
+    def discard(self, upload_id):
+        shutil.rmtree(self._session_dir(upload_id), ignore_errors=True)
+
+    def purge_expired(self, now=None):
+        """最後の更新から ttl 秒を過ぎたセッションを削除する
+
+        Returns:
+            int: 削除したセッション数
+        """
+        now = now or time.time()
+        removed = 0
+        try:
+            names = os.listdir(self.folder)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            session_dir = os.path.join(self.folder, name)
+            # 完了処理の途中で止まったセッションも対象にする
+            if not _UPLOAD_ID.fullmatch(name.removesuffix(FINALIZING_SUFFIX)):
+                continue
+            try:
+                updated = max(os.stat(session_dir).st_mtime, os.stat(os.path.join(session_dir, CHUNKS_DIR)).st_mtime)
+            except FileNotFoundError:
+                updated = 0
+            if now - updated > self.ttl:
+                shutil.rmtree(session_dir, ignore_errors=True)
+                removed += 1
+        return removed
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""注釈の共同編集（ドキュメントごとの追記専用の操作ログ）
+
+同じPDFを開いているビューアは、注釈の一覧をまるごと保存し合う代わりに
+追加・更新（移動・サイズ変更・編集）・削除の操作を送り合う。操作は
+ドキュメントごとのログに通し番号（seq）を付けて追記され、Server-Sent Events で
+他のビューアに配信される。
+
+ディスク上の構成（``<フォルダ>/``）:
+
+- ``snapshot.json``: ある時点（seq）までの操作を適用した注釈の一覧と世代（generation）
+- ``log.jsonl``: 1行目に世代、以降はスナップショットより後の操作（1行1件）
+- ``lock``: 追記とコンパクションの排他用
+
+ログが ``compact_every`` 件を超えると、その時点の注釈の一覧を次の世代のスナップショットとして
+書き出し、ログをその世代の空のログに置き換える（コンパクション）。後から参加したビューアは
+スナップショットと短いログを読むだけで現在の状態を得られる。
+コンパクションのたびに ``on_compact`` でスナップショットを通知するので、呼び出し側は
+それを注釈データとして保存できる（ビューアが操作のたびに一覧全体を保存する必要はない）。
+
+ログはファイルに置くため、gunicornの別のワーカーで追記された操作も
+ファイルの追記を読み進めることで配信できる。各プロセスはログを読んだ位置と世代、
+適用済みの状態を覚えておき、増えた分だけを読む。ログの1行目の世代が変わっていれば
+コンパクションされたので、スナップショットから読み直す（inodeは共有ディレクトリでは
+使い回されることがあるため使わない）。フォルダを全ノードで共有するディレクトリ（flockが
+使えるもの）に置けば、複数のノードで同じログを使える。
+
+別のプロセスの追記は、待っている配信がある間だけドキュメントごとに1つの
+スレッド（テイラー）がログを読み進めて検知し、待っている配信をまとめて起こす。
+配信ごとにログを確認し直すことはしない。
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows（単一プロセスで動かすためロックは不要）
+    fcntl = None
+
+OPERATIONS = ('add', 'update', 'delete', 'replace')
+
+# この件数の操作が溜まったらスナップショットを作り直す
+COMPACT_EVERY = 500
+
+# 1回のリクエストで送れる操作の数
+MAX_OPERATIONS = 500
+
+# テイラーが別のプロセスの追記を確認する間隔（秒）
+TAIL_INTERVAL = 0.05
+
+SNAPSHOT_NAME = 'snapshot.json'
+LOG_NAME = 'log.jsonl'
+LOCK_NAME = 'lock'
+
+
+class OperationError(ValueError):
+    """操作の形式が不正"""
+
+
+def validate_operation(op):
+    """クライアントから送られた操作を検証して、ログに書く形にする"""
+    if not isinstance(op, dict) or op.get('op') not in OPERATIONS:
+        raise OperationError(f'未対応の操作です: {op.get("op") if isinstance(op, dict) else op!r}')
+    kind = op['op']
+    if kind == 'replace':
+        annotations = op.get('annotations')
+        if not isinstance(annotations, list) or not all(isinstance(a, dict) and 'id' in a for a in annotations):
+            raise OperationError('replace には注釈の一覧（idを含む）が必要です')
+        return {'op': kind, 'annotations': annotations}
+    if kind == 'delete':
+        if op.get('id') is None:
+            raise OperationError('delete には注釈のidが必要です')
+        return {'op': kind, 'id': str(op['id'])}
+    annotation = op.get('annotation')
+    if not isinstance(annotation, dict) or annotation.get('id') is None:
+        raise OperationError(f'{kind} にはidを含む注釈が必要です')
+    return {'op': kind, 'id': str(annotation['id']), 'annotation': annotation}
+
+
+def apply_operation(annotations, record):
+    """注釈の辞書（id -> 注釈、追加順）に操作を適用する
+
+    更新は対象がなければ追加として扱う（PDFに含まれていた注釈の移動など）。
+    """
+    kind = record['op']
+    if kind == 'replace':
+        annotations.clear()
+        for annotation in record['annotations']:
+            annotations[str(annotation['id'])] = annotation
+    elif kind == 'delete':
+        annotations.pop(record['id'], None)
+    else:
+        annotations[record['id']] = record['annotation']
+
+
+@contextmanager
+def _file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_json(path, data, newline=False):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        if newline:
+            f.write('\n')
+    os.replace(tmp_path, path)
+
+
+def _write_log_header(path, generation):
+    # 世代だけを書いた空のログに置き換える
+    _write_json(path, {'generation': generation}, newline=True)
+
+
+class DocumentLog:
+    """1つのドキュメントの操作ログ
+
+    Args:
+        folder: ログを置くディレクトリ
+        seed: スナップショットがまだない場合に最初の注釈の一覧を返す関数
+        compact_every: コンパクションするログの件数
+        on_compact: コンパクションの後に ``(seq, 注釈のリスト)`` で呼ぶ関数（ロックの外で呼ぶ）
+        tail_interval: テイラーが別のプロセスの追記を確認する間隔（秒）
+    """
+
+    def __init__(self, folder, seed=None, compact_every=COMPACT_EVERY, on_compact=None,
+                 tail_interval=TAIL_INTERVAL):
+        self.folder = folder
+        self.seed = seed
+        self.compact_every = compact_every
+        self.on_compact = on_compact
+        self.tail_interval = tail_interval
+        self._condition = threading.Condition()
+        self._waiters = 0       # wait() で待っている数
+        self._tailer = None     # 待っている間だけ動くテイラーのスレッド
+        self._generation = None  # 読んでいるログファイルの世代
+        self._position = 0      # ログファイルの読んだ位置
+        self._snapshot_seq = 0
+        self._seq = 0
+        self._annotations = OrderedDict()
+        self._records = []      # スナップショットより後の操作
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def _ensure_files(self):
+        # ロックを保持して呼ぶ
+        if not os.path.isfile(self._path(SNAPSHOT_NAME)):
+            annotations = list(self.seed()) if self.seed else []
+            _write_json(self._path(SNAPSHOT_NAME), {'seq': 0, 'generation': 0, 'annotations': annotations})
+        if not os.path.isfile(self._path(LOG_NAME)):
+            _write_log_header(self._path(LOG_NAME), 0)
+
+    def _sync(self):
+        """ディスク上のログの増えた分を読み込む（self._condition を保持して呼ぶ）"""
+        if not os.path.isfile(self._path(LOG_NAME)):
+            os.makedirs(self.folder, exist_ok=True)
+            with _file_lock(self._path(LOCK_NAME)):
+                self._ensure_files()
+
+        # 世代の確認と追記の読み込みは同じファイルから行う（途中で置き換えられても混ざらない）
+        with open(self._path(LOG_NAME), 'rb') as f:
+            header = f.readline()
+            generation = json.loads(header)['generation']
+            if generation != self._generation:
+                # コンパクションされた（または初回）: スナップショットから読み直す
+                # （スナップショットはログより先に書き出されるので、この世代以降のものが読める）
+                with open(self._path(SNAPSHOT_NAME), encoding='utf-8') as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+                self._generation = generation
+                self._position = len(header)
+                self._snapshot_seq = self._seq = snapshot['seq']
+                self._annotations = OrderedDict((str(a['id']), a) for a in snapshot['annotations'])
+                self._records = []
+                # 待っている配信にリセットが必要かどうかを確認させる
+                self._condition.notify_all()
+            f.seek(self._position)
+            data = f.read()
+        # 書き込み途中の行は次回に読む
+        complete = data[:data.rfind(b'\n') + 1]
+        self._position += len(complete)
+        added = False
+        for line in complete.splitlines():
+            record = json.loads(line)
+            if record['seq'] <= self._seq:
+                continue
+            apply_operation(self._annotations, record)
+            self._records.append(record)
+            self._seq = record['seq']
+            added = True
+        if added:
+            self._condition.notify_all()
+
+    def state(self):
+        """現在の注釈の一覧
+
+        Returns:
+            tuple: (seq, 注釈のリスト)
+        """
+        with self._condition:
+            self._sync()
+            return self._seq, list(self._annotations.values())
+
+    def append(self, ops, client=None):
+        """操作を検証してログに追記する
+
+        Returns:
+            list: 通し番号を付けた操作
+        """
+        if not isinstance(ops, list) or not ops:
+            raise OperationError('操作の一覧が必要です')
+        if len(ops) > MAX_OPERATIONS:
+            raise OperationError(f'1回に送れる操作は{MAX_OPERATIONS}件までです')
+        validated = [validate_operation(op) for op in ops]
+
+        snapshot = None
+        with self._condition:
+            self._sync()
+            with _file_lock(self._path(LOCK_NAME)):
+                # 他のプロセスが追記した分を読んでから番号を振る
+                self._sync()
+                now = time.time()
+                records = []
+                for i, op in enumerate(validated, start=1):
+                    records.append(dict(op, seq=self._seq + i, client=client, time=now))
+                lines = ''.join(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + '\n' for r in records)
+                with open(self._path(LOG_NAME), 'a', encoding='utf-8') as f:
+                    f.write(lines)
+                self._sync()
+                if len(self._records) >= self.compact_every:
+                    snapshot = self._compact()
+        if snapshot is not None and self.on_compact:
+            self.on_compact(*snapshot)
+        return records
+
+    def _compact(self):
+        """スナップショットを書き出してログを空にする（両方のロックを保持して呼ぶ）
+
+        Returns:
+            tuple: 書き出したスナップショット (seq, 注釈のリスト)
+        """
+        snapshot = (self._seq, list(self._annotations.values()))
+        generation = self._generation + 1
+        _write_json(self._path(SNAPSHOT_NAME), {'seq': snapshot[0], 'generation': generation, 'annotations': snapshot[1]})
+        _write_log_header(self._path(LOG_NAME), generation)
+        self._sync()
+        return snapshot
+
+    def compact(self):
+        with self._condition:
+            self._sync()
+            with _file_lock(self._path(LOCK_NAME)):
+                self._sync()
+                snapshot = self._compact()
+        if self.on_compact:
+            self.on_compact(*snapshot)
+
+    def since(self, seq):
+        """指定した通し番号より後の操作（コンパクションで失われている場合や、ログにない番号の場合はNone）"""
+        with self._condition:
+            self._sync()
+            if seq < self._snapshot_seq or seq > self._seq:
+                return None
+            return [r for r in self._records if r['seq'] > seq]
+
+    def wait(self, seq, timeout):
+        """指定した通し番号より後の操作が届くまで待つ
+
+        同じプロセスでの追記はすぐに、別のプロセスでの追記はテイラーが読み進めた時点で起こされる。
+
+        Returns:
+            list | None: 届いた操作（タイムアウトした場合は空のリスト）。
+                コンパクションで失われている場合や、ログにない番号の場合はNone
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._sync()
+            self._waiters += 1
+            if self._tailer is None or not self._tailer.is_alive():
+                self._tailer = threading.Thread(target=self._tail, name=f'collab-tail-{os.path.basename(self.folder)}',
+                                                daemon=True)
+                self._tailer.start()
+            try:
+                while True:
+                    if seq < self._snapshot_seq or seq > self._seq:
+                        return None
+                    if self._seq > seq:
+                        return [r for r in self._records if r['seq'] > seq]
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return []
+                    self._condition.wait(remaining)
+            finally:
+                self._waiters -= 1
+
+    def _tail(self):
+        """待っている配信がある間、ログの追記を読み進めて待っている配信を起こす"""
+        while True:
+            with self._condition:
+                if not self._waiters:
+                    self._tailer = None
+                    return
+                try:
+                    self._sync()
+                except (OSError, ValueError):
+                    # 書き換え途中のスナップショットなどは次の確認で読み直す
+                    pass
+            time.sleep(self.tail_interval)
+
+    @property
+    def waiters(self):
+        with self._condition:
+            return self._waiters
+
+
+class StreamSlots:
+    """イベントストリームの同時接続数（プロセスごと）
+
+    ストリームは1本につきリクエストのスレッドを1つ使うため、上限を超えた接続は断り、
+    ほかのリクエストのためのスレッドを残す。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+
+    @property
+    def active(self):
+        with self._lock:
+            return self._active
+
+    def acquire(self, limit):
+        """空きがあれば1本分を確保する（上限に達していればFalse）"""
+        with self._lock:
+            if self._active >= limit:
+                return False
+            self._active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+
+
+class CollabLogs:
+    """ドキュメントごとのDocumentLogを使い回す（プロセスごと）"""
+
+    def __init__(self, max_documents=64, compact_every=COMPACT_EVERY):
+        self.max_documents = max_documents
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._logs = OrderedDict()
+
+    def get(self, folder, seed=None, on_compact=None):
+        folder = os.path.abspath(folder)
+        with self._lock:
+            log = self._logs.get(folder)
+            if log is None:
+                log = self._logs[folder] = DocumentLog(folder, seed, self.compact_every, on_compact)
+            self._logs.move_to_end(folder)
+            while len(self._logs) > self.max_documents:
+                self._logs.popitem(last=False)
+            return log
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""プロセス内で共有する fitz.Document のLRUプール
+
+ページ数の確認・単語の取得・座標の変換のような読み取りのたびに fitz.open で
+xrefとページツリーを解析し直さないように、開いたドキュメントをパスと
+更新日時をキーに保持する。
+
+ドキュメントはスレッドセーフではないため、1つのハンドルは同時に1つの
+リクエストにしか貸し出さない。使用中のハンドルを要求された場合は、
+待たずにプール外の一時的なハンドルを開いて返す。
+
+プールのハンドルは読み取り専用として扱う（返却時に変更されていたハンドルは破棄する）。
+注釈を追加して保存する処理は ``checkout(path, private=True)`` でプール外のハンドルを借り、
+そのまま保存して閉じる。保存はプロファイルのオプションでドキュメント自体を書き換えるため、
+プールのハンドルを使い回しても変更の取り消しやコピーの分だけ遅くなる
+（300ページのPDFでジャーナルで取り消す方式より新しく開く方が速かった）。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from mapped_pdf import open_pdf
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class _Entry:
+    def __init__(self, path, key, document):
+        self.path = path
+        self.key = key
+        self.document = document
+        self.size = key[1]
+        self.busy = False
+        self.stale = False
+
+
+class DocumentPool:
+    """開いた fitz.Document を保持するLRUプール
+
+    Args:
+        max_documents: 保持するドキュメント数の上限
+        max_bytes: 保持するドキュメントのファイルサイズ合計の上限
+        on_open: fitz.open の所要時間を受け取るコールバック ``(seconds, pooled)``
+        on_checkout: 貸し出し結果（'hit' / 'miss' / 'busy' / 'private'）を受け取るコールバック
+        open_mode: PDFの開き方（'path' / 'mmap'、mapped_pdf.open_pdf を参照）
+    """
+
+    def __init__(self, max_documents=8, max_bytes=512 * 1024 * 1024, on_open=None, on_checkout=None,
+                 open_mode='path'):
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.on_open = on_open
+        self.on_checkout = on_checkout
+        self.open_mode = open_mode
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # パス -> _Entry（末尾が最近使用したもの）
+        if hasattr(os, 'register_at_fork'):
+            # fork後の子プロセスは親のMuPDFオブジェクトを使わない
+            os.register_at_fork(after_in_child=self._forget_all)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    @contextmanager
+    def checkout(self, path, private=False):
+        """ドキュメントを貸し出す（withブロックを抜けると返却。変更されていた場合は破棄する）
+
+        private=True の場合はプールを使わず、変更して保存するための一時的なハンドルを開いて
+        withブロックを抜けると閉じる。
+        """
+        path = os.path.abspath(path)
+        if private:
+            if self.on_checkout:
+                self.on_checkout('private')
+            document = self._open(path, pooled=False)
+            try:
+                yield document
+            finally:
+                document.close()
+            return
+
+        key = _file_key(path)
+        entry, result = self._acquire(path, key)
+        if self.on_checkout:
+            self.on_checkout(result)
+
+        if entry is None:
+            # 使用中のためプール外のハンドルを使う
+            document = self._open(path, pooled=False)
+            try:
+                yield document
+            finally:
+                document.close()
+            return
+
+        reusable = False
+        try:
+            yield entry.document
+            reusable = True
+        finally:
+            self._release(entry, reusable and not entry.document.is_dirty)
+
+    def invalidate(self, path):
+        """指定したパスのハンドルを破棄する（ファイルを削除・置換する前に呼ぶ）"""
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None:
+                return
+            if entry.busy:
+                entry.stale = True
+                return
+        entry.document.close()
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry.busy:
+                entry.stale = True
+            else:
+                entry.document.close()
+
+    def _open(self, path, pooled):
+        start = time.perf_counter()
+        document = open_pdf(path, self.open_mode)
+        if self.on_open:
+            self.on_open(time.perf_counter() - start, pooled)
+        return document
+
+    def _acquire(self, path, key):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.key != key:
+                # ファイルが更新されている
+                del self._entries[path]
+                if entry.busy:
+                    entry.stale = True
+                else:
+                    entry.document.close()
+                entry = None
+            if entry is not None:
+                if entry.busy:
+                    return None, 'busy'
+                entry.busy = True
+                self._entries.move_to_end(path)
+                return entry, 'hit'
+
+        document = self._open(path, pooled=True)
+        if not document.is_pdf:
+            # PDF以外（画像など）はプールしない
+            document.close()
+            return None, 'miss'
+
+        entry = _Entry(path, key, document)
+        entry.busy = True
+        with self._lock:
+            if path in self._entries:
+                # 別のスレッドが先に登録した
+                document.close()
+                return None, 'busy'
+            self._entries[path] = entry
+            evicted = self._evict()
+        for old in evicted:
+            old.document.close()
+        return entry, 'miss'
+
+    def _evict(self):
+        """上限を超えた分を古い順に取り除く（ロックを保持して呼ぶ）"""
+        evicted = []
+        total = sum(entry.size for entry in self._entries.values())
+        for path in list(self._entries):
+            if len(self._entries) <= self.max_documents and total <= self.max_bytes:
+                break
+            entry = self._entries[path]
+            if entry.busy:
+                continue
+            del self._entries[path]
+            total -= entry.size
+            evicted.append(entry)
+        return evicted
+
+    def _release(self, entry, reusable):
+        with self._lock:
+            entry.busy = False
+            if reusable and not entry.stale:
+                return
+            if self._entries.get(entry.path) is entry:
+                del self._entries[entry.path]
+        entry.document.close()
+
+    def _forget_all(self):
+        # 親プロセスのハンドルは閉じずに参照だけを捨てる
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
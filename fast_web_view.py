@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""ブラウザ表示用に最適化したPDFのコピーを作る
+
+アップロードされたPDFの多くは線形化（Fast Web View）されておらず、
+pdf.jsは末尾のxrefとファイルの大部分を取得するまで1ページ目を描けない。
+ここでは不要なオブジェクトの削除とストリームの圧縮を行ったコピーを作り、
+qpdfが使える場合はさらに線形化して、先頭から順に読めば1ページ目を
+表示できるようにする。
+
+MuPDF 1.23以降は線形化に対応していないため、線形化はqpdfで行う。
+qpdfがない場合は最適化だけを行い、元のファイルより小さくならなければ
+コピーは作らない（元のファイルをそのまま配信する）。
+"""
+import os
+import shutil
+import subprocess
+
+import fitz  # PyMuPDF
+
+FAST_WEB_SUFFIX = '.fastweb.pdf'
+
+
+def fast_web_path_for(pdf_path):
+    return pdf_path + FAST_WEB_SUFFIX
+
+
+def find_qpdf():
+    """qpdfの実行ファイルのパス（見つからなければNone）"""
+    return shutil.which('qpdf')
+
+
+def is_linearized(path):
+    """ファイルの先頭に線形化パラメータ辞書があるか"""
+    with open(path, 'rb') as f:
+        return b'/Linearized' in f.read(1024)
+
+
+def write_fast_web_copy(pdf_path, out_path=None, qpdf=None, timeout=300):
+    """最適化（と線形化）したコピーを作成する（別プロセスから呼ばれる）
+
+    Returns:
+        dict: 出力先（作らなかった場合はNone）、線形化したか、入出力のサイズ
+    """
+    out_path = out_path or fast_web_path_for(pdf_path)
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    linear_tmp_path = f'{out_path}.{os.getpid()}.linear.tmp'
+    input_bytes = os.path.getsize(pdf_path)
+    try:
+        with fitz.open(pdf_path) as doc:
+            doc.save(tmp_path, garbage=3, deflate=True, deflate_images=True, deflate_fonts=True)
+
+        linearized = False
+        if qpdf:
+            result = subprocess.run(
+                [qpdf, '--linearize', tmp_path, linear_tmp_path],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout
+            )
+            # 終了コード3は警告付きの成功
+            if result.returncode in (0, 3) and os.path.isfile(linear_tmp_path):
+                os.replace(linear_tmp_path, tmp_path)
+                linearized = True
+
+        output_bytes = os.path.getsize(tmp_path)
+        if not linearized and output_bytes >= input_bytes:
+            # 効果がないので元のファイルを配信させる
+            os.remove(tmp_path)
+            return {'path': None, 'linearized': False, 'input_bytes': input_bytes, 'output_bytes': input_bytes}
+
+        os.replace(tmp_path, out_path)
+        return {'path': out_path, 'linearized': linearized, 'input_bytes': input_bytes, 'output_bytes': output_bytes}
+    finally:
+        for path in (tmp_path, linear_tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def current_fast_web_copy(pdf_path):
+    """配信に使えるコピーのパス（ない場合や元のファイルより古い場合はNone）"""
+    out_path = fast_web_path_for(pdf_path)
+    try:
+        if os.stat(out_path).st_mtime_ns >= os.stat(pdf_path).st_mtime_ns:
+            return out_path
+    except FileNotFoundError:
+        pass
+    return None
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""アップロード後の重い処理をバックグラウンドで実行するジョブキュー
+
+索引の作成などPyMuPDFでCPUを使う処理はGILを保持するため、
+リクエストスレッドと競合しないように別プロセスで実行する。
+同じキーのジョブが実行待ちまたは実行中の場合は重複して投入しない。
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class BackgroundJobs:
+    """キー付きのバックグラウンドジョブ
+
+    Args:
+        workers: ワーカープロセス数（0の場合はプロセスを使わず1本のスレッドで実行）
+        logger: 失敗したジョブを記録するロガー
+        on_queue_change: 未完了のジョブ数を受け取るコールバック
+        max_history: 完了したジョブの状態を保持する件数
+    """
+
+    def __init__(self, workers=2, logger=None, on_queue_change=None, max_history=1000):
+        self.workers = workers
+        self.logger = logger
+        self.on_queue_change = on_queue_change
+        self.max_history = max_history
+        self._lock = threading.Lock()
+        self._futures = {}  # キー -> Future（投入順）
+        self._executor = None
+        self._pid = None
+        atexit.register(self.shutdown)
+
+    def _get_executor(self):
+        # ロックを保持して呼ぶ。fork後の子プロセスでは作り直す
+        if self._executor is None or self._pid != os.getpid():
+            if self.workers == 0:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='background-job')
+            else:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            self._pid = os.getpid()
+            self._futures = {}
+        return self._executor
+
+    def submit(self, key, func, *args, callback=None):
+        """ジョブを投入する（同じキーのジョブが未完了ならそのFutureを返す）
+
+        callbackは完了時に結果を引数として呼び出し元のプロセスで実行される。
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and not future.done() and self._pid == os.getpid():
+                return future
+            future = self._get_executor().submit(func, *args)
+            self._futures.pop(key, None)
+            self._futures[key] = future
+            self._prune()
+        self._notify()
+        future.add_done_callback(lambda f: self._finished(key, f, callback))
+        return future
+
+    def status(self, key):
+        """ジョブの状態（pending / done / failed、未投入ならNone）"""
+        with self._lock:
+            future = self._futures.get(key)
+        if future is None:
+            return None
+        if not future.done():
+            return PENDING
+        return FAILED if future.cancelled() or future.exception() is not None else DONE
+
+    def wait(self, key, timeout=None):
+        """ジョブの完了を待って結果を返す（未投入ならNone）"""
+        with self._lock:
+            future = self._futures.get(key)
+        return None if future is None else future.result(timeout=timeout)
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum(1 for f in self._futures.values() if not f.done())
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _finished(self, key, future, callback):
+        self._notify()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            if self.logger:
+                self.logger.error(f'バックグラウンドジョブ失敗: {key}: {str(error)}')
+            return
+        if callback is not None:
+            try:
+                callback(future.result())
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f'バックグラウンドジョブの完了処理エラー: {key}: {str(e)}')
+
+    def _notify(self):
+        if self.on_queue_change:
+            self.on_queue_change(self.pending)
+
+    def _prune(self):
+        # 完了したジョブの状態を古い順に捨てる（ロックを保持して呼ぶ）
+        excess = len(self._futures) - self.max_history
+        if excess <= 0:
+            return
+        for key in [k for k, f in self._futures.items() if f.done()][:excess]:
+            del self._futures[key]
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""リクエストスレッドをブロックしないログ出力
+
+ロガーには ``QueueHandler`` だけを付け、ファイルへの書き込みとローテーションは
+``QueueListener`` のスレッドで行う。リクエストスレッドで行うのはメッセージの
+組み立てとキューへの追加だけなので、ローテーション中のファイル名の変更や
+ディスクの遅延を待たされることはない。
+
+レコードは1行1件のJSONで書き出す。リクエストの処理中に出したログには、
+呼び出し側が渡す関数（``context``）でリクエストID・ルート・ドキュメントIDを付ける。
+
+キューには上限があり、書き込みが追いつかない場合は待たずにレコードを捨てて
+件数を数える（``QueueLogging.dropped``）。
+
+gunicornの複数のワーカーが同じファイルに書き込むため、ローテーションはロック
+ファイルで排他し、他のプロセスが切り替えたファイルは書き込む前に開き直す。
+"""
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    import fcntl
+except ImportError:  # Windows（単一プロセスで動かすためロックは不要）
+    fcntl = None
+
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_QUEUE_SIZE = 10000
+
+# LogRecordの標準の属性（これ以外はextraで渡された項目としてJSONに含める）
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """レコードを1行のJSONにする"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+            'location': f'{record.pathname}:{record.lineno}',
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_') and value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+@contextmanager
+def _file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """複数のプロセスから同じファイルに書き込めるRotatingFileHandler
+
+    ローテーションはロックファイルで排他し、ロックを取った後にサイズを確かめ直す。
+    他のプロセスがローテーションした後は、古いファイルに書き続けないよう開き直す。
+    """
+
+    def _reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+            self.stream.close()
+            self.stream = self._open()
+
+    def shouldRollover(self, record):
+        self._reopen_if_rotated()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with _file_lock(self.baseFilename + '.lock'):
+            self._reopen_if_rotated()
+            if self.stream is not None and self.stream.seek(0, os.SEEK_END) < self.maxBytes:
+                return  # 他のプロセスが先にローテーションした
+            super().doRollover()
+
+
+class _ContextQueueHandler(QueueHandler):
+    """リクエストの情報を付けてキューに入れる（キューが一杯なら捨てる）"""
+
+    def __init__(self, pipeline):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        # ファイルへの書き込みは別スレッドなので、ここでリクエストの情報とメッセージを確定させる
+        context = self.pipeline.context() if self.pipeline.context else None
+        record = logging.makeLogRecord(record.__dict__)
+        for key, value in (context or {}).items():
+            if getattr(record, key, None) is None:
+                setattr(record, key, value)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.pipeline.ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.pipeline.dropped += 1
+
+    def handleError(self, record):
+        # ログの失敗でリクエストを失敗させない
+        self.pipeline.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # キューが一杯でも停止の合図は必ず入れる（書き込みスレッドが空きを作る）
+        self.queue.put(self._sentinel)
+
+
+class QueueLogging:
+    """ロガーにキュー経由のJSONログ出力を設定する
+
+    Args:
+        logger: 設定するロガー
+        path: 書き出すファイル
+        max_bytes: ローテーションするサイズ（0で無効）
+        backup_count: 残す世代数
+        queue_size: キューに溜められるレコード数
+        context: レコードに付ける項目の辞書を返す関数（リクエストスレッドで呼ばれる）
+    """
+
+    def __init__(self, logger, path, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT,
+                 queue_size=DEFAULT_QUEUE_SIZE, context=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue_size = queue_size
+        self.context = context
+        self.dropped = 0
+        self.queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._listener = None
+        self._pid = None
+        self.handler = _ContextQueueHandler(self)
+        logger.addHandler(self.handler)
+        atexit.register(self.stop)
+
+    def ensure_started(self):
+        """書き込みスレッドを起動する（fork後の子プロセスでは作り直す）"""
+        if self._listener is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                # 親プロセスのキューに残ったレコードは親が書き出す
+                self.queue = queue.Queue(self.queue_size)
+                self.handler.queue = self.queue
+            file_handler = SharedRotatingFileHandler(
+                self.path, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding='utf-8')
+            file_handler.setFormatter(JsonFormatter())
+            self._listener = _Listener(self.queue, file_handler)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """キューに残ったレコードを書き出して書き込みスレッドを止める"""
+        with self._lock:
+            listener, self._listener = self._listener, None
+            if listener is None or self._pid != os.getpid():
+                return
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+    def flush(self):
+        """キューに入っているレコードを書き出すまで待つ"""
+        self.stop()
+        self.ensure_started()
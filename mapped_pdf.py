@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""PDFをメモリマップして開く
+
+``fitz.open(path)`` はMuPDFが必要な部分だけをファイルから読み込むため、
+ファイル全体をメモリに載せることはない。一方、``fitz.open(stream=bytes)`` は
+ファイル全体のコピーを各プロセスの匿名メモリに持つことになる。
+
+``open_pdf(path, 'mmap')`` はファイルを読み取り専用でメモリマップし、その
+memoryviewをMuPDFに渡す。コピーは作られず、読み込んだページはページキャッシュの
+ページそのものなので、同じPDFを開いている複数のワーカープロセスの間で共有される
+（RSSには数えられるが、PSSでは各プロセスに按分される）。
+
+注意:
+    マップしたファイルを別の内容で上書き（切り詰め）すると、マップ済みの
+    ドキュメントの読み込みでSIGBUSになる。ファイルを置き換える場合は
+    一時ファイルに書き込んでから os.replace で差し替えること。
+"""
+import mmap
+import os
+
+import fitz  # PyMuPDF
+
+OPEN_MODES = ('path', 'mmap')
+
+
+def open_mapped(path):
+    """ファイルをメモリマップしてドキュメントを開く（空のファイルなどは通常どおり開く）"""
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return fitz.open(path)
+    # memoryviewはドキュメントが保持し、ドキュメントが破棄されるとマップも解除される
+    return fitz.open(path, stream=memoryview(mapped), filetype='pdf')
+
+
+def open_pdf(path, mode='path'):
+    """指定した方法（path / mmap）でドキュメントを開く"""
+    if mode == 'mmap':
+        return open_mapped(path)
+    if mode == 'path':
+        return fitz.open(path)
+    raise ValueError(f'未対応の開き方です: {mode}')
+
+
+def memory_usage():
+    """プロセスのメモリ使用量（MB）。Linux以外ではNone
+
+    Returns:
+        dict: rss（常駐）、pss（共有ページを按分）、anonymous（匿名メモリ）、
+              shared（他のプロセスと共有しているページ）
+    """
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Anonymous': 'anonymous',
+              'Shared_Clean': 'shared', 'Shared_Dirty': 'shared'}
+    usage = {}
+    try:
+        with open(f'/proc/{os.getpid()}/smaps_rollup', encoding='ascii') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in fields:
+                    key = fields[name]
+                    usage[key] = usage.get(key, 0) + int(value.split()[0]) / 1024
+    except (FileNotFoundError, PermissionError):
+        return None
+    return {key: round(value, 1) for key, value in usage.items()}
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""Prometheusテキスト形式で出力できる軽量なメトリクス集計
+
+値はプロセスごとに集計する。gunicornの複数ワーカーで動かす場合はレジストリにディレクトリを
+指定すると（マルチプロセスモード）、各ワーカーが一定間隔で自分の値を ``<ディレクトリ>/<pid>.json`` に
+書き出し、/metrics を受けたワーカーがすべてのファイルを合算して返す。
+
+- カウンタとヒストグラムは全ワーカーの合計。終了したワーカーの値は ``archive.json`` に
+  まとめて残す（ワーカーを入れ替えても値が減らない）
+- ゲージは動いているワーカーの合計（終了したワーカーの値は捨てる）
+
+fork後の子プロセス（gunicornのワーカー）では、親から引き継いだ値を捨てて書き出しを始める。
+"""
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows（マルチプロセスモードは使わない）
+    fcntl = None
+
+# レイテンシ用のデフォルトバケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# ファイルサイズ用のバケット（バイト）
+SIZE_BUCKETS = tuple(2 ** n * 1024 for n in range(0, 20, 2))  # 1KB〜256MB
+
+# 件数用のバケット
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+# マルチプロセスモードで各プロセスが値を書き出す間隔（秒）
+SYNC_INTERVAL = 2.0
+
+ARCHIVE_NAME = 'archive.json'
+LOCK_NAME = 'lock'
+
+
+def _escape(value):
+    """ラベル値をPrometheusの書式でエスケープする"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.extend(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """ラベル付きメトリクスの基底クラス"""
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name}: ラベルが一致しません: {sorted(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        """現在の値（ラベルの値のタプル -> 値）のコピー"""
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    def reset(self):
+        # fork後の子プロセスで呼ぶ（親のスレッドが保持していたロックも作り直す）
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def merge(a, b):
+        """別のプロセスの値を合算する"""
+        return a + b
+
+    def render(self, values=None):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ]
+        values = self.snapshot() if values is None else values
+        lines.extend(self._render_samples(sorted(values.items())))
+        return lines
+
+    def _render_samples(self, items):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+            for key, value in items
+        ]
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """増減する値（処理中のリクエスト数など）"""
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """累積バケット付きヒストグラム"""
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+
+    @staticmethod
+    def _copy(value):
+        return {'counts': list(value['counts']), 'sum': value['sum']}
+
+    @staticmethod
+    def merge(a, b):
+        return {'counts': [x + y for x, y in zip(a['counts'], b['counts'])], 'sum': a['sum'] + b['sum']}
+
+    @contextmanager
+    def time(self, **labels):
+        """withブロックの経過時間（秒）を記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(state["sum"])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class Registry:
+    """メトリクスの登録とテキスト形式への変換
+
+    Args:
+        directory: マルチプロセスモードで値を書き出すディレクトリ（Noneの場合はプロセスごとの値）
+        sync_interval: マルチプロセスモードで値を書き出す間隔（秒）
+    """
+
+    def __init__(self, directory=None, sync_interval=SYNC_INTERVAL):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self.directory = None
+        self.sync_interval = sync_interval
+        self._writer = None
+        self._stop = threading.Event()
+        if directory:
+            self.set_directory(directory)
+
+    def set_directory(self, directory):
+        """マルチプロセスモードにする（ワーカーをforkする前に呼ぶ）"""
+        if self.directory is not None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @staticmethod
+    def clear_directory(directory):
+        """前回の起動で書き出された値を削除する（サーバーの起動時に呼ぶ）"""
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(path)
+
+    def _after_fork(self):
+        # 親から引き継いだ値を捨て、このプロセスの値の書き出しを始める
+        self._lock = threading.Lock()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._sync_loop, name='metrics-sync', daemon=True)
+        self._writer.start()
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def flush(self, live=True):
+        """このプロセスの値をディレクトリに書き出す
+
+        Args:
+            live: Falseの場合はプロセスの終了として書き出す（ゲージは合算しなくなる）
+        """
+        if self.directory is None:
+            return
+        with self._lock:
+            metrics = list(self._metrics.values())
+        _write_json(os.path.join(self.directory, f'{os.getpid()}.json'), {
+            'pid': os.getpid(),
+            'live': live,
+            'metrics': {m.name: [[list(key), value] for key, value in m.snapshot().items()] for m in metrics},
+        })
+
+    def stop(self):
+        """値の書き出しを止めて、終了として書き出す（ワーカーの終了時に呼ぶ）"""
+        self._stop.set()
+        self.flush(live=False)
+
+    def _merged_values(self, metrics):
+        """ディレクトリの全プロセスの値を合算する（マルチプロセスモード）"""
+        self.flush()
+        by_name = {m.name: m for m in metrics}
+        totals = {m.name: {} for m in metrics}
+
+        def add(name, key, value, include_gauges):
+            metric = by_name.get(name)
+            if metric is None or (isinstance(metric, Gauge) and not include_gauges):
+                return
+            key = tuple(key)
+            values = totals[name]
+            values[key] = metric.merge(values[key], value) if key in values else value
+
+        lock_path = os.path.join(self.directory, LOCK_NAME)
+        with open(lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.directory, ARCHIVE_NAME)
+            archive = _read_json(archive_path) or {'metrics': {}}
+            exited = []
+            for path in glob.glob(os.path.join(self.directory, '[0-9]*.json')):
+                data = _read_json(path)
+                if data is None:
+                    continue
+                if not data['live'] or not _process_alive(data['pid']):
+                    exited.append((path, data))
+                    continue
+                for name, samples in data['metrics'].items():
+                    for key, value in samples:
+                        add(name, key, value, include_gauges=True)
+            if exited:
+                # 終了したプロセスのカウンタとヒストグラムをまとめて、ファイルを減らす
+                merged = {m.name: {} for m in metrics if not isinstance(m, Gauge)}
+                for name, samples in archive['metrics'].items():
+                    if name in merged:
+                        merged[name].update((tuple(key), value) for key, value in samples)
+                for _, data in exited:
+                    for name, samples in data['metrics'].items():
+                        if name not in merged:
+                            continue
+                        for key, value in samples:
+                            key = tuple(key)
+                            values = merged[name]
+                            values[key] = by_name[name].merge(values[key], value) if key in values else value
+                archive = {'metrics': {name: [[list(key), value] for key, value in values.items()]
+                                       for name, values in merged.items()}}
+                _write_json(archive_path, archive)
+                for path, _ in exited:
+                    os.remove(path)
+            for name, samples in archive['metrics'].items():
+                for key, value in samples:
+                    add(name, key, value, include_gauges=False)
+        return totals
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'メトリクス名が重複しています: {metric.name}')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """全メトリクスをPrometheusテキスト形式（0.0.4）で返す"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        totals = self._merged_values(metrics) if self.directory is not None else {}
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(totals.get(metric.name)))
+        return '\n'.join(lines) + '\n'
+
+
+# アプリケーション全体で共有するレジストリ
+REGISTRY = Registry()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""注釈付きPDFの保存オプション（出力プロファイル）
+
+save() を既定のオプションで呼ぶと、参照されないオブジェクトや圧縮されていない
+ストリームがそのまま残り、元のファイルより大きくなることが多い。
+プロファイルごとに次のオプションをまとめている。
+
+- garbage: 不要なオブジェクトの削除（3以上で重複の統合、4でストリームの重複も統合）
+- deflate: ストリームの圧縮
+- use_objstms: オブジェクトストリームへの格納
+- images: 指定した解像度を超える画像の縮小（dpi_threshold / dpi_target / quality）
+
+garbage や clean を指定した保存はメモリ上のドキュメントを書き換える。in_place=False（既定）の
+場合はドキュメントをシリアライズしたコピーに対して保存するが、コピーと解析し直しの分だけ
+時間とメモリがかかる。サーバーは保存ごとにプール外のハンドル
+（``DocumentPool.checkout(path, private=True)``）を開き、in_place=True で保存する。
+
+出力先にはパスのほか、書き込み可能なファイルオブジェクト（io.BytesIOなど）も渡せる。
+
+CLI:
+    python output_profiles.py drawing.pdf -o drawing_small.pdf --profile compact
+"""
+import argparse
+import os
+import sys
+import time
+
+import fitz  # PyMuPDF
+
+PROFILES = {
+    # 従来どおり（オプションなし）
+    'default': {},
+    # 劣化のない最適化
+    'balanced': {
+        'garbage': 3,
+        'deflate': True,
+        'deflate_images': True,
+        'deflate_fonts': True,
+    },
+    # 最小サイズ（150dpiを超える画像は縮小する）
+    'compact': {
+        'garbage': 4,
+        'clean': True,
+        'deflate': True,
+        'deflate_images': True,
+        'deflate_fonts': True,
+        'use_objstms': 1,
+        'images': {'dpi_threshold': 200, 'dpi_target': 150, 'quality': 80},
+    },
+}
+
+DEFAULT_PROFILE = 'balanced'
+
+
+def _input_size(document):
+    if document.name and os.path.isfile(document.name):
+        return os.path.getsize(document.name)
+    return None
+
+
+def save_with_profile(document, output_path, profile=DEFAULT_PROFILE, in_place=False):
+    """プロファイルのオプションでドキュメントを保存する
+
+    Args:
+        document: 保存するドキュメント
+        output_path: 出力先のパス、またはファイルオブジェクト
+        profile: プロファイル名（PROFILESのキー）
+        in_place: Trueの場合は渡したドキュメントに対して直接画像の縮小や保存を行う
+
+    Returns:
+        dict: プロファイル名、保存前（元のファイル）と保存後のサイズ、所要時間
+    """
+    if profile not in PROFILES:
+        raise ValueError(f'未対応の出力プロファイルです: {profile}')
+    options = dict(PROFILES[profile])
+    images = options.pop('images', None)
+    input_bytes = _input_size(document)
+
+    to_file = hasattr(output_path, 'write')
+    output_start = output_path.tell() if to_file else 0
+    start = time.perf_counter()
+    target = document
+    if options and not in_place:
+        # ドキュメントを書き換える保存になるため、コピーに対して行う
+        target = fitz.open('pdf', document.tobytes())
+    try:
+        if images:
+            target.rewrite_images(**images)
+        target.save(output_path, **options)
+    finally:
+        if target is not document:
+            target.close()
+    seconds = time.perf_counter() - start
+
+    output_bytes = output_path.tell() - output_start if to_file else os.path.getsize(output_path)
+    return {
+        'profile': profile,
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'ratio': round(output_bytes / input_bytes, 4) if input_bytes else None,
+        'seconds': round(seconds, 4),
+    }
+
+
+def format_report(report):
+    """保存結果を1行の文字列にする"""
+    if report['input_bytes']:
+        return (f"{report['profile']}: {report['input_bytes']:,} -> {report['output_bytes']:,} バイト"
+                f" ({report['ratio'] * 100:.1f}%), {report['seconds']:.2f}秒")
+    return f"{report['profile']}: {report['output_bytes']:,} バイト, {report['seconds']:.2f}秒"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PDFを出力プロファイルで保存し直してサイズを比較する')
+    parser.add_argument('pdf', help='入力PDF')
+    parser.add_argument('-o', '--output', help='出力PDF（省略時は <入力名>_<プロファイル>.pdf）')
+    parser.add_argument('--profile', choices=sorted(PROFILES), action='append',
+                        help='出力プロファイル（複数指定で比較、省略時はすべて）')
+    args = parser.parse_args(argv)
+
+    profiles = args.profile or list(PROFILES)
+    if args.output and len(profiles) > 1:
+        parser.error('複数のプロファイルを比較する場合は --output を指定できません')
+    with fitz.open(args.pdf) as doc:
+        for profile in profiles:
+            output = args.output or f'{os.path.splitext(args.pdf)[0]}_{profile}.pdf'
+            print(format_report(save_with_profile(doc, output, profile)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
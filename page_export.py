@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""PDFの全ページ（または指定範囲）を画像にしてZIPで書き出す
+
+レンダリングはレンダリングサービスのワーカープロセスに分散し、
+ページが完成するたびにZIPのエントリとして書き出すため、
+全ページの画像をメモリに溜め込まない。
+
+CLI:
+    python page_export.py drawing.pdf -o drawing_pages.zip --dpi 150 --format png --pages 1-20
+"""
+import argparse
+import os
+import sys
+import zipfile
+
+import fitz  # PyMuPDF
+
+from render_service import RenderService, FORMATS
+
+
+def parse_page_range(spec, page_count):
+    """ "1-3,7,10-" のようなページ指定を0始まりのページ番号のリストにする
+
+    空文字列やNoneの場合は全ページ。範囲外のページはValueError。
+    """
+    if not spec:
+        return list(range(page_count))
+    pages = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            start = int(start) if start else 1
+            end = int(end) if end else page_count
+        else:
+            start = end = int(part)
+        if start < 1 or end > page_count or start > end:
+            raise ValueError(f'ページ指定が範囲外です: {part}')
+        pages.extend(range(start - 1, end))
+    return pages
+
+
+class _ChunkBuffer:
+    """ZipFileの書き込み先（tellやseekを持たないのでストリーミング形式で書かれる）"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip_chunks(service, pdf_path, pages, dpi=96, fmt='png', name_prefix=None):
+    """ページ画像を1枚ずつZIPに追加し、書き出されたバイト列を順に返すジェネレータ"""
+    prefix = name_prefix or os.path.splitext(os.path.basename(pdf_path))[0]
+    buffer = _ChunkBuffer()
+    # 画像は圧縮済みなので無圧縮で格納する
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for page_number, data in service.render_pages(pdf_path, pages, dpi=dpi, fmt=fmt):
+            archive.writestr(f'{prefix}_p{page_number + 1:04d}.{fmt}', data)
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+    chunk = buffer.drain()
+    if chunk:
+        yield chunk
+
+
+def export_pages(pdf_path, output, pages=None, dpi=96, fmt='png', workers=None):
+    """PDFのページ画像をZIPファイルに書き出す
+
+    Args:
+        pdf_path: 入力PDFのパス
+        output: 出力先のパスまたはバイナリのファイルオブジェクト
+        pages: ページ指定（"1-3,7"形式、Noneの場合は全ページ）
+        dpi: 解像度
+        fmt: 'png' または 'jpg'
+        workers: ワーカープロセス数（Noneの場合はCPUコア数）
+
+    Returns:
+        int: 書き出したページ数
+    """
+    with fitz.open(pdf_path) as doc:
+        page_numbers = parse_page_range(pages, len(doc))
+    service = RenderService(workers=workers)
+    try:
+        if isinstance(output, (str, os.PathLike)):
+            with open(output, 'wb') as f:
+                for chunk in iter_zip_chunks(service, pdf_path, page_numbers, dpi, fmt):
+                    f.write(chunk)
+        else:
+            for chunk in iter_zip_chunks(service, pdf_path, page_numbers, dpi, fmt):
+                output.write(chunk)
+    finally:
+        service.shutdown()
+    return len(page_numbers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PDFのページを画像にしてZIPで書き出す')
+    parser.add_argument('pdf', help='入力PDF')
+    parser.add_argument('-o', '--output', help='出力ZIP（省略時は <入力名>_pages.zip）')
+    parser.add_argument('--pages', help='ページ指定（例: 1-10,15）。省略時は全ページ')
+    parser.add_argument('--dpi', type=int, default=150, help='解像度')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='png', help='画像形式')
+    parser.add_argument('--workers', type=int, help='ワーカープロセス数（省略時はCPUコア数）')
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.splitext(args.pdf)[0] + '_pages.zip'
+    try:
+        count = export_pages(args.pdf, output, args.pages, args.dpi, args.format, args.workers)
+    except ValueError as e:
+        print(f'エラー: {e}', file=sys.stderr)
+        return 1
+    print(f'{count}ページを書き出しました: {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""リクエスト単位のオンデマンドプロファイラ
+
+ヘッダーまたはサンプリングで選ばれたリクエストだけをcProfileで計測し、
+pstatsとflamegraph用のcollapsed stacksをプロファイルIDごとに保存する。
+
+ヘッダーによる計測は管理用トークン（``X-Admin-Token``）が正しい場合だけ受け付ける。
+プロファイルIDはリクエストIDにサーバーで採番した接尾辞を付けたもので、
+クライアントが同じリクエストIDを送っても以前の結果を上書きしない。
+"""
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+# リクエストIDとして受け付ける文字列（ファイル名にそのまま使う）
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# プロファイルID（リクエストID + '-' + 8桁の16進数）
+PROFILE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}-[0-9a-f]{8}$')
+
+ENVIRON_REQUEST_ID = 'pdf_annotator.request_id'
+
+
+def ensure_request_id(environ):
+    """WSGI環境からリクエストIDを取得し、なければ採番して保存する"""
+    request_id = environ.get(ENVIRON_REQUEST_ID)
+    if request_id:
+        return request_id
+    request_id = environ.get('HTTP_X_REQUEST_ID', '')
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+    environ[ENVIRON_REQUEST_ID] = request_id
+    return request_id
+
+
+class StackSampler(threading.Thread):
+    """対象スレッドのスタックを一定間隔でサンプリングしてcollapsed形式で集計する"""
+
+    def __init__(self, target_thread_id, interval=0.001):
+        super().__init__(daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        """flamegraph.pl / speedscope で読めるcollapsed stacks形式の文字列"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def new_profile_id(request_id):
+    """リクエストIDから保存用のプロファイルIDを作る（同じリクエストIDでも重ならない）"""
+    return f'{request_id}-{uuid.uuid4().hex[:8]}'
+
+
+class ProfileStore:
+    """プロファイル結果をプロファイルIDごとにファイルへ保存する"""
+
+    FORMATS = {
+        'pstats': 'application/octet-stream',
+        'collapsed': 'text/plain; charset=utf-8',
+        'txt': 'text/plain; charset=utf-8',
+    }
+
+    def __init__(self, folder, max_profiles=100):
+        self.folder = folder
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+
+    def save(self, profile_id, profile, sampler, meta):
+        os.makedirs(self.folder, exist_ok=True)
+        base = os.path.join(self.folder, profile_id)
+        profile.dump_stats(base + '.pstats')
+        with open(base + '.collapsed', 'w', encoding='utf-8') as f:
+            f.write(sampler.collapsed())
+        with open(base + '.json', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        self._prune()
+
+    def list(self):
+        """保存済みプロファイルのメタ情報を新しい順に返す"""
+        if not os.path.isdir(self.folder):
+            return []
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, name), encoding='utf-8') as f:
+                    entries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(entries, key=lambda e: e.get('timestamp', 0), reverse=True)
+
+    def path(self, profile_id, fmt):
+        """保存済みファイルのパスを返す（存在しなければNone）"""
+        if fmt not in self.FORMATS or not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        ext = 'pstats' if fmt == 'txt' else fmt
+        path = os.path.join(self.folder, f'{profile_id}.{ext}')
+        return path if os.path.isfile(path) else None
+
+    def render_text(self, profile_id, limit=50):
+        """pstatsを累積時間順のテキストレポートにする"""
+        path = self.path(profile_id, 'pstats')
+        if path is None:
+            return None
+        out = io.StringIO()
+        stats = pstats.Stats(path, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def _prune(self):
+        # 古いプロファイルから削除して上限数を保つ
+        with self._lock:
+            entries = self.list()
+            for entry in entries[self.max_profiles:]:
+                for ext in ('pstats', 'collapsed', 'json'):
+                    try:
+                        os.remove(os.path.join(self.folder, f"{entry['profile_id']}.{ext}"))
+                    except OSError:
+                        pass
+
+
+class ProfilerMiddleware:
+    """設定に応じてリクエストをプロファイルするWSGIミドルウェア
+
+    設定はリクエストごとに ``config`` （Flaskのapp.config）から読むため、
+    実行中に有効・無効を切り替えられる。
+    """
+
+    def __init__(self, wsgi_app, config, logger=None):
+        self.wsgi_app = wsgi_app
+        self.config = config
+        self.logger = logger
+        # cProfileは同時に1つしか有効にできないため排他する
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        return ProfileStore(self.config['PROFILE_FOLDER'], self.config['PROFILE_MAX_FILES'])
+
+    def should_profile(self, environ):
+        if not self.config.get('PROFILING_ENABLED'):
+            return False
+        header = 'HTTP_' + self.config['PROFILE_HEADER'].upper().replace('-', '_')
+        if environ.get(header) and self.is_admin(environ):
+            return True
+        rate = self.config.get('PROFILE_SAMPLE_RATE', 0.0)
+        return rate > 0 and random.random() < rate
+
+    def is_admin(self, environ):
+        # 誰でも計測を強制できないよう、ヘッダーによる計測は管理用トークンを要求する
+        token = self.config.get('ADMIN_TOKEN')
+        supplied = environ.get('HTTP_X_ADMIN_TOKEN', '')
+        return bool(token) and hmac.compare_digest(supplied.encode(), token.encode())
+
+    def __call__(self, environ, start_response):
+        request_id = ensure_request_id(environ)
+        if not self.should_profile(environ) or not self._lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+
+        status_holder = {}
+        profile_id = new_profile_id(request_id)
+
+        def capture_status(status, headers, exc_info=None):
+            status_holder['status'] = status
+            headers = list(headers) + [('X-Profile-ID', profile_id)]
+            return start_response(status, headers, exc_info)
+
+        profile = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), self.config['PROFILE_SAMPLE_INTERVAL'])
+        start = time.perf_counter()
+        try:
+            sampler.start()
+            profile.enable()
+            try:
+                body = self.wsgi_app(environ, capture_status)
+            finally:
+                profile.disable()
+                sampler.stop()
+            duration = time.perf_counter() - start
+            if duration >= self.config.get('PROFILE_MIN_DURATION', 0.0):
+                self._save(profile_id, request_id, environ, status_holder, duration, profile, sampler)
+            return body
+        finally:
+            self._lock.release()
+
+    def _save(self, profile_id, request_id, environ, status_holder, duration, profile, sampler):
+        meta = {
+            'profile_id': profile_id,
+            'request_id': request_id,
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'status': status_holder.get('status'),
+            'duration': duration,
+            'samples': sum(sampler.stacks.values()),
+            'timestamp': time.time(),
+        }
+        try:
+            self.store.save(profile_id, profile, sampler, meta)
+            if self.logger:
+                self.logger.info(f"プロファイル保存: {profile_id} {meta['path']} {duration:.3f}s")
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f'プロファイル保存エラー: {str(e)}')
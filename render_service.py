@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""ページのラスタライズを別プロセスで行うレンダリングサービス
+
+get_pixmap はGILを保持したまま処理するため、Flaskのスレッドで実行すると
+リクエストスレッドを占有し、複数コアにも分散されない。このモジュールは
+ワーカープロセスのプールを持ち、各ワーカーはPyMuPDFを初期化済みの状態で
+自分用のドキュメントキャッシュを保持する。
+
+- 待ち行列の上限を超えたリクエストは RenderBusy で即座に断る（バックプレッシャー）
+- 結果を待つ時間の上限を超えた場合は RenderTimeout を送出する
+- workers=0 の場合は呼び出し元のスレッドで直接レンダリングする（テスト・Windows向け）。
+  このときドキュメントのキャッシュは複数のリクエストスレッドで共有されるため、
+  使用中は排他する（fitz.Documentはスレッドセーフではない）
+- タイムアウトしても実行中のレンダリングは止められないため、待ち行列の枠は
+  実際に終わったときに返す
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import fitz  # PyMuPDF
+
+from mapped_pdf import open_pdf
+
+# 受け付ける出力形式とMIMEタイプ
+FORMATS = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+}
+
+MIN_DPI = 18
+MAX_DPI = 600
+
+
+class RenderError(Exception):
+    """レンダリングに失敗した"""
+
+
+class RenderBusy(RenderError):
+    """待ち行列が一杯で受け付けられない"""
+
+
+class RenderTimeout(RenderError):
+    """制限時間内にレンダリングが終わらなかった"""
+
+
+class PageNotFound(RenderError):
+    """指定されたページが存在しない"""
+
+
+# --- ワーカープロセス側 ---
+
+_worker_documents = OrderedDict()  # (パス, 更新日時, サイズ) -> fitz.Document
+_worker_cache_size = 4
+_worker_open_mode = 'path'
+# キャッシュとドキュメントの排他（ワーカープロセスでは競合しない。workers=0では呼び出し元のスレッド間で使う）
+_worker_lock = threading.RLock()
+
+
+def _init_worker(cache_size, open_mode='path'):
+    """ワーカープロセスの初期化（PyMuPDFを読み込み、キャッシュの上限とPDFの開き方を設定する）"""
+    global _worker_cache_size, _worker_open_mode
+    _worker_cache_size = cache_size
+    _worker_open_mode = open_mode
+    doc = fitz.open()
+    doc.new_page().get_pixmap(matrix=fitz.Matrix(0.1, 0.1))
+    doc.close()
+
+
+def _worker_document(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    doc = _worker_documents.get(key)
+    if doc is not None:
+        _worker_documents.move_to_end(key)
+        return doc
+    # 同じパスの古いハンドルと、上限を超えた分を閉じる
+    for old_key in [k for k in _worker_documents if k[0] == path]:
+        _worker_documents.pop(old_key).close()
+    doc = open_pdf(path, _worker_open_mode)
+    _worker_documents[key] = doc
+    while len(_worker_documents) > _worker_cache_size:
+        _worker_documents.popitem(last=False)[1].close()
+    return doc
+
+
+@contextmanager
+def worker_document(path):
+    """キャッシュのドキュメントを使い終わるまで排他して借りる"""
+    with _worker_lock:
+        yield _worker_document(path)
+
+
+def render_page(path, page_number, dpi=96, fmt='png', jpg_quality=85):
+    """1ページをレンダリングして画像のバイト列を返す（page_numberは0始まり）"""
+    with worker_document(path) as doc:
+        if page_number < 0 or page_number >= len(doc):
+            raise PageNotFound(f'ページが存在しません: {page_number + 1}')
+        pix = doc[page_number].get_pixmap(dpi=dpi)
+    if fmt == 'jpg':
+        return pix.tobytes('jpg', jpg_quality=jpg_quality)
+    return pix.tobytes('png')
+
+
+def page_count(path):
+    """ページ数を返す"""
+    with worker_document(path) as doc:
+        return len(doc)
+
+
+# --- 呼び出し側 ---
+
+class RenderService:
+    """レンダリング用のワーカープロセスプール
+
+    Args:
+        workers: ワーカープロセス数（0の場合は呼び出し元のスレッドで実行）
+        max_pending: 実行中と待機中を合わせたリクエスト数の上限
+        timeout: 1リクエストの結果を待つ秒数
+        cache_size: ワーカーごとに開いたままにするドキュメント数
+        open_mode: ワーカーでのPDFの開き方（'path' / 'mmap'、mapped_pdf.open_pdf を参照）
+        on_queue_change: 実行中と待機中のリクエスト数を受け取るコールバック
+    """
+
+    def __init__(self, workers=None, max_pending=None, timeout=30.0, cache_size=4, on_queue_change=None,
+                 open_mode='path'):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending or max(self.workers, 1) * 4
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.open_mode = open_mode
+        self.on_queue_change = on_queue_change
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = None
+        self._pid = None
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _get_executor(self):
+        with self._lock:
+            # fork後の子プロセスでは親のプールを使わずに作り直す
+            if self._executor is None or self._pid != os.getpid():
+                # スレッドを持つプロセスからforkしないようにspawnで起動する
+                context = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=(self.cache_size, self.open_mode)
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _change_pending(self, delta):
+        with self._lock:
+            self._pending += delta
+            pending = self._pending
+        if self.on_queue_change:
+            self.on_queue_change(pending)
+
+    def _acquire_slot(self):
+        if not self._slots.acquire(blocking=False):
+            return False
+        self._change_pending(1)
+        return True
+
+    def _release_slot(self, future=None):
+        self._change_pending(-1)
+        self._slots.release()
+
+    def _submit_to_executor(self, func, args):
+        """枠を確保済みの状態で投入する（枠は実行が終わったとき、または取り消されたときに返す）"""
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._release_slot()
+            raise
+        future.add_done_callback(self._release_slot)
+        return future
+
+    def submit(self, func, *args, timeout=None):
+        """ワーカーで関数を実行して結果を返す"""
+        if not self._acquire_slot():
+            raise RenderBusy('レンダリングの待ち行列が一杯です')
+        if self.workers == 0:
+            try:
+                return func(*args)
+            finally:
+                self._release_slot()
+        future = self._submit_to_executor(func, args)
+        try:
+            return future.result(timeout=timeout or self.timeout)
+        except FutureTimeoutError:
+            # 実行中のものは止められないので、枠は終わるまで返さない
+            future.cancel()
+            raise RenderTimeout('レンダリングがタイムアウトしました')
+
+    def render(self, path, page_number, dpi=96, fmt='png', timeout=None):
+        """ページをレンダリングする（page_numberは0始まり）"""
+        if fmt not in FORMATS:
+            raise ValueError(f'未対応の形式です: {fmt}')
+        dpi = min(max(int(dpi), MIN_DPI), MAX_DPI)
+        return self.submit(render_page, os.path.abspath(path), page_number, dpi, fmt, timeout=timeout)
+
+    def render_pages(self, path, page_numbers, dpi=96, fmt='png', timeout=None):
+        """複数ページを並列にレンダリングし、ページ順に (page_number, bytes) を返すジェネレータ"""
+        if fmt not in FORMATS:
+            raise ValueError(f'未対応の形式です: {fmt}')
+        path = os.path.abspath(path)
+        dpi = min(max(int(dpi), MIN_DPI), MAX_DPI)
+        page_numbers = list(page_numbers)
+        results = self.map(render_page, ((path, page_number, dpi, fmt) for page_number in page_numbers), timeout)
+        yield from zip(page_numbers, results)
+
+    def map(self, func, args_iter, timeout=None):
+        """引数の組ごとにワーカーで関数を並列に実行し、結果を投入した順に返すジェネレータ
+
+        ワーカー数の2倍までを同時に投入する。
+        待ち行列の空きがない場合は、投入済みの結果を受け取ってから次を投入する。
+        """
+        if self.workers == 0:
+            for args in args_iter:
+                yield self.submit(func, *args)
+            return
+
+        window = deque()
+        pending_args = iter(args_iter)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(window) < self.workers * 2:
+                    if not self._acquire_slot():
+                        if not window:
+                            raise RenderBusy('レンダリングの待ち行列が一杯です')
+                        break
+                    args = next(pending_args, None)
+                    if args is None:
+                        self._release_slot()
+                        exhausted = True
+                        break
+                    window.append(self._submit_to_executor(func, args))
+                if not window:
+                    return
+                future = window.popleft()
+                try:
+                    data = future.result(timeout=timeout or self.timeout)
+                except FutureTimeoutError:
+                    future.cancel()
+                    raise RenderTimeout('レンダリングがタイムアウトしました')
+                yield data
+        finally:
+            # 途中で中断された場合は投入済みの分を取り消す（実行中の分の枠は終わったときに返る）
+            for future in window:
+                future.cancel()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def render_workers_per_process(web_workers):
+    """Webのワーカープロセスごとのレンダリングワーカー数の既定値
+
+    プールはWebのワーカープロセスごとに作られるため、CPUコア数をWebのワーカー数で分ける
+    （少なくとも1）。
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, web_workers))
+
+
+def create_render_service(config, on_queue_change=None):
+    """Flaskの設定からレンダリングサービスを作成する"""
+    service = RenderService(
+        workers=config['RENDER_WORKERS'],
+        max_pending=config['RENDER_MAX_PENDING'],
+        timeout=config['RENDER_TIMEOUT'],
+        cache_size=config['RENDER_CACHE_SIZE'],
+        open_mode=config.get('PDF_OPEN_MODE', 'path'),
+        on_queue_change=on_queue_change
+    )
+    atexit.register(service.shutdown, False)
+    return service
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""同じドキュメントへの保存の直列化とまとめ実行
+
+同じPDFへの保存はキーごとに1つずつ実行する。実行中に届いた保存は
+「次の保存」として1つにまとめられ、その間に届いたものは内容を最新の
+ものに差し替えて同じ保存を待つ。前の保存が終わると最新の内容で1回だけ
+実行し、まとめられたすべてのリクエストに同じ結果を返す。
+
+    実行中: A    次の保存: B → C → D（内容はDに差し替え）
+    → Aの後にDだけを実行し、B・C・DにはDの結果を返す
+
+同時に走る保存は常にキーごとに「実行中1つ + 待機中1つ」までになり、
+自動保存が重なってもPDF全体の書き出しは最新の内容の分しか行わない。
+
+状態はプロセス内だけに持つ（gunicornのワーカーをまたいだ保存はまとめない）。
+"""
+import threading
+from concurrent.futures import Future
+
+
+class _Batch:
+    """まとめて1回で実行する保存"""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.requests = 1
+        self.future = Future()
+
+
+class _Slot:
+    def __init__(self):
+        self.running = False
+        self.pending = None  # 次に実行する_Batch
+
+
+class SaveCoalescer:
+    """キーごとに保存を直列化し、待っている間に届いた保存をまとめる
+
+    Args:
+        on_coalesce: 保存がまとめられたとき（実行されずに済んだとき）に呼ばれる
+    """
+
+    def __init__(self, on_coalesce=None):
+        self.on_coalesce = on_coalesce
+        self._condition = threading.Condition()
+        self._slots = {}
+
+    def submit(self, key, payload, func):
+        """func(payload) を実行して結果を返す
+
+        同じキーの保存が実行中の場合はそれが終わるまで待ち、その間に届いた
+        保存とまとめて最新のpayloadで1回だけ実行する。
+
+        Returns:
+            tuple: (結果, まとめて実行したリクエスト数)
+        """
+        with self._condition:
+            slot = self._slots.setdefault(key, _Slot())
+            batch = slot.pending
+            if batch is not None:
+                # 待機中の保存に相乗りし、内容を最新のものに差し替える
+                batch.payload = payload
+                batch.requests += 1
+                runner = False
+            else:
+                batch = slot.pending = _Batch(payload)
+                runner = True
+
+            if runner:
+                self._condition.wait_for(lambda: not slot.running)
+                slot.pending = None
+                slot.running = True
+
+        if not runner:
+            if self.on_coalesce:
+                self.on_coalesce()
+            return batch.future.result(), batch.requests
+
+        try:
+            batch.future.set_result(func(batch.payload))
+        except BaseException as e:
+            batch.future.set_exception(e)
+        finally:
+            with self._condition:
+                slot.running = False
+                if slot.pending is None:
+                    self._slots.pop(key, None)
+                self._condition.notify_all()
+        return batch.future.result(), batch.requests
+
+    def pending(self, key):
+        """キーの待機中の保存にまとめられているリクエスト数"""
+        with self._condition:
+            slot = self._slots.get(key)
+            return slot.pending.requests if slot and slot.pending else 0
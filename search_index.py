@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""PDFの全文検索用の転置索引
+
+page.get_text("words") の単語と位置から、語 -> 単語IDの転置索引を作り、
+アップロードしたPDFの隣に ``<ファイル名>.index.json`` として保存する。
+
+日本語などの分かち書きされない文字列は、1文字と2文字の部分文字列も索引に
+加えて部分一致で検索できるようにしている。
+"""
+import bisect
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+import fitz  # PyMuPDF
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index.json'
+
+# 前方一致を行う検索語の最小文字数
+MIN_PREFIX_LENGTH = 3
+
+_CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]')
+_STRIP = '.,;:!?()[]{}<>"\'`“”‘’「」『』（）【】、。・：；！？'
+
+
+def index_path_for(pdf_path):
+    return pdf_path + INDEX_SUFFIX
+
+
+def normalize(text):
+    """検索用に正規化する（NFKC、小文字化、前後の記号の除去）"""
+    return unicodedata.normalize('NFKC', text).lower().strip(_STRIP + ' ')
+
+
+def _cjk_grams(text):
+    """日本語などを含む語の1文字・2文字の部分文字列"""
+    grams = {c for c in text if _CJK.match(c)}
+    grams.update(text[i:i + 2] for i in range(len(text) - 1) if _CJK.search(text[i:i + 2]))
+    return grams
+
+
+def build_index(pdf_path):
+    """PDFから転置索引を作成する"""
+    words = []
+    terms = defaultdict(list)
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+        for page_number in range(page_count):
+            for x0, y0, x1, y1, text, *_ in doc[page_number].get_text('words'):
+                term = normalize(text)
+                if not term:
+                    continue
+                word_id = len(words)
+                words.append([page_number, round(x0, 2), round(y0, 2), round(x1, 2), round(y1, 2), term])
+                keys = {term}
+                if _CJK.search(term):
+                    keys.update(_cjk_grams(term))
+                for key in keys:
+                    terms[key].append(word_id)
+    return {'version': INDEX_VERSION, 'pages': page_count, 'words': words, 'terms': terms}
+
+
+def write_index(pdf_path, index_path=None):
+    """索引を作成してファイルに保存する（別プロセスから呼ばれる）"""
+    index_path = index_path or index_path_for(pdf_path)
+    index = build_index(pdf_path)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, index_path)
+    return {'path': index_path, 'pages': index['pages'], 'words': len(index['words'])}
+
+
+class SearchIndex:
+    """読み込んだ索引に対する検索"""
+
+    def __init__(self, data):
+        self.pages = data['pages']
+        self.words = data['words']
+        self.terms = data['terms']
+        self._sorted_terms = sorted(self.terms)
+
+    @classmethod
+    def load(cls, index_path):
+        with open(index_path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != INDEX_VERSION:
+            raise ValueError('索引のバージョンが異なります')
+        return cls(data)
+
+    def _match(self, token):
+        """検索語に一致する単語IDの集合"""
+        ids = set(self.terms.get(token, ()))
+        if len(token) >= MIN_PREFIX_LENGTH:
+            start = bisect.bisect_left(self._sorted_terms, token)
+            for term in self._sorted_terms[start:]:
+                if not term.startswith(token):
+                    break
+                ids.update(self.terms[term])
+        if _CJK.search(token) and len(token) > 2:
+            # 2文字の部分文字列で候補を絞り込んでから、部分文字列として含むか確認する
+            candidates = None
+            for gram in _cjk_grams(token):
+                found = set(self.terms.get(gram, ()))
+                candidates = found if candidates is None else candidates & found
+                if not candidates:
+                    break
+            ids.update(i for i in candidates or () if token in self.words[i][5])
+        return ids
+
+    def search(self, query, limit=100):
+        """すべての検索語を含むページと、一致した単語の矩形を返す
+
+        Returns:
+            list: [{'page': 1始まりのページ番号, 'rects': [[x0, y0, x1, y1], ...]}, ...]
+        """
+        return self.search_with_total(query, limit)[0]
+
+    def search_with_total(self, query, limit=100):
+        """search と同じ結果と、limitで切り詰める前の一致したページ数を返す
+
+        Returns:
+            tuple: (結果のリスト, 一致したページ数)
+        """
+        tokens = [t for t in (normalize(part) for part in query.split()) if t]
+        if not tokens:
+            return [], 0
+        pages = None
+        hits = defaultdict(set)
+        for token in tokens:
+            token_pages = set()
+            for word_id in self._match(token):
+                page = self.words[word_id][0]
+                token_pages.add(page)
+                hits[page].add(word_id)
+            pages = token_pages if pages is None else pages & token_pages
+            if not pages:
+                return [], 0
+        results = [
+            {'page': page + 1, 'rects': [self.words[i][1:5] for i in sorted(hits[page])]}
+            for page in sorted(pages)[:limit]
+        ]
+        return results, len(pages)
+
+
+class IndexCache:
+    """読み込んだ索引をプロセス内で保持するLRUキャッシュ"""
+
+    def __init__(self, max_indexes=4):
+        self.max_indexes = max_indexes
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()  # (パス, 更新日時) -> SearchIndex
+
+    def get(self, index_path):
+        """索引を返す（ファイルがなければNone）"""
+        try:
+            key = (index_path, os.stat(index_path).st_mtime_ns)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        index = SearchIndex.load(index_path)
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        return index
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""本番用のマルチプロセスサーバー（gunicornのpre-forkワーカー）
+
+アプリケーションとPyMuPDFをforkの前にマスタープロセスで読み込み、
+ワーカーはそれをコピーオンライトで共有する。fitzのメモリ増加を抑えるため、
+一定数のリクエストを処理したワーカーは入れ替える。
+
+    python app.py serve --workers 8 --threads 4 --max-requests 500
+
+app.py を直接実行した場合もこのファイルをメインのスクリプトにして起動し直す
+（spawnで起動するワーカープロセスはメインのスクリプトを読み込み直すため、
+初期化処理の多い app.py ではなくこのファイルを読み込ませる）。
+
+プロセスの数（マシン全体）:
+    Webのワーカー workers 個それぞれが、レンダリングのワーカープロセスを RENDER_WORKERS 個
+    （既定値は CPUコア数 ÷ workers、少なくとも1）と、バックグラウンドジョブのワーカープロセスを
+    BACKGROUND_WORKERS 個（既定値2）起動する。
+
+再起動はマスタープロセスにシグナルを送る:
+    kill -HUP <master pid>   ワーカーを順に入れ替える（処理中のリクエストは完了を待つ）
+    kill -TERM <master pid>  graceful-timeoutまで処理中のリクエストを待って停止
+
+スレッドの割り当て（ワーカーごと）:
+    共同編集のイベントストリーム（/collab/<filename>/events）は1本がスレッドを1つ
+    COLLAB_STREAM_SECONDS 秒使い続ける。ストリームだけでスレッドが埋まらないよう、
+    同時接続数の上限（COLLAB_MAX_SUBSCRIBERS）を既定では --threads の半分にし、
+    超えた接続には503を返す。ビューアを多く同時に開く場合は --threads と一緒に増やすこと。
+    ワーカー全体で受けられるストリームは workers × COLLAB_MAX_SUBSCRIBERS 本になる。
+
+メトリクス:
+    各ワーカーは METRICS_DIR（未設定なら起動ごとに作る一時ディレクトリ）に自分の値を書き出し、
+    /metrics を受けたワーカーが全ワーカーの値を合算して返す（metrics.Registry を参照）。
+"""
+import argparse
+import logging
+import os
+import tempfile
+
+import fitz  # PyMuPDF
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # Windowsなどgunicornが使えない環境
+    BaseApplication = None
+
+logger = logging.getLogger('pdf_annotator')
+
+
+def default_workers():
+    # PyMuPDFの処理はCPUを使うため、コア数と同じワーカー数を既定値にする
+    return int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+
+
+def collab_subscriber_budget(threads):
+    """ワーカーごとのイベントストリームの上限（残りのスレッドをほかのリクエストに残す）"""
+    return max(1, threads // 2)
+
+
+def warm_up_engine():
+    """fork前にMuPDFのコンテキストとフォントを初期化しておく"""
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 50), "warm up")
+    page.get_pixmap(matrix=fitz.Matrix(0.1, 0.1))
+    doc.close()
+
+
+def post_fork(server, worker):
+    logger.info(f'ワーカー起動: pid={worker.pid}')
+
+
+def worker_exit(server, worker):
+    from metrics import REGISTRY
+    # 終了したワーカーのカウンタは合計に残し、ゲージは合算しないようにする
+    REGISTRY.stop()
+    logger.info(f'ワーカー終了: pid={worker.pid}')
+
+
+if BaseApplication is not None:
+    class AnnotatorServer(BaseApplication):
+        """app.pyのFlaskアプリをgunicornで動かすためのラッパー"""
+
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                if key in self.cfg.settings and value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='app.py serve', description='PDF注釈ツールの本番用サーバー')
+    parser.add_argument('--bind', type=str, default=os.environ.get('BIND', '0.0.0.0:5000'), help='待ち受けアドレス')
+    parser.add_argument('--workers', type=int, default=default_workers(), help='ワーカープロセス数')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('THREADS', '4')), help='ワーカーあたりのスレッド数')
+    parser.add_argument('--max-requests', type=int, default=int(os.environ.get('MAX_REQUESTS', '1000')),
+                        help='ワーカーを入れ替えるまでのリクエスト数（0で無効）')
+    parser.add_argument('--max-requests-jitter', type=int, default=100, help='全ワーカーが同時に入れ替わらないための揺らぎ')
+    parser.add_argument('--timeout', type=int, default=120, help='応答のないワーカーを再起動するまでの秒数')
+    parser.add_argument('--graceful-timeout', type=int, default=30, help='停止・再起動時に処理中のリクエストを待つ秒数')
+    parser.add_argument('--keepalive', type=int, default=5, help='Keep-Aliveの秒数')
+    parser.add_argument('--log-level', type=str, default='info', help='gunicornのログレベル')
+    parser.add_argument('--dev', action='store_true', help='Flaskの開発用サーバー（デバッグモード・単一プロセス）で起動')
+    return parser
+
+
+def main(argv=None, application=None):
+    args = build_parser().parse_args(argv)
+
+    if args.dev:
+        from app import app as application
+        print('PDF Annotator Server starting...')
+        application.run(host='0.0.0.0', port=5000, debug=True)
+        return
+
+    if BaseApplication is None:
+        raise SystemExit('gunicornがインストールされていません: pip install gunicorn')
+
+    # fork前にアプリケーションとPyMuPDFを読み込む
+    if application is None:
+        # レンダリングのワーカー数の既定値（RENDER_WORKERS）をWebのワーカー数から決める
+        os.environ['WEB_CONCURRENCY'] = str(args.workers)
+        # メトリクスを全ワーカーで合算する（前回の起動の値は消す）
+        if os.environ.get('METRICS_DIR'):
+            from metrics import Registry
+            Registry.clear_directory(os.environ['METRICS_DIR'])
+        else:
+            os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='pdf-annotator-metrics-')
+        from app import app as application
+    warm_up_engine()
+    if 'COLLAB_MAX_SUBSCRIBERS' not in os.environ:
+        application.config['COLLAB_MAX_SUBSCRIBERS'] = collab_subscriber_budget(args.threads)
+
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests_jitter if args.max_requests else 0,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': args.keepalive,
+        'preload_app': True,
+        'loglevel': args.log_level,
+        'accesslog': '-',
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+    }
+    print(f'PDF Annotator Server starting (workers={args.workers}, threads={args.threads}, '
+          f'collab streams={application.config["COLLAB_MAX_SUBSCRIBERS"]}/worker, bind={args.bind})...')
+    AnnotatorServer(application, options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,17 @@ import sys  # 標準出力用
 import shutil  # ファイルコピー用
 import datetime  # ログ用タイムスタンプ
 import argparse  # コマンドライン引数処理用
+import atexit  # 終了時の一時ファイル削除用
+import tempfile  # サムネイルの一時保存用
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from word_index import WordIndex  # テキストへの吸着用の単語矩形の索引
+from render_service import RenderService  # 一括ハイライトの検索用ワーカープロセス
+from bulk_highlight import normalize_terms, find_occurrences, summarize
+from jobs import BackgroundJobs, PENDING  # サムネイル作成用のバックグラウンドジョブ
+from thumbnails import write_thumbnails, load_index as load_thumbnail_index
+from output_profiles import PROFILES as OUTPUT_PROFILES, DEFAULT_PROFILE, save_with_profile, format_report
+from mapped_pdf import OPEN_MODES, open_pdf  # PDFの開き方（path / mmap）
 
 # ログレベル定数
 LOG_DEBUG = 0
@@ -20,6 +31,9 @@ LOG_ERROR = 3
 # グローバル変数の宣言 - 実際の値設定は後で行います
 CURRENT_LOG_LEVEL = LOG_INFO  # デフォルト値
 
+# PDFの開き方（--open-mode で変更）
+PDF_OPEN_MODE = 'path'
+
 def log(level, message):
     """ログを出力する関数"""
     level_str = {
@@ -45,6 +59,11 @@ class PDFAnnotator:
         self.current_page = 0
         self.total_pages = 0
         self.page_images = {}  # ページ番号をキーとするイメージのキャッシュ
+        self.word_index = WordIndex()  # ページ番号をキーとする単語矩形の索引（遅延作成）
+        self.thumbnail_jobs = BackgroundJobs(workers=1)  # ページ一覧用のサムネイルを別プロセスで作成
+        self.thumbnail_root = None  # サムネイルを保存する一時ディレクトリ
+        self.thumbnail_dir = None  # 開いているPDFのサムネイルのディレクトリ
+        self.thumbnail_images = []  # ページ一覧に表示中の画像（参照を保持）
         
         self.annotations = {}  # ページ番号をキーとする注釈のリスト
         self.annotation_type = "highlight"  # デフォルトの注釈タイプ
@@ -99,6 +118,14 @@ class PDFAnnotator:
         save_btn = ttk.Button(control_frame, text="注釈付きPDFを保存", command=self.save_pdf)
         save_btn.pack(fill=tk.X, padx=5, pady=5)
         
+        # 保存時の出力プロファイル
+        profile_frame = ttk.Frame(control_frame)
+        profile_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(profile_frame, text="出力:").pack(side=tk.LEFT)
+        self.output_profile_var = tk.StringVar(value=DEFAULT_PROFILE)
+        ttk.Combobox(profile_frame, textvariable=self.output_profile_var, values=list(OUTPUT_PROFILES),
+                     state="readonly", width=10).pack(side=tk.LEFT, padx=5)
+        
         # ページ移動ボタン
         page_frame = ttk.Frame(control_frame)
         page_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -131,6 +158,10 @@ class PDFAnnotator:
         fit_window_btn = ttk.Button(control_frame, text="全体表示", command=self.fit_to_window_and_update)
         fit_window_btn.pack(fill=tk.X, padx=5, pady=5)
         
+        # ページ一覧ボタン
+        navigator_btn = ttk.Button(control_frame, text="ページ一覧", command=self.show_page_navigator)
+        navigator_btn.pack(fill=tk.X, padx=5, pady=5)
+        
         # ウィンドウリサイズに追随するチェックボックス
         self.auto_resize_var = tk.BooleanVar(value=self.auto_resize)
         auto_resize_cb = ttk.Checkbutton(
@@ -178,6 +209,11 @@ class PDFAnnotator:
                          variable=self.annotation_type_var, value="freetext",
                          command=self.change_annotation_type).pack(anchor=tk.W, padx=5, pady=2)
         
+        # ハイライト・下線・取り消し線をテキストに吸着させるチェックボックス
+        self.snap_to_text_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(annotation_type_frame, text="テキストに吸着",
+                        variable=self.snap_to_text_var).pack(anchor=tk.W, padx=5, pady=2)
+        
         # テキストサイズ選択フレーム
         text_size_frame = ttk.Frame(annotation_type_frame)
         text_size_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -207,6 +243,10 @@ class PDFAnnotator:
         clear_btn = ttk.Button(control_frame, text="注釈を消去", command=self.clear_annotations)
         clear_btn.pack(fill=tk.X, padx=5, pady=5)
         
+        # 検索語の一括ハイライトボタン
+        bulk_highlight_btn = ttk.Button(control_frame, text="語句を一括ハイライト", command=self.bulk_highlight_terms)
+        bulk_highlight_btn.pack(fill=tk.X, padx=5, pady=5)
+        
         # 座標表示モードの切り替え (デバッグ用)
         self.debug_frame = ttk.Frame(control_frame)
         self.debug_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -1022,6 +1062,66 @@ class PDFAnnotator:
         self.update_page_display()
         log(LOG_INFO, "PDFをウィンドウサイズに合わせて表示しました")
     
+    def start_thumbnails(self):
+        """開いているPDFのサムネイルの作成をバックグラウンドで開始する"""
+        if self.thumbnail_root is None:
+            self.thumbnail_root = tempfile.mkdtemp(prefix="pdf_annotator_thumbs_")
+            atexit.register(shutil.rmtree, self.thumbnail_root, True)
+        self.thumbnail_dir = os.path.join(self.thumbnail_root, str(len(os.listdir(self.thumbnail_root))))
+        self.thumbnail_jobs.submit(self.thumbnail_dir, write_thumbnails, os.path.abspath(self.file_path), self.thumbnail_dir)
+        log(LOG_DEBUG, f"サムネイルの作成を開始: {self.thumbnail_dir}")
+    
+    def show_page_navigator(self):
+        """サムネイルのページ一覧を表示し、クリックしたページに移動する"""
+        if not self.pdf_document:
+            messagebox.showwarning("警告", "PDFが開かれていません")
+            return
+        if self.thumbnail_dir is None:
+            self.start_thumbnails()
+        
+        index = load_thumbnail_index(self.thumbnail_dir)
+        if index is None:
+            if self.thumbnail_jobs.status(self.thumbnail_dir) != PENDING:
+                self.start_thumbnails()
+            messagebox.showinfo("ページ一覧", "サムネイルを作成中です。しばらくしてから再度開いてください。")
+            return
+        
+        window = tk.Toplevel(self.root)
+        window.title("ページ一覧")
+        columns = 4
+        cell_w, cell_h = index['cell']
+        window.geometry(f"{columns * (cell_w + 12) + 30}x600")
+        
+        canvas = tk.Canvas(window, bg="#f0f0f0")
+        scrollbar = ttk.Scrollbar(window, orient=tk.VERTICAL, command=canvas.yview)
+        canvas.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        # スプライト画像から各ページの部分を切り出して並べる
+        sheets = [Image.open(os.path.join(self.thumbnail_dir, name)) for name in index['sheets']]
+        self.thumbnail_images = []
+        for page_num, (sheet, x, y, width, height) in enumerate(index['thumbs']):
+            image = ImageTk.PhotoImage(sheets[sheet].crop((x, y, x + width, y + height)))
+            self.thumbnail_images.append(image)
+            left = (page_num % columns) * (cell_w + 12) + 6
+            top = (page_num // columns) * (cell_h + 24) + 6
+            item = canvas.create_image(left, top, image=image, anchor=tk.NW)
+            label = canvas.create_text(left + cell_w / 2, top + cell_h + 10, text=str(page_num + 1))
+            for item_id in (item, label):
+                canvas.tag_bind(item_id, "<Button-1>", lambda event, n=page_num: self.go_to_page(n))
+        canvas.configure(scrollregion=canvas.bbox("all"))
+    
+    def go_to_page(self, page_num):
+        """指定したページ（0始まり）に移動"""
+        if not self.pdf_document or not 0 <= page_num < self.total_pages:
+            return
+        self.current_page = page_num
+        log(LOG_DEBUG, f"ページに移動: {self.current_page + 1}")
+        if hasattr(self, 'page_label'):
+            self.page_label.config(text=f"ページ: {self.current_page + 1} / {self.total_pages}")
+        self.update_page_display()
+    
     def prev_page(self):
         """前のページに移動"""
         if not self.pdf_document:
@@ -1110,6 +1210,47 @@ class PDFAnnotator:
             
             log(LOG_INFO, f"注釈を消去しました: ページ {self.current_page + 1}, {note_count}件")
             
+    def bulk_highlight_terms(self):
+        """検索語の出現箇所を全ページでハイライトする
+        
+        検索はワーカープロセスに分散して行い、見つかった箇所を注釈として追加する。
+        PDFへの書き込みは「注釈付きPDFを保存」でまとめて1回だけ行われる。
+        """
+        if not self.pdf_document:
+            messagebox.showwarning("警告", "PDFが開かれていません")
+            return
+        
+        text = simpledialog.askstring(
+            "一括ハイライト", "ハイライトする語句を入力してください（複数の場合はカンマ区切り）:", parent=self.root)
+        terms = normalize_terms((text or "").split(","))
+        if not terms:
+            return
+        
+        self.root.config(cursor="watch")
+        self.root.update()
+        service = RenderService(open_mode=PDF_OPEN_MODE)
+        try:
+            occurrences = find_occurrences(service, self.file_path, len(self.pdf_document), terms)
+        except Exception as e:
+            log(LOG_ERROR, f"一括ハイライトエラー: {str(e)}")
+            messagebox.showerror("エラー", f"語句の検索に失敗しました:\n{str(e)}")
+            return
+        finally:
+            service.shutdown()
+            self.root.config(cursor="")
+        
+        # 見つかった箇所ごとにハイライト注釈を追加
+        for page_num, term, quads in occurrences:
+            for q in quads:
+                coords = (min(q[0::2]), min(q[1::2]), max(q[0::2]), max(q[1::2]))
+                self.annotations.setdefault(page_num, []).append(("highlight", coords, self.annotation_color, term))
+        
+        result = summarize(occurrences, terms)
+        summary = "\n".join(f"{term}: {count}件" for term, count in result['matches'].items())
+        log(LOG_INFO, f"一括ハイライト: {result['matches']}, {result['pages']}ページ")
+        self.update_page_display()
+        messagebox.showinfo("一括ハイライト", f"{result['pages']}ページにハイライトを追加しました\n{summary}")
+    
     def canvas_to_pdf_coords(self, canvas_coords):
         """キャンバス座標をPDF座標に変換
         
@@ -1263,13 +1404,46 @@ class PDFAnnotator:
             
         # テキスト注釈の場合は特別処理（すでにstart_drawで処理済みのため、ここでは通常の図形のみ扱う）
         if self.annotation_type != "freetext":
-            annotation = (self.annotation_type, pdf_coords, self.annotation_color, "")
-            self.annotations[self.current_page].append(annotation)
-            log(LOG_INFO, f"注釈を追加: タイプ={self.annotation_type}, PDF座標={pdf_coords}")
+            lines = self.snap_to_text(pdf_coords)
+            if lines:
+                # 覆った単語の行ごとに注釈を追加
+                for line in lines:
+                    annotation = (self.annotation_type, tuple(line['rect']), self.annotation_color, "")
+                    self.annotations[self.current_page].append(annotation)
+                log(LOG_INFO, f"注釈を追加: タイプ={self.annotation_type}, テキストに吸着={len(lines)}行")
+            else:
+                annotation = (self.annotation_type, pdf_coords, self.annotation_color, "")
+                self.annotations[self.current_page].append(annotation)
+                log(LOG_INFO, f"注釈を追加: タイプ={self.annotation_type}, PDF座標={pdf_coords}")
             
         # 表示を更新
         self.update_page_display()
     
+    def snap_to_text(self, pdf_coords):
+        """描いた矩形を覆われた単語の行ごとの矩形に吸着させる
+        
+        Args:
+            pdf_coords: PDF座標の矩形 (x0, y0, x1, y1)
+        
+        Returns:
+            list: 行ごとの矩形と文字列（吸着しない場合は空のリスト）
+        """
+        if self.annotation_type not in ("highlight", "underline", "strike"):
+            return []
+        if not self.snap_to_text_var.get():
+            return []
+        
+        page_num = self.current_page
+        try:
+            return self.word_index.snap(
+                page_num,
+                lambda: self.pdf_document[page_num].get_text("words"),
+                pdf_coords
+            )
+        except Exception as e:
+            log(LOG_WARNING, f"テキストへの吸着エラー: {str(e)}")
+            return []
+    
     def modify_annotation(self, event):
         """選択した注釈を修正する（マウス右ボタンドラッグ）"""
         if self.selected_annotation_index < 0 or self.current_page not in self.annotations:
@@ -1464,7 +1638,9 @@ class PDFAnnotator:
             self.file_path = file_path
             
             # PDFを開く
-            self.pdf_document = fitz.open(file_path)
+            self.pdf_document = open_pdf(file_path, PDF_OPEN_MODE)
+            self.word_index.clear()
+            self.start_thumbnails()
             
             # 初期化
             self.current_page = 0
@@ -1517,7 +1693,7 @@ class PDFAnnotator:
             
         try:
             # 現在のPDFの一時コピーを作成
-            temp_doc = fitz.open(self.file_path)
+            temp_doc = open_pdf(self.file_path, PDF_OPEN_MODE)
             
             # 各ページの注釈を追加
             for page_num, page_annotations in self.annotations.items():
@@ -1594,12 +1770,18 @@ class PDFAnnotator:
                             annot.set_info(content=text)
                             annot.update()
             
-            # 変更を保存
-            temp_doc.save(save_path)
+            # 変更を出力プロファイルのオプションで保存
+            # 開いているファイルに上書きする場合は、読み込み中のファイルを切り詰めないよう
+            # 一時ファイルに保存してから置き換える
+            overwrite = os.path.exists(save_path) and os.path.samefile(save_path, self.file_path)
+            output_path = save_path + '.tmp' if overwrite else save_path
+            report = save_with_profile(temp_doc, output_path, self.output_profile_var.get(), in_place=True)
             temp_doc.close()
+            if overwrite:
+                os.replace(output_path, save_path)
             
-            log(LOG_INFO, f"注釈付きPDFを保存しました: {save_path}")
-            messagebox.showinfo("保存完了", f"注釈付きPDFを保存しました:\n{save_path}")
+            log(LOG_INFO, f"注釈付きPDFを保存しました: {save_path} ({format_report(report)})")
+            messagebox.showinfo("保存完了", f"注釈付きPDFを保存しました:\n{save_path}\n{format_report(report)}")
             return True
             
         except Exception as e:
@@ -1716,8 +1898,11 @@ if __name__ == "__main__":
                         choices=['debug', 'info', 'warning', 'error'],
                         help='ログレベル (debug/info/warning/error)')
     parser.add_argument('--pdf', type=str, help='起動時に開くPDFファイル')
+    parser.add_argument('--open-mode', choices=OPEN_MODES, default='path',
+                        help='PDFの開き方 (path: ファイルから読み込む / mmap: メモリマップする)')
     
     args = parser.parse_args()
+    PDF_OPEN_MODE = args.open_mode
     
     # ログレベル設定
     log_level_map = {
@@ -1737,7 +1922,7 @@ if __name__ == "__main__":
     if args.pdf and os.path.exists(args.pdf):
         log(LOG_INFO, f"コマンドライン引数で指定されたPDFを開きます: {args.pdf}")
         app.file_path = args.pdf
-        app.pdf_document = fitz.open(args.pdf)
+        app.pdf_document = open_pdf(args.pdf, PDF_OPEN_MODE)
         app.current_page = 0
         app.total_pages = len(app.pdf_document)
         app.annotations = {i: [] for i in range(app.total_pages)}
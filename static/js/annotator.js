@@ -58,10 +58,15 @@ class PDFAnnotator {
             this.activeTextColor = '#000000'; // テキストのデフォルト色を黒に設定
             this.activeOpacity = options.activeOpacity || 0.3;
             this.activeRectStyle = options.activeRectStyle || 'outline';
+            this.snapToText = options.snapToText !== undefined ? options.snapToText : true; // ハイライトを単語に吸着させる
             this.selectedAnnotation = null;
             this.tempAnnotation = null;
             this.totalPages = 0;
             this.debugMode = options.debug || false;
+            // 共同編集: 自分が送った操作を見分けるためのIDと、受け取った操作の通し番号
+            this.clientId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+            this.collabSeq = null;
+            this.eventSource = null;
             
             // 初期化
             this.showDebugInfo('アノテータ初期化開始');
@@ -165,7 +170,12 @@ class PDFAnnotator {
             } else {
                 // URLの場合は直接読み込み
                 this.showDebugInfo(`URLからの読み込み: ${pdfSource}`);
-                loadingTask = pdfjsLib.getDocument(pdfSource);
+                // サーバーが線形化したPDFを配信する場合は、必要な範囲だけをRangeリクエストで取得する
+                loadingTask = pdfjsLib.getDocument({
+                    url: pdfSource,
+                    disableAutoFetch: true,
+                    disableStream: true
+                });
                 this.processPDFLoadingTask(loadingTask);
             }
         } catch (error) {
@@ -209,6 +219,11 @@ class PDFAnnotator {
                     // 初期ツールを選択
                     this.selectTool('select');
                     
+                    // ページ一覧とPDFに含まれている注釈を読み込む（表示を待たない）
+                    this.loadPageNavigator();
+                    this.loadExistingAnnotations();
+                    this.joinCollaboration();
+                    
                     resolve();
                 })
                 .catch((error) => {
@@ -301,6 +316,252 @@ class PDFAnnotator {
         });
     }
     
+    /**
+     * PDFにすでに含まれている注釈をサーバーから取得して表示する
+     * 座標はPDF座標（ポイント）で返されるのでキャンバス座標に変換する
+     */
+    loadExistingAnnotations() {
+        if (typeof this.pdfUrl !== 'string') return;
+        const filename = this.pdfUrl.split('/').pop();
+        
+        fetch(`/annotations/${encodeURIComponent(filename)}`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('ステータス: ' + response.status);
+                }
+                return response.json();
+            })
+            .then(data => {
+                if (!data.annotations || data.annotations.length === 0) return;
+                if (!this.annotations) {
+                    this.annotations = [];
+                }
+                const known = new Set(this.annotations.map(anno => String(anno.id)));
+                data.annotations.forEach(annotation => {
+                    if (known.has(String(annotation.id))) return;
+                    const converted = Object.assign({}, annotation, {
+                        x: annotation.x * this.scale,
+                        y: annotation.y * this.scale
+                    });
+                    if (typeof annotation.width === 'number') {
+                        converted.width = annotation.width * this.scale;
+                        converted.height = annotation.height * this.scale;
+                    }
+                    this.annotations.push(converted);
+                });
+                console.log(`PDFに含まれている注釈を${data.annotations.length}件読み込みました`);
+                this.renderAnnotations();
+            })
+            .catch(error => {
+                console.warn('PDFに含まれている注釈の読み込みに失敗しました:', error.message);
+            });
+    }
+    
+    /**
+     * 共同編集に参加する
+     * 最初に現在の注釈の一覧（reset）を受け取り、以降は他のビューアの操作（op）を受け取る
+     * 接続が切れた場合はブラウザが最後に受け取った通し番号（Last-Event-ID）の続きから再接続する。
+     * サーバーの接続数が上限に達していて断られた場合（503）はブラウザが再接続しないため、
+     * 少し待ってから受け取った通し番号の続きで接続し直す
+     */
+    joinCollaboration() {
+        if (typeof this.pdfUrl !== 'string' || typeof EventSource === 'undefined') return;
+        const filename = this.pdfUrl.split('/').pop();
+        const since = this.collabSeq === null ? '' : `?since=${this.collabSeq}`;
+        
+        this.eventSource = new EventSource(`/collab/${encodeURIComponent(filename)}/events${since}`);
+        this.eventSource.addEventListener('error', () => {
+            if (this.eventSource.readyState !== EventSource.CLOSED) return;
+            setTimeout(() => this.joinCollaboration(), 5000 + Math.random() * 5000);
+        });
+        this.eventSource.addEventListener('reset', event => {
+            const state = JSON.parse(event.data);
+            this.collabSeq = state.seq;
+            this.replaceSharedAnnotations(state.annotations);
+        });
+        this.eventSource.addEventListener('op', event => {
+            this.applyCollabOperation(JSON.parse(event.data));
+        });
+    }
+    
+    /**
+     * 共有されている注釈を置き換える（PDFに含まれている注釈は残す）
+     * @param {Array} annotations - 共有されている注釈の一覧
+     */
+    replaceSharedAnnotations(annotations) {
+        const shared = new Set(annotations.map(anno => String(anno.id)));
+        const fromPdf = (this.annotations || []).filter(anno => anno.source === 'pdf' && !shared.has(String(anno.id)));
+        this.annotations = fromPdf.concat(annotations);
+        this.renderAnnotations();
+    }
+    
+    /**
+     * 他のビューアの操作を反映する
+     * @param {Object} record - 通し番号付きの操作
+     */
+    applyCollabOperation(record) {
+        this.collabSeq = record.seq;
+        if (record.client === this.clientId) return;
+        
+        if (record.op === 'replace') {
+            this.replaceSharedAnnotations(record.annotations);
+            return;
+        }
+        const index = this.annotations.findIndex(anno => String(anno.id) === record.id);
+        if (record.op === 'delete') {
+            if (index === -1) return;
+            this.annotations.splice(index, 1);
+            if (this.selectedAnnotation && this.selectedAnnotation.dataset.id === record.id) {
+                this.selectedAnnotation = null;
+            }
+        } else if (index === -1) {
+            this.annotations.push(record.annotation);
+        } else {
+            this.annotations[index] = record.annotation;
+        }
+        this.renderAnnotations();
+    }
+    
+    /**
+     * 注釈の操作を記録する
+     * 共同編集に参加している場合は操作ログに送るだけで、注釈データはサーバーが操作ログから保存する。
+     * 参加していない場合（EventSourceが使えないブラウザ）は注釈の一覧を保存する
+     * @param {Array} ops - 操作（{op: 'add' | 'update', annotation} または {op: 'delete', id}）
+     */
+    recordOperations(ops) {
+        if (this.eventSource) {
+            this.publishOperations(ops);
+        } else {
+            this.saveAnnotations();
+        }
+    }
+    
+    /**
+     * 注釈の操作を他のビューアに送る
+     * 操作の順序（追加の後の移動など）が入れ替わらないよう、前の送信が終わってから送る
+     * @param {Array} ops - 操作（{op: 'add' | 'update', annotation} または {op: 'delete', id}）
+     */
+    publishOperations(ops) {
+        if (!this.eventSource) return;
+        const filename = this.pdfUrl.split('/').pop();
+        
+        this.pendingOperations = (this.pendingOperations || Promise.resolve())
+            .then(() => fetch(`/collab/${encodeURIComponent(filename)}/ops`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ client: this.clientId, ops: ops })
+            }))
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('ステータス: ' + response.status);
+                }
+            })
+            .catch(error => {
+                console.warn('注釈の操作を共有できませんでした:', error.message);
+            });
+    }
+    
+    /**
+     * サーバーで作成されたサムネイルのスプライト画像からページ一覧を表示する
+     * 作成中の場合はRetry-Afterの秒数だけ待って再試行する
+     * @param {number} [attempt] - 再試行の回数
+     */
+    loadPageNavigator(attempt = 0) {
+        if (typeof this.pdfUrl !== 'string') return;
+        const filename = this.pdfUrl.split('/').pop();
+        
+        fetch(`/thumbnails/${encodeURIComponent(filename)}`)
+            .then(response => {
+                if (response.status === 202) {
+                    if (attempt < 30) {
+                        const retryAfter = parseInt(response.headers.get('Retry-After') || '2', 10);
+                        setTimeout(() => this.loadPageNavigator(attempt + 1), retryAfter * 1000);
+                    }
+                    return null;
+                }
+                if (!response.ok) {
+                    throw new Error('ステータス: ' + response.status);
+                }
+                return response.json();
+            })
+            .then(index => {
+                if (index) {
+                    this.createPageNavigator(index);
+                }
+            })
+            .catch(error => {
+                console.warn('ページ一覧の読み込みに失敗しました:', error.message);
+            });
+    }
+    
+    /**
+     * ページ一覧を作成する（各ページはスプライト画像の一部を背景として表示）
+     * @param {Object} index - サムネイルの索引
+     */
+    createPageNavigator(index) {
+        const existingNavigator = document.querySelector('.page-navigator');
+        if (existingNavigator) {
+            existingNavigator.remove();
+        }
+        
+        const navigator = document.createElement('div');
+        navigator.className = 'page-navigator';
+        navigator.style.position = 'fixed';
+        navigator.style.top = '70px';
+        navigator.style.right = '10px';
+        navigator.style.bottom = '10px';
+        navigator.style.width = (index.cell[0] + 24) + 'px';
+        navigator.style.overflowY = 'auto';
+        navigator.style.backgroundColor = 'rgba(255, 255, 255, 0.95)';
+        navigator.style.boxShadow = '0 2px 10px rgba(0,0,0,0.2)';
+        navigator.style.borderRadius = '8px';
+        navigator.style.zIndex = '998';
+        
+        index.thumbs.forEach(([sheet, x, y, width, height], i) => {
+            const pageNum = i + 1;
+            const item = document.createElement('div');
+            item.className = 'page-thumb';
+            item.title = `ページ ${pageNum}`;
+            item.style.margin = '8px auto 0';
+            item.style.width = width + 'px';
+            item.style.cursor = 'pointer';
+            item.style.textAlign = 'center';
+            item.style.fontSize = '12px';
+            
+            const image = document.createElement('div');
+            image.style.width = width + 'px';
+            image.style.height = height + 'px';
+            image.style.border = '1px solid #ccc';
+            image.style.backgroundImage = `url(${index.sheets[sheet]})`;
+            image.style.backgroundPosition = `-${x}px -${y}px`;
+            image.style.backgroundRepeat = 'no-repeat';
+            
+            const label = document.createElement('div');
+            label.textContent = pageNum;
+            
+            item.appendChild(image);
+            item.appendChild(label);
+            item.onclick = () => this.goToPage(pageNum);
+            navigator.appendChild(item);
+        });
+        
+        this.container.appendChild(navigator);
+        console.log(`ページ一覧を作成しました: ${index.pages}ページ`);
+    }
+    
+    /**
+     * 指定したページに移動する
+     * @param {number} num - ページ番号
+     */
+    goToPage(num) {
+        if (this.hasError || num === this.currentPage) return;
+        this.renderPage(num)
+            .then(() => this.renderAnnotations())
+            .catch(error => this.handleError(`ページの表示に失敗しました: ${error.message}`, error));
+    }
+    
     queueRenderPage(num) {
         if (this.pageRendering) {
             this.pageNumPending = num;
@@ -519,6 +780,22 @@ class PDFAnnotator {
         };
         borderWidthContainer.appendChild(borderWidthSelect);
         
+        // テキストへの吸着の切り替えを追加
+        const snapContainer = document.createElement('div');
+        snapContainer.className = 'snap-container';
+        const snapCheckbox = document.createElement('input');
+        snapCheckbox.type = 'checkbox';
+        snapCheckbox.className = 'snap-checkbox';
+        snapCheckbox.checked = this.snapToText;
+        snapCheckbox.onchange = (e) => {
+            this.snapToText = e.target.checked;
+            console.log('テキストへの吸着を変更:', this.snapToText);
+        };
+        const snapLabel = document.createElement('label');
+        snapLabel.appendChild(snapCheckbox);
+        snapLabel.appendChild(document.createTextNode(' ハイライトをテキストに吸着'));
+        snapContainer.appendChild(snapLabel);
+        
         // 削除ボタンを追加
         const deleteBtn = document.createElement('button');
         deleteBtn.className = 'tool-btn delete-btn';
@@ -542,6 +819,7 @@ class PDFAnnotator {
         toolbar.appendChild(colorPicker);
         toolbar.appendChild(opacityContainer);
         toolbar.appendChild(rectStyleContainer);
+        toolbar.appendChild(snapContainer);
         toolbar.appendChild(deleteBtn);
         toolbar.appendChild(helpBtn);
         
@@ -873,7 +1151,7 @@ class PDFAnnotator {
                 // データを更新
                 this.annotations[annotIndex].x = parseInt(this.dragTarget.style.left);
                 this.annotations[annotIndex].y = parseInt(this.dragTarget.style.top);
-                this.saveAnnotations();
+                this.recordOperations([{ op: 'update', annotation: this.annotations[annotIndex] }]);
             }
             
             this.dragTarget = null;
@@ -947,28 +1225,85 @@ class PDFAnnotator {
                 page: this.currentPage
             };
             
-            // 注釈リストに追加
-            if (!this.annotations) {
-                this.annotations = [];
-            }
-            this.annotations.push(newAnnotation);
-            console.log('新しい注釈を追加しました:', newAnnotation);
-            
             // 一時的な要素を削除
             this.currentAnnotation.remove();
             this.currentAnnotation = null;
             
-            // 注釈を再描画
-            this.renderAnnotations();
+            if (this.currentTool === 'highlight' && this.snapToText) {
+                // ハイライトは覆った単語の行ごとの矩形に置き換えてから追加する
+                this.snapHighlightToText(newAnnotation);
+                return;
+            }
             
-            // 注釈を保存
-            this.saveAnnotations();
+            this.addDrawnAnnotations([newAnnotation]);
         }
         
         e.preventDefault();
         e.stopPropagation();
     }
     
+    /**
+     * 描画した注釈をリストに追加して保存する
+     * @param {Array} annotations - 追加する注釈
+     */
+    addDrawnAnnotations(annotations) {
+        if (!this.annotations) {
+            this.annotations = [];
+        }
+        annotations.forEach(annotation => {
+            this.annotations.push(annotation);
+            console.log('新しい注釈を追加しました:', annotation);
+        });
+        this.recordOperations(annotations.map(annotation => ({ op: 'add', annotation: annotation })));
+        
+        // 注釈を再描画
+        this.renderAnnotations();
+    }
+    
+    /**
+     * ハイライトの矩形をサーバーの単語矩形の索引で行ごとの矩形に吸着させる
+     * 単語を覆っていない場合やエラーの場合は描いた矩形のまま追加する
+     * @param {Object} annotation - 描画したハイライト注釈
+     */
+    snapHighlightToText(annotation) {
+        const filename = this.pdfUrl.split('/').pop();
+        // キャンバス座標からPDF座標（ポイント）に変換して問い合わせる
+        const params = new URLSearchParams({
+            x: annotation.x / this.scale,
+            y: annotation.y / this.scale,
+            width: annotation.width / this.scale,
+            height: annotation.height / this.scale
+        });
+        
+        fetch(`/snap/${encodeURIComponent(filename)}/${annotation.page}?${params}`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('ステータス: ' + response.status);
+                }
+                return response.json();
+            })
+            .then(data => {
+                if (!data.lines || data.lines.length === 0) {
+                    this.addDrawnAnnotations([annotation]);
+                    return;
+                }
+                const snapped = data.lines.map((line, i) => Object.assign({}, annotation, {
+                    id: annotation.id + i,
+                    x: line.rect[0] * this.scale,
+                    y: line.rect[1] * this.scale,
+                    width: (line.rect[2] - line.rect[0]) * this.scale,
+                    height: (line.rect[3] - line.rect[1]) * this.scale,
+                    text: line.text
+                }));
+                console.log(`ハイライトを${snapped.length}行に吸着しました`);
+                this.addDrawnAnnotations(snapped);
+            })
+            .catch(error => {
+                console.warn('テキストへの吸着に失敗したため描いた矩形のまま追加します:', error.message);
+                this.addDrawnAnnotations([annotation]);
+            });
+    }
+    
     /**
      * テキスト注釈を追加する
      */
@@ -990,7 +1325,7 @@ class PDFAnnotator {
         
         this.annotations.push(annotation);
         this.renderAnnotations();
-        this.saveAnnotations();
+        this.recordOperations([{ op: 'add', annotation: annotation }]);
     }
 
     /**
@@ -1112,7 +1447,7 @@ class PDFAnnotator {
         .then(result => {
             Object.assign(this.annotations[annotIndex], result);
             this.renderAnnotations();
-            this.saveAnnotations();
+            this.recordOperations([{ op: 'update', annotation: this.annotations[annotIndex] }]);
         })
         .catch(() => {
             console.log('テキスト編集がキャンセルされました');
@@ -1287,7 +1622,7 @@ class PDFAnnotator {
                     this.annotations[annotIndex].x = parseInt(annotation.style.left);
                     this.annotations[annotIndex].y = parseInt(annotation.style.top);
                 }
-                this.saveAnnotations();
+                this.recordOperations([{ op: 'update', annotation: this.annotations[annotIndex] }]);
             }
 
             isDragging = false;
@@ -1343,7 +1678,7 @@ class PDFAnnotator {
                     if (annotIndex !== -1) {
                         this.annotations[annotIndex].width = parseInt(annotation.style.width);
                         this.annotations[annotIndex].height = parseInt(annotation.style.height);
-                        this.saveAnnotations();
+                        this.recordOperations([{ op: 'update', annotation: this.annotations[annotIndex] }]);
                     }
                     
                     document.removeEventListener('mousemove', onMouseMove);
@@ -1395,7 +1730,7 @@ class PDFAnnotator {
         if (index !== -1) {
             this.annotations.splice(index, 1);
             this.renderAnnotations();
-            this.saveAnnotations();
+            this.recordOperations([{ op: 'delete', id: id }]);
             this.selectedAnnotation = null;
             console.log('注釈を削除しました');
         }
@@ -1456,27 +1791,59 @@ class PDFAnnotator {
         }
     }
     
-    saveAnnotations() {
-        if (this.hasError) return;
-        
-        // 注釈データをサーバーに送信
-        fetch('/save-annotations', {
+    /**
+     * 注釈付きPDFを保存するリクエストを送る
+     * 共同編集に参加している場合は送信中の操作を待ってから、サーバーの操作ログの内容で保存する。
+     * 参加していない場合は現在の注釈の一覧を送る
+     * @param {string} delivery - 受け取り方（'file' または 'stream'）
+     * @returns {Promise<Response>}
+     */
+    requestSave(delivery) {
+        const filename = this.pdfUrl.split('/').pop();
+        const options = {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
-            },
+            }
+        };
+        if (this.eventSource) {
+            return (this.pendingOperations || Promise.resolve()).then(() => fetch(
+                `/collab/${encodeURIComponent(filename)}/save`,
+                Object.assign(options, { body: JSON.stringify({ delivery: delivery }) })
+            ));
+        }
+        return fetch('/save-annotations', Object.assign(options, {
             body: JSON.stringify({
-                filename: this.pdfUrl.split('/').pop(),
-                annotations: this.annotations
+                filename: filename,
+                annotations: this.annotations,
+                delivery: delivery
             })
-        })
+        }));
+    }
+    
+    /**
+     * 注釈をサーバーに保存する
+     * サーバーが混雑している場合（503）はRetry-Afterの秒数だけ待って再試行する
+     * @param {number} [attempt] - 再試行の回数
+     */
+    saveAnnotations(attempt = 0) {
+        if (this.hasError) return;
+        
+        // 注釈データをサーバーに送信
+        this.requestSave('file')
         .then(response => {
+            if (response.status === 503 && attempt < 5) {
+                const retryAfter = parseInt(response.headers.get('Retry-After') || '1', 10);
+                setTimeout(() => this.saveAnnotations(attempt + 1), retryAfter * 1000);
+                return null;
+            }
             if (!response.ok) {
                 throw new Error('サーバーからエラーレスポンスを受け取りました（ステータス: ' + response.status + '）');
             }
             return response.json();
         })
         .then(data => {
+            if (!data) return;
             if (data.success) {
                 // 成功メッセージを表示（アラートは表示しない）
                 console.log('注釈が保存されました。ダウンロードリンク: ' + data.download_url);
@@ -1651,21 +2018,37 @@ PDFアノテーションヘルプ:
 
     /**
      * 注釈付きPDFをダウンロードする
+     * 現在の注釈を適用したPDFをレスポンスとして直接受け取る（サーバーにはファイルを残さない）
      */
     downloadAnnotatedPDF() {
-        if (!this.latestDownloadUrl) {
+        if (!this.latestDownloadUrl && !this.eventSource) {
             alert('ダウンロード可能なPDFがありません。注釈を追加してから再試行してください。');
             return;
         }
         
-        // ダウンロードリンクを作成して実行
-        const downloadLink = document.createElement('a');
-        downloadLink.href = this.latestDownloadUrl;
-        downloadLink.download = 'annotated_' + this.pdfUrl.split('/').pop();
-        downloadLink.style.display = 'none';
-        document.body.appendChild(downloadLink);
-        downloadLink.click();
-        document.body.removeChild(downloadLink);
+        const filename = this.pdfUrl.split('/').pop();
+        this.requestSave('stream')
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('サーバーからエラーレスポンスを受け取りました（ステータス: ' + response.status + '）');
+            }
+            return response.blob();
+        })
+        .then(blob => {
+            // ダウンロードリンクを作成して実行
+            const objectUrl = URL.createObjectURL(blob);
+            const downloadLink = document.createElement('a');
+            downloadLink.href = objectUrl;
+            downloadLink.download = 'annotated_' + filename;
+            downloadLink.style.display = 'none';
+            document.body.appendChild(downloadLink);
+            downloadLink.click();
+            document.body.removeChild(downloadLink);
+            setTimeout(() => URL.revokeObjectURL(objectUrl), 1000);
+        })
+        .catch(error => {
+            this.handleError('注釈付きPDFのダウンロード中にエラーが発生しました: ' + error.message);
+        });
     }
 
     // ツール選択のエイリアスメソッド（互換性のため）
@@ -1739,6 +2122,7 @@ PDFアノテーションヘルプ:
             
             // 注釈を描画
             this.renderAnnotations();
+            this.publishOperations([{ op: 'add', annotation: annotation }]);
             
             // デバッグ情報
             this.showDebugInfo('注釈追加', {
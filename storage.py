@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""PDFと注釈データの保存先（ストレージバックエンド）
+
+アップロードフォルダと注釈フォルダはこれまでどおり作業用のローカルフォルダとして使い、
+ストレージバックエンドを設定した場合はそれを正本とする。
+
+- 書き込み: ローカルフォルダに書いたファイルをバックエンドにも送る（``StorageFolder.publish``）
+- 読み込み: ローカルフォルダにないファイルはバックエンドから取得して置く（``StorageFolder.local_path``）。
+  取得したファイルはよく使うものだけを残す読み込みキャッシュとして扱い、
+  合計サイズが上限を超えたら使われていない順に削除する
+
+PyMuPDFやsend_fileはローカルのパスを使うため、処理そのものは変わらない。
+アップロードされたPDF・注釈付きPDF・注釈データはファイル名ごとに内容が変わらないので、
+キャッシュを無効化する必要はない。バックエンドを共有すれば、ロードバランサの後ろに
+複数のノードを置いても、どのノードでも同じPDFを開ける。
+
+バックエンド（``STORAGE_BACKEND``）:
+
+- 未設定: ローカルフォルダだけを使う（従来どおり）
+- ``fs``: 共有ファイルシステム（NFSなど）上のディレクトリ（``STORAGE_ROOT``）
+- ``s3``: S3互換のオブジェクトストレージ（``STORAGE_BUCKET``、boto3が必要）
+- ``memory``: プロセス内のオブジェクトストレージ（テスト・開発用）
+"""
+import io
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+BACKENDS = ('fs', 's3', 'memory')
+
+_COPY_BUFFER = 1024 * 1024
+
+logger = logging.getLogger('pdf_annotator')
+
+
+class StorageError(Exception):
+    """ストレージの設定または操作のエラー"""
+
+
+class LocalStorage:
+    """ディレクトリをオブジェクトストレージとして使う（キーはディレクトリからの相対パス）"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError(f'不正なキーです: {key}')
+        return path
+
+    def put(self, key, fileobj):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f, _COPY_BUFFER)
+        os.replace(tmp_path, path)
+
+    def open(self, key):
+        """読み込み用のストリーム（なければFileNotFoundError）"""
+        return open(self._path(key), 'rb')
+
+    def size(self, key):
+        """サイズ（なければNone）"""
+        try:
+            return os.path.getsize(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix):
+        """キーが prefix で始まるオブジェクトのキー"""
+        directory = os.path.dirname(self._path(prefix + 'x'))
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        base = os.path.relpath(directory, self.root).replace(os.sep, '/')
+        keys = [name if base == '.' else f'{base}/{name}' for name in names if not name.endswith('.tmp')]
+        return sorted(key for key in keys if key.startswith(prefix))
+
+
+class MemoryStorage:
+    """プロセス内に置くオブジェクトストレージ（テスト・開発用）"""
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, fileobj):
+        data = fileobj.read()
+        with self._lock:
+            self._objects[key] = bytes(data)
+
+    def open(self, key):
+        with self._lock:
+            data = self._objects.get(key)
+        if data is None:
+            raise FileNotFoundError(key)
+        return io.BytesIO(data)
+
+    def size(self, key):
+        with self._lock:
+            data = self._objects.get(key)
+        return None if data is None else len(data)
+
+    def delete(self, key):
+        with self._lock:
+            self._objects.pop(key, None)
+
+    def list(self, prefix):
+        with self._lock:
+            return sorted(key for key in self._objects if key.startswith(prefix))
+
+
+class S3Storage:
+    """S3互換のオブジェクトストレージ
+
+    読み書きはストリームのまま行い（大きなファイルはマルチパートで送る）、
+    ファイル全体をメモリに載せない。
+    """
+
+    def __init__(self, bucket, prefix='', client=None, endpoint_url=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise StorageError('S3のストレージにはboto3が必要です: pip install boto3')
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, key, fileobj):
+        self.client.upload_fileobj(fileobj, self.bucket, self.prefix + key)
+
+    def open(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)['ContentLength']
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def list(self, prefix):
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            keys.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return sorted(keys)
+
+
+def create_storage(config):
+    """設定からストレージバックエンドを作成する（未設定の場合はNone）"""
+    backend = config.get('STORAGE_BACKEND')
+    if not backend:
+        return None
+    if backend == 'fs':
+        if not config.get('STORAGE_ROOT'):
+            raise StorageError('STORAGE_ROOT が設定されていません')
+        return LocalStorage(config['STORAGE_ROOT'])
+    if backend == 's3':
+        if not config.get('STORAGE_BUCKET'):
+            raise StorageError('STORAGE_BUCKET が設定されていません')
+        return S3Storage(config['STORAGE_BUCKET'], config.get('STORAGE_PREFIX', ''),
+                         endpoint_url=config.get('STORAGE_ENDPOINT_URL'))
+    if backend == 'memory':
+        return MemoryStorage()
+    raise StorageError(f'未対応のストレージです: {backend}（{", ".join(BACKENDS)}）')
+
+
+class ReadCache:
+    """バックエンドから取得したファイルの使われた順と合計サイズ（プロセスごと）"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # パス -> サイズ
+        self._total = 0
+
+    def touch(self, path):
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+
+    def add(self, path, size):
+        """追加し、上限を超えた分を古い順に削除する（追加したファイルは残す。削除したパスを返す）"""
+        with self._lock:
+            self._total += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            evicted = []
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_path, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                evicted.append((old_path, old_size))
+        removed = []
+        kept = []
+        for old_path, old_size in evicted:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # 削除できなかったファイル（使用中など）は最も古いものとして残し、次の追加時に削除し直す
+                logger.warning(f'キャッシュのファイルを削除できません: {old_path}: {e}')
+                kept.append((old_path, old_size))
+                continue
+            removed.append(old_path)
+        if kept:
+            with self._lock:
+                for old_path, old_size in reversed(kept):
+                    if old_path not in self._entries:
+                        self._entries[old_path] = old_size
+                        self._entries.move_to_end(old_path, last=False)
+                        self._total += old_size
+        return removed
+
+
+class StorageFolder:
+    """ローカルフォルダとストレージバックエンドの対応
+
+    Args:
+        backend: ストレージバックエンド（Noneの場合はローカルフォルダだけを使う）
+        folder: 作業用のローカルフォルダ
+        prefix: バックエンドでのキーの接頭辞（'documents/' など）
+        cache: 取得したファイルを管理するReadCache
+    """
+
+    def __init__(self, backend, folder, prefix, cache=None):
+        self.backend = backend
+        self.folder = folder
+        self.prefix = prefix
+        self.cache = cache
+
+    def local_path(self, name):
+        """ファイルのローカルのパス（ローカルになければバックエンドから取得する。どちらにもなければNone）"""
+        path = os.path.join(self.folder, name)
+        if os.path.isfile(path):
+            if self.cache is not None:
+                self.cache.touch(os.path.abspath(path))
+            return path
+        if self.backend is None:
+            return None
+        try:
+            stream = self.backend.open(self.prefix + name)
+        except FileNotFoundError:
+            return None
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with stream, open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, _COPY_BUFFER)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if self.cache is not None:
+            self.cache.add(os.path.abspath(path), os.path.getsize(path))
+        return path
+
+    def publish(self, name):
+        """ローカルフォルダに書いたファイルをバックエンドに送る"""
+        if self.backend is None:
+            return
+        path = os.path.join(self.folder, name)
+        with open(path, 'rb') as f:
+            self.backend.put(self.prefix + name, f)
+        if self.cache is not None:
+            self.cache.add(os.path.abspath(path), os.path.getsize(path))
+
+    def names(self, prefix=''):
+        """prefix で始まるファイル名の一覧（バックエンドがあればバックエンドの一覧）
+
+        バックエンドには prefix を付けたキーで問い合わせるため、フォルダ全体を列挙しない。
+        """
+        if self.backend is None:
+            return sorted(name for name in os.listdir(self.folder)
+                          if name.startswith(prefix) and os.path.isfile(os.path.join(self.folder, name)))
+        return [key[len(self.prefix):] for key in self.backend.list(self.prefix + prefix)
+                if '/' not in key[len(self.prefix):]]
@@ -0,0 +1,255 @@
+"""アップロード・保存・ダウンロード経路のベンチマーク
+
+Flaskのテストクライアント経由で各エンドポイントを実行し、PDFのページ数と
+注釈密度ごとにスループット・レイテンシのパーセンタイル・ピークRSSを計測します。
+結果はJSONで書き出し、コミット間で比較できます。
+
+使い方:
+    python tests/benchmark.py --pages 1 10 100 1000 --densities 0 5 50 --output bench.json
+    python tests/benchmark.py --compare before.json after.json
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fitz  # PyMuPDF
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from app import app, apply_annotations_to_pdf, DOCUMENT_POOL
+from create_sample_pdf import create_corpus_pdf, create_annotation_payload
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+OPERATIONS = ('upload', 'save', 'apply', 'serve', 'download')
+
+
+def peak_rss_mb():
+    """プロセスのピークRSS（MB）を返す。取得できない環境ではNone"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # LinuxはKB、macOSはバイト単位
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def percentile(values, pct):
+    """線形補間でパーセンタイルを求める"""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def summarize(latencies):
+    return {
+        'min': min(latencies),
+        'mean': statistics.mean(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies),
+    }
+
+
+def upload(client, pdf_bytes, name):
+    response = client.post(
+        '/upload',
+        data={'file': (io.BytesIO(pdf_bytes), name)},
+        content_type='multipart/form-data'
+    )
+    if response.status_code != 302:
+        raise RuntimeError(f'upload failed: {response.status_code} {response.data[:200]!r}')
+    return response.headers['Location'].rsplit('/', 1)[-1]
+
+
+def timed(func, iterations):
+    latencies = []
+    result = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = func()
+        latencies.append(time.perf_counter() - start)
+    return latencies, result
+
+
+def run_scenario(client, workdir, pages, density, iterations, operations):
+    """1つのページ数・注釈密度の組み合わせを計測する"""
+    pdf_path = os.path.join(workdir, f'bench_{pages}.pdf')
+    if not os.path.exists(pdf_path):
+        create_corpus_pdf(pdf_path, pages, seed=0)
+    with open(pdf_path, 'rb') as f:
+        pdf_bytes = f.read()
+    annotations = create_annotation_payload(pages, density, seed=0)
+    results = []
+
+    def record(operation, latencies, nbytes):
+        total = sum(latencies)
+        results.append({
+            'operation': operation,
+            'pages': pages,
+            'annotations': len(annotations),
+            'iterations': len(latencies),
+            'bytes': nbytes,
+            'latency': summarize(latencies),
+            'throughput_ops': len(latencies) / total if total else None,
+            'throughput_mb': nbytes * len(latencies) / total / (1024 * 1024) if total else None,
+            'peak_rss_mb': peak_rss_mb(),
+        })
+
+    # アップロード（検証を含む）
+    latencies, filename = timed(lambda: upload(client, pdf_bytes, f'bench_{pages}.pdf'), iterations)
+    if 'upload' in operations:
+        record('upload', latencies, len(pdf_bytes))
+
+    # 注釈の保存（JSON書き出し + 注釈付きPDF生成）
+    def save():
+        response = client.post('/save-annotations', json={'filename': filename, 'annotations': annotations})
+        data = response.get_json()
+        if not data or not data.get('success'):
+            raise RuntimeError(f'save failed: {response.status_code} {data}')
+        return data['download_url']
+
+    latencies, download_url = timed(save, iterations)
+    if 'save' in operations:
+        record('save', latencies, len(pdf_bytes))
+
+    if 'apply' in operations:
+        output_path = os.path.join(workdir, 'apply_output.pdf')
+        latencies, _ = timed(lambda: apply_annotations_to_pdf(pdf_path, annotations, output_path), iterations)
+        record('apply', latencies, os.path.getsize(output_path))
+
+    def fetch(url):
+        def get():
+            response = client.get(url)
+            body = response.get_data()
+            if response.status_code != 200:
+                raise RuntimeError(f'GET {url} failed: {response.status_code}')
+            return len(body)
+        return get
+
+    if 'serve' in operations:
+        latencies, nbytes = timed(fetch(f'/temp/{filename}'), iterations)
+        record('serve', latencies, nbytes)
+
+    if 'download' in operations:
+        latencies, nbytes = timed(fetch(download_url), iterations)
+        record('download', latencies, nbytes)
+
+    return results
+
+
+def environment_info():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pymupdf': fitz.VersionBind,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run_benchmarks(pages_list, densities, iterations, operations=OPERATIONS):
+    """ベンチマークを実行して結果の辞書を返す"""
+    workdir = tempfile.mkdtemp(prefix='pdf_annotator_bench_')
+    saved_config = {key: app.config[key] for key in ('UPLOAD_FOLDER', 'ANNOTATION_FOLDER', 'MAX_CONTENT_LENGTH', 'TESTING')}
+    app.config['TESTING'] = True
+    app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'temp')
+    app.config['ANNOTATION_FOLDER'] = os.path.join(workdir, 'annotations')
+    app.config['MAX_CONTENT_LENGTH'] = None  # 大きなPDFも計測できるように上限を外す
+    os.makedirs(app.config['UPLOAD_FOLDER'])
+    os.makedirs(app.config['ANNOTATION_FOLDER'])
+    results = []
+    try:
+        with app.test_client() as client:
+            for pages in pages_list:
+                for density in densities:
+                    results.extend(run_scenario(client, workdir, pages, density, iterations, operations))
+    finally:
+        app.config.update(saved_config)
+        DOCUMENT_POOL.clear()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'environment': environment_info(), 'results': results}
+
+
+def print_results(report):
+    print(f"{'operation':<10} {'pages':>6} {'annots':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'ops/s':>8} {'MB/s':>8} {'RSS MB':>8}")
+    for r in report['results']:
+        lat = r['latency']
+        rss = r['peak_rss_mb']
+        print(f"{r['operation']:<10} {r['pages']:>6} {r['annotations']:>7} "
+              f"{lat['p50'] * 1000:>9.2f} {lat['p90'] * 1000:>9.2f} {lat['p99'] * 1000:>9.2f} "
+              f"{r['throughput_ops'] or 0:>8.1f} {r['throughput_mb'] or 0:>8.1f} "
+              f"{rss if rss is not None else float('nan'):>8.1f}")
+
+
+def compare(before_path, after_path):
+    """2つの結果ファイルのp50/p99を比較して表示する"""
+    with open(before_path, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(after_path, encoding='utf-8') as f:
+        after = json.load(f)
+
+    def key(r):
+        return (r['operation'], r['pages'], r['annotations'])
+
+    baseline = {key(r): r for r in before['results']}
+    print(f"before: {before['environment'].get('commit')}  after: {after['environment'].get('commit')}")
+    print(f"{'operation':<10} {'pages':>6} {'annots':>7} {'p50 before':>11} {'p50 after':>10} {'ratio':>7} {'p99 ratio':>10}")
+    for r in after['results']:
+        b = baseline.get(key(r))
+        if b is None:
+            continue
+        p50_ratio = r['latency']['p50'] / b['latency']['p50'] if b['latency']['p50'] else float('nan')
+        p99_ratio = r['latency']['p99'] / b['latency']['p99'] if b['latency']['p99'] else float('nan')
+        print(f"{r['operation']:<10} {r['pages']:>6} {r['annotations']:>7} "
+              f"{b['latency']['p50'] * 1000:>9.2f}ms {r['latency']['p50'] * 1000:>8.2f}ms "
+              f"{p50_ratio:>7.2f} {p99_ratio:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PDF注釈ツールのベンチマーク')
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 100, 1000], help='PDFのページ数')
+    parser.add_argument('--densities', type=int, nargs='+', default=[0, 5, 50], help='1ページあたりの注釈数')
+    parser.add_argument('--iterations', type=int, default=5, help='各操作の繰り返し回数')
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument('--output', type=str, help='結果を書き出すJSONファイル')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='2つの結果ファイルを比較')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    report = run_benchmarks(args.pages, args.densities, args.iterations, args.operations)
+    print_results(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
@@ -4,7 +4,7 @@ import tempfile
 import pytest
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from app import app
+from app import app, DOCUMENT_POOL
 
 @pytest.fixture
 def client():
@@ -15,7 +15,8 @@ def client():
     with app.test_client() as client:
         yield client
     
-    # テスト後に一時ディレクトリを削除
+    # プールのハンドルを閉じてから一時ディレクトリを削除
+    DOCUMENT_POOL.clear()
     shutil.rmtree(app.config['UPLOAD_FOLDER'])
     shutil.rmtree(app.config['ANNOTATION_FOLDER'])
 
@@ -1,5 +1,8 @@
 import fitz  # PyMuPDF
 import os
+import json
+import random
+import argparse
 
 def create_sample_pdf(output_path):
     """テスト用のサンプルPDFを作成します"""
@@ -44,14 +47,247 @@ def create_sample_pdf(output_path):
     
     print(f"サンプルPDFを作成しました: {output_path}")
 
+# --- 性能評価用のコーパス生成 ---
+
+# 生成されるPDFのメタデータ（日時を固定して同じシードから同じバイト列を得る）
+FIXED_METADATA = {
+    'title': 'PDF Annotator performance corpus',
+    'producer': 'tests/create_sample_pdf.py',
+    'creationDate': "D:20240101000000+00'00'",
+    'modDate': "D:20240101000000+00'00'",
+}
+
+LATIN_WORDS = (
+    "part", "number", "valve", "assembly", "torque", "bolt", "flange", "drawing",
+    "revision", "section", "detail", "tolerance", "material", "steel", "weld", "inspection",
+)
+
+CJK_WORDS = (
+    "図面", "部品番号", "仕様", "検査", "溶接", "寸法", "公差", "材料",
+    "改訂", "断面", "詳細", "組立", "締付", "配管", "注記", "承認",
+)
+
+ANNOTATION_TYPES = ('highlight', 'rect', 'text')
+
+def _text_lines(rng, count, words, separator):
+    return [
+        f"{n + 1:03d} " + separator.join(rng.choice(words) for _ in range(rng.randint(4, 9)))
+        for n in range(count)
+    ]
+
+def _scan_pixmap(rng, width, height):
+    """スキャン画像を模したグレースケールの画像を作成する
+
+    白地に文字列のような濃い横線とノイズを乗せる。行パターンを使い回して
+    数千ページでも高速に生成できるようにしている。
+    """
+    blank = bytes(rng.randint(235, 255) for _ in range(width))
+    patterns = []
+    for _ in range(32):
+        row = bytearray(blank)
+        x = rng.randint(0, width // 10)
+        while x < width - 40:
+            run = rng.randint(8, 40)
+            row[x:x + run] = bytes(rng.randint(0, 90) for _ in range(run))
+            x += run + rng.randint(4, 20)
+        patterns.append(bytes(row))
+
+    rows = []
+    y = 0
+    while y < height:
+        # 行間（白）と文字行（パターン）を交互に並べる
+        gap = rng.randint(6, 14)
+        rows.extend([blank] * min(gap, height - y))
+        y += gap
+        line_height = min(rng.randint(8, 12), max(height - y, 0))
+        pattern = rng.choice(patterns)
+        rows.extend([pattern] * line_height)
+        y += line_height
+    samples = b''.join(rows[:height])
+    return fitz.Pixmap(fitz.csGRAY, width, height, samples, 0)
+
+def _draw_vectors(page, rng, count):
+    """図面を模した線・曲線・矩形を描く"""
+    shape = page.new_shape()
+    w, h = page.rect.width, page.rect.height
+    for i in range(count):
+        p1 = fitz.Point(rng.uniform(20, w - 20), rng.uniform(20, h - 20))
+        p2 = fitz.Point(rng.uniform(20, w - 20), rng.uniform(20, h - 20))
+        kind = i % 4
+        if kind == 0:
+            shape.draw_line(p1, p2)
+        elif kind == 1:
+            shape.draw_bezier(p1, fitz.Point(p1.x, p2.y), fitz.Point(p2.x, p1.y), p2)
+        elif kind == 2:
+            shape.draw_rect(fitz.Rect(p1, p1 + (rng.uniform(5, 60), rng.uniform(5, 60))))
+        else:
+            shape.draw_circle(p1, rng.uniform(2, 30))
+        # 描画単位ごとに確定させてパス数を増やす（ベクター重視のPDFを再現）
+        if i % 8 == 7:
+            shape.finish(color=(0, 0, rng.random()), width=0.5)
+    shape.finish(color=(0, 0, 0), width=0.5)
+    shape.commit()
+
+def _add_existing_annotations(page, rng, count):
+    """既存の注釈（ハイライト・矩形・テキスト）を追加する"""
+    w, h = page.rect.width, page.rect.height
+    for i in range(count):
+        x = rng.uniform(40, w - 140)
+        y = rng.uniform(40, h - 40)
+        rect = fitz.Rect(x, y, x + rng.uniform(40, 100), y + 14)
+        kind = ANNOTATION_TYPES[i % len(ANNOTATION_TYPES)]
+        if kind == 'highlight':
+            annot = page.add_highlight_annot(rect)
+        elif kind == 'rect':
+            annot = page.add_rect_annot(rect)
+            annot.set_colors(stroke=(1, 0, 0))
+        else:
+            annot = page.add_text_annot(rect.tl, f"既存コメント {i}")
+        annot.update()
+
+def create_corpus_pdf(output_path, pages, seed=0, text_lines=40, cjk=False,
+                      scan_every=0, scan_size=(850, 1100), vector_shapes=0,
+                      annotations_per_page=0):
+    """性能評価用のPDFを決定的に作成します
+
+    Args:
+        output_path: 出力先のパス
+        pages: ページ数
+        seed: 乱数シード（同じ引数とシードなら同じPDFになる）
+        text_lines: 1ページあたりのテキスト行数
+        cjk: Trueの場合は日本語のテキストを使用
+        scan_every: Nページごとにスキャン画像のページを挿入（0で無効）
+        scan_size: スキャン画像の画素数（幅, 高さ）
+        vector_shapes: 1ページあたりのベクター図形の数
+        annotations_per_page: 1ページあたりの既存注釈の数
+
+    Returns:
+        dict: 作成したPDFの概要
+    """
+    rng = random.Random(seed)
+    doc = fitz.open()
+    doc.set_metadata(FIXED_METADATA)
+    words, separator, fontname = (CJK_WORDS, "", "japan") if cjk else (LATIN_WORDS, " ", "helv")
+    scan_pages = 0
+
+    for i in range(pages):
+        page = doc.new_page()
+        if scan_every and i % scan_every == scan_every - 1:
+            # スキャンページ（ページ全体が画像）
+            page.insert_image(page.rect, pixmap=_scan_pixmap(rng, *scan_size))
+            scan_pages += 1
+        else:
+            page.insert_text((50, 50), f"Corpus page {i + 1}", fontsize=16)
+            if text_lines:
+                page.insert_text(
+                    (50, 80),
+                    "\n".join(_text_lines(rng, text_lines, words, separator)),
+                    fontsize=10, fontname=fontname, lineheight=1.6
+                )
+        if vector_shapes:
+            _draw_vectors(page, rng, vector_shapes)
+        if annotations_per_page:
+            _add_existing_annotations(page, rng, annotations_per_page)
+
+    doc.save(output_path, garbage=1, deflate=True, no_new_id=True)
+    doc.close()
+
+    return {
+        'path': output_path,
+        'pages': pages,
+        'seed': seed,
+        'scan_pages': scan_pages,
+        'vector_shapes': vector_shapes * pages,
+        'annotations': annotations_per_page * pages,
+        'cjk': cjk,
+        'bytes': os.path.getsize(output_path),
+    }
+
+def create_annotation_payload(pages, per_page, seed=0, page_size=(595, 842)):
+    """ビューアーの保存形式（/save-annotations）に合わせた注釈データを作成します"""
+    rng = random.Random(seed)
+    width, height = page_size
+    annotations = []
+    for page in range(1, pages + 1):
+        for i in range(per_page):
+            x = round(rng.uniform(40, width - 140), 2)
+            y = round(rng.uniform(40, height - 40), 2)
+            annotations.append({
+                'page': page,
+                'type': ANNOTATION_TYPES[i % len(ANNOTATION_TYPES)],
+                'x': x,
+                'y': y,
+                'width': round(rng.uniform(40, 100), 2),
+                'height': 14,
+                'color': '#{:06x}'.format(rng.randrange(0x1000000)),
+                'text': f'note {page}-{i}',
+            })
+    return annotations
+
+# コーパスの標準構成（名前: create_corpus_pdfの引数）
+CORPUS_PROFILES = {
+    'text_small': {'pages': 10},
+    'text_large': {'pages': 1000},
+    'cjk_large': {'pages': 1000, 'cjk': True},
+    'scans': {'pages': 200, 'scan_every': 1, 'text_lines': 0},
+    'mixed_scans': {'pages': 2000, 'scan_every': 10},
+    'vector_heavy': {'pages': 100, 'vector_shapes': 2000, 'text_lines': 5},
+    'annotated': {'pages': 500, 'annotations_per_page': 20},
+}
+
+def create_corpus(output_dir, seed=0, profiles=None, payload_density=(0, 5, 50), scale=1.0):
+    """標準構成のコーパスと注釈データのJSON、manifest.jsonを作成します
+
+    Args:
+        output_dir: 出力先ディレクトリ
+        seed: 乱数シード
+        profiles: 作成する構成名のリスト（Noneの場合はすべて）
+        payload_density: 注釈データを作成する1ページあたりの注釈数
+        scale: ページ数の倍率（CIなどで小さなコーパスを作る場合に使用）
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {'seed': seed, 'scale': scale, 'documents': []}
+    for name in profiles or CORPUS_PROFILES:
+        options = dict(CORPUS_PROFILES[name])
+        options['pages'] = max(1, int(options['pages'] * scale))
+        pdf_path = os.path.join(output_dir, f"{name}.pdf")
+        entry = create_corpus_pdf(pdf_path, seed=seed, **options)
+        entry['path'] = os.path.basename(pdf_path)
+        entry['name'] = name
+        entry['payloads'] = {}
+        for density in payload_density:
+            payload_name = f"{name}_annotations_{density}.json"
+            payload = create_annotation_payload(options['pages'], density, seed=seed)
+            with open(os.path.join(output_dir, payload_name), 'w', encoding='utf-8') as f:
+                json.dump({'filename': entry['path'], 'annotations': payload}, f, ensure_ascii=False)
+            entry['payloads'][str(density)] = payload_name
+        manifest['documents'].append(entry)
+        print(f"コーパスを作成しました: {pdf_path} ({entry['pages']}ページ, {entry['bytes']}バイト)")
+
+    with open(os.path.join(output_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
 if __name__ == "__main__":
-    # このスクリプトが直接実行された場合、test_filesディレクトリにPDFを作成
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    test_files_dir = os.path.join(script_dir, "test_files")
+    parser = argparse.ArgumentParser(description='テスト用PDFの作成')
+    parser.add_argument('--corpus', type=str, help='性能評価用コーパスの出力先ディレクトリ')
+    parser.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(CORPUS_PROFILES), help='作成する構成')
+    parser.add_argument('--scale', type=float, default=1.0, help='ページ数の倍率')
+    parser.add_argument('--densities', type=int, nargs='+', default=[0, 5, 50], help='注釈データの1ページあたりの注釈数')
+    args = parser.parse_args()
+    
+    if args.corpus:
+        create_corpus(args.corpus, seed=args.seed, profiles=args.profiles,
+                      payload_density=args.densities, scale=args.scale)
+    else:
+        # このスクリプトが直接実行された場合、test_filesディレクトリにPDFを作成
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        test_files_dir = os.path.join(script_dir, "test_files")
     
-    # ディレクトリが存在しない場合は作成
-    if not os.path.exists(test_files_dir):
-        os.makedirs(test_files_dir)
+        # ディレクトリが存在しない場合は作成
+        if not os.path.exists(test_files_dir):
+            os.makedirs(test_files_dir)
     
-    pdf_path = os.path.join(test_files_dir, "sample.pdf")
-    create_sample_pdf(pdf_path) 
\ No newline at end of file
+        pdf_path = os.path.join(test_files_dir, "sample.pdf")
+        create_sample_pdf(pdf_path) 
\ No newline at end of file
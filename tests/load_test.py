@@ -0,0 +1,296 @@
+"""ローカルで起動したサーバーに対する同時アクセスの負荷試験
+
+サーバーを別プロセスで起動し（または起動済みのサーバーを --url で指定し）、
+多数の仮想ユーザーから /upload, /view, /temp, /save-annotations, /download を
+混在させたリクエストを送り、スループット・エラー率・レイテンシを集計します。
+
+使い方:
+    python tests/load_test.py --users 20 --duration 30 --pages 50
+    python tests/load_test.py --url http://localhost:5000 --users 50 --output load.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlsplit, quote
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from benchmark import summarize, environment_info
+from create_sample_pdf import create_corpus_pdf, create_annotation_payload
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 操作ごとの重み（閲覧が中心で、保存とアップロードはときどき）
+DEFAULT_MIX = {
+    'view': 30,
+    'temp': 30,
+    'save': 20,
+    'download': 15,
+    'upload': 5,
+}
+
+# サーバー起動用のスクリプト
+SERVER_SCRIPTS = {
+    # 開発用サーバーをスレッドモードで起動
+    'flask': (
+        "import os, sys; from app import app; "
+        "app.config.update(UPLOAD_FOLDER=os.path.abspath('temp'), ANNOTATION_FOLDER=os.path.abspath('annotations')); "
+        "app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True, debug=False, use_reloader=False)"
+    ),
+    # 本番用のマルチプロセスサーバー（app.py serve）で起動
+    'serve': (
+        "import os, sys; from app import app; from serve import main; "
+        "app.config.update(UPLOAD_FOLDER=os.path.abspath('temp'), ANNOTATION_FOLDER=os.path.abspath('annotations')); "
+        "main(['--bind', '127.0.0.1:' + sys.argv[1]] + sys.argv[2:], app)"
+    ),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, workdir, mode='flask', server_args=()):
+    """サーバーを別プロセスで起動して、応答するまで待つ"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    cmd = [sys.executable, '-c', SERVER_SCRIPTS[mode], str(port)] + list(server_args)
+    process = subprocess.Popen(cmd, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'サーバーの起動に失敗しました (exit {process.returncode})')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            conn.close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('サーバーが起動しませんでした')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+class Stats:
+    """スレッド間で共有する計測結果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.status_codes = defaultdict(lambda: defaultdict(int))
+
+    def record(self, operation, latency, status, ok):
+        with self._lock:
+            self.latencies[operation].append(latency)
+            self.status_codes[operation][status] += 1
+            if not ok:
+                self.errors[operation] += 1
+
+
+class VirtualUser(threading.Thread):
+    """PDFを1つアップロードし、閲覧と保存を繰り返す仮想ユーザー"""
+
+    def __init__(self, base_url, pdf_bytes, annotations, mix, stats, stop_at, seed, think_time):
+        super().__init__(daemon=True)
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.pdf_bytes = pdf_bytes
+        self.annotations = annotations
+        self.operations = list(mix)
+        self.weights = [mix[op] for op in self.operations]
+        self.stats = stats
+        self.stop_at = stop_at
+        self.rng = random.Random(seed)
+        self.think_time = think_time
+        self.conn = None
+        self.filename = None
+        self.download_url = None
+
+    def request(self, operation, method, path, body=None, headers=None, expect=(200,)):
+        start = time.perf_counter()
+        status = 0
+        data = b''
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            self.conn.request(method, path, body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            data = response.read()
+            status = response.status
+            location = response.getheader('Location')
+        except (OSError, http.client.HTTPException):
+            # 接続エラーは再接続してエラーとして記録
+            self.conn = None
+            location = None
+        self.stats.record(operation, time.perf_counter() - start, status, status in expect)
+        return status, data, location
+
+    def upload(self):
+        boundary = uuid.uuid4().hex
+        body = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="file"; filename="load_test.pdf"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n'
+        ).encode() + self.pdf_bytes + f'\r\n--{boundary}--\r\n'.encode()
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        status, _, location = self.request('upload', 'POST', '/upload', body, headers, expect=(302,))
+        if status == 302 and location:
+            self.filename = location.rsplit('/', 1)[-1]
+
+    def save(self):
+        body = json.dumps({'filename': self.filename, 'annotations': self.annotations}).encode()
+        status, data, _ = self.request('save', 'POST', '/save-annotations', body,
+                                       {'Content-Type': 'application/json'})
+        if status == 200:
+            self.download_url = json.loads(data).get('download_url')
+
+    def run(self):
+        self.upload()
+        while time.time() < self.stop_at:
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            if operation == 'upload' or self.filename is None:
+                self.upload()
+            elif operation == 'view':
+                self.request('view', 'GET', f'/view/{quote(self.filename)}')
+            elif operation == 'temp':
+                self.request('temp', 'GET', f'/temp/{quote(self.filename)}')
+            elif operation == 'save' or self.download_url is None:
+                self.save()
+            else:
+                self.request('download', 'GET', self.download_url)
+            if self.think_time:
+                time.sleep(self.rng.uniform(0, self.think_time * 2))
+        if self.conn is not None:
+            self.conn.close()
+
+
+def run_load_test(base_url, users, duration, pages, density, mix=None, think_time=0.0, seed=0):
+    """負荷試験を実行して結果の辞書を返す"""
+    workdir = tempfile.mkdtemp(prefix='pdf_annotator_load_')
+    try:
+        pdf_path = os.path.join(workdir, 'load_test.pdf')
+        create_corpus_pdf(pdf_path, pages, seed=seed)
+        with open(pdf_path, 'rb') as f:
+            pdf_bytes = f.read()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    annotations = create_annotation_payload(pages, density, seed=seed)
+
+    stats = Stats()
+    stop_at = time.time() + duration
+    threads = [
+        VirtualUser(base_url, pdf_bytes, annotations, mix or DEFAULT_MIX, stats, stop_at, seed + i, think_time)
+        for i in range(users)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    operations = {}
+    total_requests = 0
+    total_errors = 0
+    for operation, latencies in sorted(stats.latencies.items()):
+        errors = stats.errors[operation]
+        total_requests += len(latencies)
+        total_errors += errors
+        operations[operation] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'error_rate': errors / len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'latency': summarize(latencies),
+            'status_codes': {str(k): v for k, v in stats.status_codes[operation].items()},
+        }
+    return {
+        'environment': environment_info(),
+        'config': {'url': base_url, 'users': users, 'duration': duration, 'pages': pages,
+                   'annotations_per_page': density, 'think_time': think_time},
+        'elapsed': elapsed,
+        'requests': total_requests,
+        'errors': total_errors,
+        'error_rate': total_errors / total_requests if total_requests else 0.0,
+        'throughput': total_requests / elapsed,
+        'operations': operations,
+    }
+
+
+def print_report(report):
+    print(f"users={report['config']['users']} elapsed={report['elapsed']:.1f}s "
+          f"requests={report['requests']} throughput={report['throughput']:.1f} req/s "
+          f"error_rate={report['error_rate']:.2%}")
+    print(f"{'operation':<10} {'reqs':>7} {'err%':>7} {'req/s':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for operation, r in report['operations'].items():
+        lat = r['latency']
+        print(f"{operation:<10} {r['requests']:>7} {r['error_rate']:>7.2%} {r['throughput']:>8.1f} "
+              f"{lat['p50'] * 1000:>9.1f} {lat['p90'] * 1000:>9.1f} {lat['p99'] * 1000:>9.1f} {lat['max'] * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PDF注釈ツールの負荷試験')
+    parser.add_argument('--url', type=str, help='起動済みサーバーのURL（省略時はローカルに起動）')
+    parser.add_argument('--server', choices=sorted(SERVER_SCRIPTS), default='flask',
+                        help='ローカルに起動するサーバーの種類（flask: 開発用, serve: 本番用マルチプロセス）')
+    parser.add_argument('--workers', type=int, help='--server serve のワーカー数')
+    parser.add_argument('--threads', type=int, help='--server serve のワーカーあたりのスレッド数')
+    parser.add_argument('--users', type=int, default=10, help='同時ユーザー数')
+    parser.add_argument('--duration', type=float, default=30, help='試験時間（秒）')
+    parser.add_argument('--pages', type=int, default=20, help='アップロードするPDFのページ数')
+    parser.add_argument('--density', type=int, default=5, help='1ページあたりの注釈数')
+    parser.add_argument('--think-time', type=float, default=0.0, help='リクエスト間の平均待ち時間（秒）')
+    parser.add_argument('--seed', type=int, default=0, help='乱数シード')
+    parser.add_argument('--output', type=str, help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    server = None
+    server_dir = None
+    base_url = args.url
+    if base_url is None:
+        server_dir = tempfile.mkdtemp(prefix='pdf_annotator_server_')
+        port = free_port()
+        server_args = []
+        if args.workers:
+            server_args += ['--workers', str(args.workers)]
+        if args.threads:
+            server_args += ['--threads', str(args.threads)]
+        server = start_server(port, server_dir, args.server, server_args)
+        base_url = f'http://127.0.0.1:{port}'
+        print(f"サーバーを起動しました: {base_url}")
+    try:
+        report = run_load_test(base_url, args.users, args.duration, args.pages, args.density,
+                               think_time=args.think_time, seed=args.seed)
+    finally:
+        if server is not None:
+            stop_server(server)
+            shutil.rmtree(server_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
@@ -0,0 +1,127 @@
+"""同じ大きなPDFを複数のワーカープロセスで開いたときのメモリ使用量の比較
+
+ワーカープロセスごとに指定した方法でPDFを開いて全ページ（または指定数のページ）を
+レンダリングし、すべてのワーカーがドキュメントを開いたままの状態で
+RSS・PSS・匿名メモリ・共有ページを計測します（Linuxのみ）。
+
+- path:  fitz.open(path)（MuPDFが必要な部分だけをファイルから読む）
+- mmap:  ファイルをメモリマップしたmemoryviewを渡す（ページキャッシュを共有）
+- bytes: ファイル全体を読み込んだbytesを渡す（各プロセスがコピーを持つ）
+
+使い方:
+    python tests/rss_benchmark.py --size-mb 300 --workers 4
+    python tests/rss_benchmark.py --pdf plans.pdf --workers 8 --modes path mmap --output rss.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import fitz  # PyMuPDF
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mapped_pdf import open_pdf, memory_usage
+
+MODES = ('path', 'mmap', 'bytes')
+
+
+def make_large_pdf(path, size_mb=300, side=600):
+    """圧縮の効かないノイズ画像を1ページに1枚ずつ貼ったPDFを作成する（1ページ約1MB）"""
+    page_bytes = side * side * 3
+    pages = max(1, size_mb * 1024 * 1024 // page_bytes)
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page(width=side, height=side)
+        pix = fitz.Pixmap(fitz.csRGB, side, side, os.urandom(page_bytes), False)
+        page.insert_image(page.rect, pixmap=pix)
+    doc.save(path)
+    doc.close()
+    return pages
+
+
+def _open(path, mode):
+    if mode == 'bytes':
+        with open(path, 'rb') as f:
+            return fitz.open(stream=f.read(), filetype='pdf')
+    return open_pdf(path, mode)
+
+
+def _worker(path, mode, pages, dpi, barrier, results):
+    doc = _open(path, mode)
+    start = time.perf_counter()
+    for page_number in range(min(pages or len(doc), len(doc))):
+        doc[page_number].get_pixmap(dpi=dpi)
+    seconds = time.perf_counter() - start
+    # すべてのワーカーがドキュメントを開いている状態で計測する
+    barrier.wait()
+    results.put(dict(memory_usage() or {}, seconds=round(seconds, 2)))
+    barrier.wait()
+    doc.close()
+
+
+def measure(path, mode, workers=4, pages=None, dpi=18):
+    """ワーカーごとのメモリ使用量（MB）と、全ワーカーの合計"""
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=_worker, args=(path, mode, pages, dpi, barrier, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    per_worker = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    keys = ('rss', 'pss', 'anonymous', 'shared')
+    return {
+        'mode': mode,
+        'workers': workers,
+        'per_worker': per_worker,
+        'total': {key: round(sum(w.get(key, 0) for w in per_worker), 1) for key in keys},
+        'render_seconds': max(w['seconds'] for w in per_worker),
+    }
+
+
+def print_results(results, file_mb):
+    print(f'PDF: {file_mb:.0f} MB')
+    print(f"{'mode':<6} {'workers':>7} {'RSS MB':>9} {'PSS MB':>9} {'anon MB':>9} {'shared MB':>10} {'render s':>9}")
+    for r in results:
+        t = r['total']
+        print(f"{r['mode']:<6} {r['workers']:>7} {t['rss']:>9.1f} {t['pss']:>9.1f} {t['anonymous']:>9.1f} "
+              f"{t['shared']:>10.1f} {r['render_seconds']:>9.2f}")
+    print('（RSS / PSS / 匿名メモリ / 共有ページは全ワーカーの合計）')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='複数のワーカープロセスで同じPDFを開いたときのメモリ使用量を比較する')
+    parser.add_argument('--pdf', help='計測に使うPDF（省略時は --size-mb のPDFを一時的に作成）')
+    parser.add_argument('--size-mb', type=int, default=300, help='作成するPDFのおおよそのサイズ')
+    parser.add_argument('--workers', type=int, default=4, help='ワーカープロセス数')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help='比較する開き方')
+    parser.add_argument('--pages', type=int, help='ワーカーごとにレンダリングするページ数（省略時は全ページ）')
+    parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    args = parser.parse_args(argv)
+
+    if memory_usage() is None:
+        parser.error('メモリ使用量の計測には /proc/<pid>/smaps_rollup が必要です（Linuxのみ）')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.pdf
+        if path is None:
+            path = os.path.join(workdir, 'large.pdf')
+            make_large_pdf(path, args.size_mb)
+        file_mb = os.path.getsize(path) / (1024 * 1024)
+        results = [measure(path, mode, args.workers, args.pages) for mode in args.modes]
+
+    print_results(results, file_mb)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'file_mb': round(file_mb, 1), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
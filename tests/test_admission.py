@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from admission import AdmissionLimit, AdmissionController, AdmissionRejected
+
+def test_rejects_when_queue_is_full():
+    """実行枠と待ち行列が埋まったらすぐに断るかテスト"""
+    limit = AdmissionLimit(concurrency=1, max_waiting=0)
+    assert limit.acquire() == 0.0
+    with pytest.raises(AdmissionRejected) as e:
+        limit.acquire()
+    assert e.value.reason == 'full'
+    assert e.value.retry_after >= 1
+    
+    limit.release(0.5)
+    limit.acquire()
+    limit.release()
+    assert limit.running == 0
+
+def test_waiter_is_admitted_after_release():
+    """待ち行列のリクエストは実行枠が空いたら開始されるかテスト"""
+    changes = []
+    limit = AdmissionLimit(concurrency=1, max_waiting=1, timeout=5,
+                           on_change=lambda running, waiting: changes.append((running, waiting)))
+    limit.acquire()
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(limit.acquire()))
+    waiter.start()
+    while limit.waiting == 0:
+        pass
+    
+    # 待ち行列が一杯なので3つ目は断られる
+    with pytest.raises(AdmissionRejected):
+        limit.acquire()
+    limit.release()
+    waiter.join(5)
+    
+    assert waited and waited[0] > 0
+    assert limit.running == 1 and limit.waiting == 0
+    assert (1, 1) in changes
+    limit.release()
+
+def test_wait_timeout():
+    """待ち時間の上限を過ぎたら断るかテスト"""
+    limit = AdmissionLimit(concurrency=1, max_waiting=1, timeout=0.05)
+    limit.acquire()
+    with pytest.raises(AdmissionRejected) as e:
+        limit.acquire()
+    assert e.value.reason == 'timeout'
+    assert limit.waiting == 0
+
+def test_controller_ignores_unlimited_routes():
+    """制限のないルートは素通りするかテスト"""
+    controller = AdmissionController({'/save-annotations': (1, 0)})
+    assert '/view/<filename>' not in controller
+    assert controller.acquire('/view/<filename>') is None
+    
+    controller.acquire('/save-annotations')
+    assert controller.stats()['/save-annotations']['running'] == 1
+    controller.release('/save-annotations')
+    assert controller.stats()['/save-annotations']['running'] == 0
@@ -0,0 +1,61 @@
+import os
+import sys
+import fitz  # PyMuPDF
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from annotation_extract import extract_annotations, AnnotationCache
+from render_service import RenderService
+
+def make_reviewed_pdf(path, pages=30):
+    """3ページおきに注釈を付けたPDFを作成"""
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        if i % 3 == 0:
+            highlight = page.add_highlight_annot(quads=[fitz.Rect(50, 50, 200, 62).quad, fitz.Rect(50, 70, 120, 82).quad])
+            highlight.set_info(content=f'確認 {i + 1}')
+            highlight.update()
+            page.add_rect_annot(fitz.Rect(100, 300, 200, 350))
+            page.add_text_annot((300, 400), 'メモ')
+            page.add_line_annot((0, 0), (10, 10))
+    doc.save(path)
+    doc.close()
+
+def test_extract_annotations(tmp_path):
+    """ワーカープロセスに分散して取り出した注釈がビューアの形式でページ順に集まるかテスト"""
+    pdf_path = str(tmp_path / 'reviewed.pdf')
+    make_reviewed_pdf(pdf_path)
+    
+    service = RenderService(workers=2)
+    try:
+        annotations = extract_annotations(service, pdf_path, 30, pages_per_task=4)
+    finally:
+        service.shutdown()
+    
+    # 1ページにつき2行のハイライト、矩形、テキスト（線は未対応なので含まない）
+    assert len(annotations) == 10 * 4
+    assert [a['page'] for a in annotations] == sorted(a['page'] for a in annotations)
+    assert {a['page'] for a in annotations} == set(range(1, 31, 3))
+    assert len({a['id'] for a in annotations}) == len(annotations)
+    assert all(a['source'] == 'pdf' for a in annotations)
+    
+    first = [a for a in annotations if a['page'] == 1]
+    assert [a['type'] for a in first] == ['highlight', 'highlight', 'rect', 'text']
+    assert (first[0]['x'], first[0]['y'], first[0]['width'], first[0]['height']) == (50, 50, 150, 12)
+    assert first[1]['y'] == 70 and first[0]['text'] == '確認 1'
+    assert first[3]['text'] == 'メモ'
+
+def test_annotation_cache(tmp_path):
+    """内容が同じPDFは別のファイル名でも同じキーで保存済みの結果を使えるかテスト"""
+    first = str(tmp_path / 'a.pdf')
+    make_reviewed_pdf(first, pages=3)
+    second = str(tmp_path / 'b.pdf')
+    with open(first, 'rb') as src, open(second, 'wb') as dst:
+        dst.write(src.read())
+    
+    cache = AnnotationCache()
+    cache_dir = str(tmp_path / 'extracted')
+    digest = cache.digest(first)
+    assert cache.load(cache_dir, digest) is None
+    cache.store(cache_dir, digest, [{'id': 'pdf_1'}])
+    assert cache.digest(second) == digest
+    assert cache.load(cache_dir, cache.digest(second)) == [{'id': 'pdf_1'}]
@@ -61,4 +61,777 @@ def test_save_annotations_validation(client):
     
     assert response.status_code == 400
     json_data = json.loads(response.data)
-    assert 'error' in json_data 
\ No newline at end of file
+    assert 'error' in json_data 
+
+def test_metrics_endpoint(client):
+    """メトリクスがPrometheus形式で出力されるかテスト"""
+    client.get('/')
+    response = client.get('/metrics')
+    
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.data.decode('utf-8')
+    assert '# TYPE pdf_annotator_request_duration_seconds histogram' in body
+    assert 'pdf_annotator_request_duration_seconds_count{route="/",method="GET",status="200"}' in body
+
+def test_metrics_apply_phases(client, sample_pdf, tmp_path):
+    """注釈適用の段階別時間が記録されるかテスト"""
+    from app import apply_annotations_to_pdf
+    annotations = [{'page': 1, 'type': 'rect', 'x': 10, 'y': 10, 'width': 50, 'height': 20}]
+    apply_annotations_to_pdf(sample_pdf, annotations, str(tmp_path / 'out.pdf'))
+    
+    body = client.get('/metrics').data.decode('utf-8')
+    for phase in ('open', 'annotate', 'save'):
+        assert f'pdf_annotator_apply_annotations_seconds_count{{phase="{phase}"}}' in body
+
+def test_profile_requires_admin_token(client, monkeypatch):
+    """管理用トークンがない場合はプロファイル一覧にアクセスできないかテスト"""
+    from app import app
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', None)
+    assert client.get('/admin/profiles').status_code == 404
+    
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', 'secret')
+    assert client.get('/admin/profiles', headers={'X-Admin-Token': 'wrong'}).status_code == 403
+
+def test_profile_on_demand(client, monkeypatch, tmp_path):
+    """X-Profileヘッダー付きのリクエストがプロファイルされるかテスト"""
+    from app import app
+    monkeypatch.setitem(app.config, 'PROFILING_ENABLED', True)
+    monkeypatch.setitem(app.config, 'PROFILE_FOLDER', str(tmp_path))
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', 'secret')
+    admin = {'X-Admin-Token': 'secret'}
+    
+    # ヘッダーなしのリクエストと、管理用トークンのないX-Profileは計測しない
+    client.get('/')
+    client.get('/', headers={'X-Profile': '1'})
+    client.get('/', headers={'X-Profile': '1', 'X-Admin-Token': 'wrong'})
+    assert client.get('/admin/profiles', headers=admin).get_json()['profiles'] == []
+    
+    response = client.get('/', headers={'X-Profile': '1', 'X-Request-ID': 'req-123', **admin})
+    assert response.headers['X-Request-ID'] == 'req-123'
+    profile_id = response.headers['X-Profile-ID']
+    assert profile_id.startswith('req-123-')
+    
+    profiles = client.get('/admin/profiles', headers=admin).get_json()['profiles']
+    assert [p['profile_id'] for p in profiles] == [profile_id]
+    assert profiles[0]['request_id'] == 'req-123'
+    assert profiles[0]['path'] == '/'
+    
+    report = client.get(f'/admin/profiles/{profile_id}.txt', headers=admin)
+    assert report.status_code == 200
+    assert b'function calls' in report.data
+    assert client.get(f'/admin/profiles/{profile_id}.collapsed', headers=admin).status_code == 200
+    assert client.get('/admin/profiles/unknown.pstats', headers=admin).status_code == 404
+    
+    # 同じリクエストIDでも以前のプロファイルを上書きしない
+    client.get('/', headers={'X-Profile': '1', 'X-Request-ID': 'req-123', **admin})
+    profiles = client.get('/admin/profiles', headers=admin).get_json()['profiles']
+    assert len(profiles) == 2 and profile_id in [p['profile_id'] for p in profiles]
+
+def test_render_page(client, sample_pdf, monkeypatch):
+    """ページ画像のレンダリングAPIのテスト"""
+    import shutil
+    import app as app_module
+    from render_service import RenderService
+    monkeypatch.setattr(app_module, 'RENDER_SERVICE', RenderService(workers=0))
+    shutil.copy(sample_pdf, os.path.join(app_module.app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    
+    response = client.get('/render/sample.pdf/1?dpi=36')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    
+    assert client.get('/render/sample.pdf/2?format=jpg').mimetype == 'image/jpeg'
+    assert client.get('/render/sample.pdf/99').status_code == 404
+    assert client.get('/render/sample.pdf/1?format=gif').status_code == 400
+    assert client.get('/render/missing.pdf/1').status_code == 404
+
+def test_export_images(client, sample_pdf, monkeypatch):
+    """ページ画像のZIPダウンロードのテスト"""
+    import shutil
+    import zipfile
+    import app as app_module
+    from render_service import RenderService
+    monkeypatch.setattr(app_module, 'RENDER_SERVICE', RenderService(workers=0))
+    shutil.copy(sample_pdf, os.path.join(app_module.app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    
+    response = client.get('/export-images/sample.pdf?dpi=36&pages=1-2')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist() == ['sample_p0001.png', 'sample_p0002.png']
+    
+    assert client.get('/export-images/sample.pdf?pages=1-9').status_code == 400
+
+def test_search_after_upload(client, sample_pdf, monkeypatch):
+    """アップロード後に作成された索引で全文検索できるかテスト"""
+    import app as app_module
+    from jobs import BackgroundJobs
+    jobs = BackgroundJobs(workers=0)
+    monkeypatch.setattr(app_module, 'BACKGROUND_JOBS', jobs)
+    
+    with open(sample_pdf, 'rb') as f:
+        response = client.post('/upload', data={'file': (f, 'spec.pdf')}, content_type='multipart/form-data')
+    assert response.status_code == 302
+    filename = response.headers['Location'].rsplit('/', 1)[-1]
+    
+    pdf_path = os.path.abspath(os.path.join(app_module.app.config['UPLOAD_FOLDER'], filename))
+    jobs.wait(('index', pdf_path), timeout=30)
+    
+    response = client.get(f'/search/{filename}?q=PDF')
+    assert response.status_code == 200
+    assert response.get_json()['results'][0]['page'] == 1
+    assert client.get(f'/search/{filename}').status_code == 400
+    jobs.shutdown()
+
+def test_search_without_index(client, sample_pdf, monkeypatch):
+    """索引がない場合は作成を開始して202を返すかテスト"""
+    import shutil
+    import app as app_module
+    from jobs import BackgroundJobs
+    jobs = BackgroundJobs(workers=0)
+    monkeypatch.setattr(app_module, 'BACKGROUND_JOBS', jobs)
+    shutil.copy(sample_pdf, os.path.join(app_module.app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    
+    response = client.get('/search/sample.pdf?q=PDF')
+    assert response.status_code == 202
+    assert response.headers['Retry-After']
+    
+    jobs.wait(('index', os.path.abspath(os.path.join(app_module.app.config['UPLOAD_FOLDER'], 'sample.pdf'))), timeout=30)
+    assert client.get('/search/sample.pdf?q=PDF').status_code == 200
+    jobs.shutdown()
+
+def test_snap_to_text(client, sample_pdf):
+    """ハイライトの矩形が単語の行ごとの矩形に吸着するかテスト"""
+    import shutil
+    from app import app
+    shutil.copy(sample_pdf, os.path.join(app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    
+    response = client.get('/snap/sample.pdf/1?x=40&y=60&width=300&height=50')
+    assert response.status_code == 200
+    lines = response.get_json()['lines']
+    assert len(lines) == 2
+    assert lines[0]['rect'][1] < lines[1]['rect'][1]
+    assert len(lines[0]['quad']) == 8
+    
+    # 単語を覆っていない矩形
+    response = client.get('/snap/sample.pdf/1?x=500&y=700&width=20&height=20')
+    assert response.get_json()['lines'] == []
+    
+    assert client.get('/snap/sample.pdf/1?x=40&y=60').status_code == 400
+    assert client.get('/snap/sample.pdf/9?x=40&y=60&width=300&height=50').status_code == 404
+
+def test_highlight_terms(client, sample_pdf):
+    """検索語の出現箇所をすべてハイライトした注釈付きPDFを作成できるかテスト"""
+    import shutil
+    import fitz
+    from app import app
+    shutil.copy(sample_pdf, os.path.join(app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    
+    response = client.post('/highlight-terms', json={'filename': 'sample.pdf', 'terms': ['PDF', 'missing']})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['success']
+    assert data['matches']['PDF'] > 0
+    assert data['matches']['missing'] == 0
+    
+    output_path = os.path.join(app.config['UPLOAD_FOLDER'], data['download_url'].rsplit('/', 1)[-1])
+    with fitz.open(output_path) as doc:
+        assert sum(1 for page in doc for _ in page.annots()) > 0
+    
+    assert client.post('/highlight-terms', json={'filename': 'sample.pdf', 'terms': []}).status_code == 400
+    # 不正な色は処理を始める前に断る
+    for color in ('yellow', '#ff', '#gggggg', '#+12345', 0xffff00):
+        response = client.post('/highlight-terms', json={'filename': 'sample.pdf', 'terms': ['PDF'], 'color': color})
+        assert response.status_code == 400
+    assert client.post('/highlight-terms', json={'filename': 'sample.pdf', 'terms': ['PDF'], 'color': '#00FF80'}).status_code == 200
+    assert client.post('/highlight-terms', json={'filename': 'none.pdf', 'terms': ['PDF']}).status_code == 404
+
+def test_thumbnails_after_upload(client, sample_pdf, monkeypatch):
+    """アップロード後に作成されたサムネイルの索引とスプライト画像を取得できるかテスト"""
+    import app as app_module
+    from jobs import BackgroundJobs
+    jobs = BackgroundJobs(workers=0)
+    monkeypatch.setattr(app_module, 'BACKGROUND_JOBS', jobs)
+    
+    with open(sample_pdf, 'rb') as f:
+        response = client.post('/upload', data={'file': (f, 'spec.pdf')}, content_type='multipart/form-data')
+    filename = response.headers['Location'].rsplit('/', 1)[-1]
+    pdf_path = os.path.abspath(os.path.join(app_module.app.config['UPLOAD_FOLDER'], filename))
+    jobs.wait(('thumbnails', pdf_path), timeout=30)
+    
+    response = client.get(f'/thumbnails/{filename}')
+    assert response.status_code == 200
+    index = response.get_json()
+    assert index['pages'] == 2
+    assert len(index['thumbs']) == 2
+    
+    response = client.get(index['sheets'][0])
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+    response.close()
+    
+    assert client.get(f'/thumbnails/{filename}/index.json').status_code == 404
+    assert client.get('/thumbnails/none.pdf').status_code == 404
+    jobs.shutdown()
+
+def test_serve_fast_web_copy(client, tmp_path, monkeypatch):
+    """ビューア用のコピーができた後はそちらが配信されるかテスト"""
+    import app as app_module
+    from jobs import BackgroundJobs
+    from test_fast_web_view import make_bloated_pdf
+    jobs = BackgroundJobs(workers=0)
+    monkeypatch.setattr(app_module, 'BACKGROUND_JOBS', jobs)
+    pdf_path = str(tmp_path / 'scan.pdf')
+    make_bloated_pdf(pdf_path)
+    
+    with open(pdf_path, 'rb') as f:
+        response = client.post('/upload', data={'file': (f, 'scan.pdf')}, content_type='multipart/form-data')
+    filename = response.headers['Location'].rsplit('/', 1)[-1]
+    upload_path = os.path.abspath(os.path.join(app_module.app.config['UPLOAD_FOLDER'], filename))
+    result = jobs.wait(('fast-web', upload_path), timeout=30)
+    assert result['path']
+    
+    response = client.get(f'/temp/{filename}')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    assert len(response.data) == result['output_bytes'] < os.path.getsize(pdf_path)
+    response.close()
+    
+    response = client.get(f'/temp/{filename}', headers={'Range': 'bytes=0-1023'})
+    assert response.status_code == 206
+    assert len(response.data) == 1024
+    response.close()
+    jobs.shutdown()
+
+def test_save_with_output_profile(client, sample_pdf):
+    """保存時に出力プロファイルを指定でき、サイズが報告されるかテスト"""
+    import shutil
+    from app import app
+    shutil.copy(sample_pdf, os.path.join(app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    annotations = [{'page': 1, 'type': 'highlight', 'x': 50, 'y': 30, 'width': 100, 'height': 20}]
+    
+    response = client.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': annotations, 'profile': 'compact'})
+    assert response.status_code == 200
+    output = response.get_json()['output']
+    assert output['profile'] == 'compact'
+    assert output['input_bytes'] == os.path.getsize(sample_pdf)
+    assert output['output_bytes'] > 0
+    
+    response = client.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': annotations, 'profile': 'unknown'})
+    assert response.status_code == 400
+    
+    body = client.get('/metrics').data.decode('utf-8')
+    assert 'pdf_annotator_output_size_ratio_count{profile="compact"}' in body
+
+
+def test_save_annotations_stream(client, sample_pdf, monkeypatch):
+    """delivery=streamで注釈付きPDFがディスクに保存されずに直接返されるかテスト"""
+    import shutil
+    import fitz
+    from app import app
+    monkeypatch.setitem(app.config, 'PDF_STREAM_CHUNK_BYTES', 1000)  # 複数回に分けて送る
+    upload_folder = app.config['UPLOAD_FOLDER']
+    shutil.copy(sample_pdf, os.path.join(upload_folder, 'sample.pdf'))
+    before = set(os.listdir(upload_folder))
+    annotations = [{'page': 1, 'type': 'highlight', 'x': 50, 'y': 30, 'width': 100, 'height': 20}]
+    
+    response = client.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': annotations, 'delivery': 'stream'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert int(response.headers['X-Output-Bytes']) == len(response.data)
+    with fitz.open('pdf', response.data) as doc:
+        assert len(list(doc[0].annots())) == 1
+    
+    # ダウンロード用のファイルも注釈データも作られない
+    assert not [name for name in set(os.listdir(upload_folder)) - before if name.startswith('annotated_')]
+    assert not os.path.exists(app.config['ANNOTATION_FOLDER']) or not os.listdir(app.config['ANNOTATION_FOLDER'])
+    
+    response = client.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': annotations, 'delivery': 'mail'})
+    assert response.status_code == 400
+
+
+def test_xfdf_export_import_and_merge(client, sample_pdf):
+    """注釈をXFDFで書き出し・読み込みし、要求時に元のPDFへ統合できるかテスト"""
+    import shutil
+    import fitz
+    from app import app
+    shutil.copy(sample_pdf, os.path.join(app.config['UPLOAD_FOLDER'], 'xfdf.pdf'))
+    
+    response = client.get('/export-annotations/xfdf.pdf')
+    assert response.status_code == 404
+    
+    annotations = [{'id': 1, 'page': 1, 'type': 'highlight', 'x': 50, 'y': 30, 'width': 100, 'height': 20, 'color': '#ffff00'}]
+    response = client.post('/save-annotations', json={'filename': 'xfdf.pdf', 'annotations': annotations})
+    assert response.status_code == 200
+    
+    response = client.get('/export-annotations/xfdf.pdf?format=xfdf')
+    assert response.status_code == 200
+    assert b'<highlight' in response.data
+    assert client.get('/export-annotations/xfdf.pdf?format=pdf').status_code == 400
+    
+    # 他のツールで追加された注釈を読み込む
+    xfdf = response.data.replace(b'</annots>', b'<square page="0" rect="100,100,200,200" color="#FF0000" name="r1"/></annots>')
+    response = client.post('/import-annotations/xfdf.pdf', data=xfdf, content_type='application/vnd.adobe.xfdf')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['imported'] == 2
+    assert [a['id'] for a in data['annotations']] == [1, 'r1']
+    
+    response = client.post('/import-annotations/xfdf.pdf', data=b'not xfdf')
+    assert response.status_code == 400
+    
+    response = client.get('/merged/xfdf.pdf')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    with fitz.open('pdf', response.data) as doc:
+        assert sorted(annot.type[1] for annot in doc[0].annots()) == ['Highlight', 'Square']
+
+
+def test_existing_annotations(client, tmp_path):
+    """PDFに含まれる注釈が返され、2回目は保存済みの結果が使われ、保存時に二重に追加されないかテスト"""
+    import fitz
+    from app import app
+    from test_annotation_extract import make_reviewed_pdf
+    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'reviewed.pdf')
+    make_reviewed_pdf(pdf_path, pages=4)
+    
+    response = client.get('/annotations/reviewed.pdf')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['cached'] is False
+    assert len(data['annotations']) == 2 * 4
+    
+    response = client.get('/annotations/reviewed.pdf')
+    assert response.get_json()['cached'] is True
+    assert response.get_json()['annotations'] == data['annotations']
+    
+    response = client.post('/save-annotations', json={'filename': 'reviewed.pdf', 'annotations': data['annotations'], 'delivery': 'stream'})
+    assert response.status_code == 200
+    with fitz.open('pdf', response.data) as doc:
+        assert len(list(doc[0].annots())) == 4
+    
+    assert client.get('/annotations/missing.pdf').status_code == 404
+
+
+def test_chunked_upload(client, sample_pdf, monkeypatch):
+    """分割アップロードで送ったPDFが検証され、ビューアで開けるかテスト"""
+    import hashlib
+    from app import app
+    monkeypatch.setitem(app.config, 'CHUNKED_UPLOAD_CHUNK_BYTES', 1024)
+    with open(sample_pdf, 'rb') as f:
+        data = f.read()
+    
+    response = client.post('/uploads', json={'filename': 'plan set.pdf', 'size': len(data)})
+    assert response.status_code == 201
+    upload = response.get_json()
+    assert upload['chunk_size'] == 1024
+    url = upload['upload_url']
+    
+    chunk_size = upload['chunk_size']
+    for offset in range(chunk_size, len(data), chunk_size):
+        chunk = data[offset:offset + chunk_size]
+        response = client.put(f'{url}?offset={offset}', data=chunk, content_type='application/octet-stream',
+                              headers={'X-Chunk-SHA256': hashlib.sha256(chunk).hexdigest()})
+        assert response.status_code == 200
+    
+    # 先頭のチャンクが欠けている間は完了できない
+    response = client.post(f'{url}/complete')
+    assert response.status_code == 409
+    assert response.get_json()['missing'] == [[0, chunk_size]]
+    
+    response = client.put(f'{url}?offset=0', data=data[:chunk_size], content_type='application/octet-stream',
+                          headers={'X-Chunk-SHA256': '0' * 64})
+    assert response.status_code == 400
+    # ハッシュのないチャンクは受け付けない
+    response = client.put(f'{url}?offset=0', data=data[:chunk_size], content_type='application/octet-stream')
+    assert response.status_code == 400
+    response = client.put(f'{url}?offset=0', data=data[:chunk_size], content_type='application/octet-stream',
+                          headers={'X-Chunk-SHA256': hashlib.sha256(data[:chunk_size]).hexdigest()})
+    assert response.get_json()['complete'] is True
+    
+    response = client.post(f'{url}/complete')
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['filename'].startswith('plan_set_') and result['filename'].endswith('.pdf')
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], result['filename']), 'rb') as f:
+        assert f.read() == data
+    assert client.get(result['view_url']).status_code == 200
+    assert client.get(url).status_code == 404
+    
+    assert client.post('/uploads', json={'filename': 'notes.txt', 'size': 10}).status_code == 400
+
+def test_chunked_upload_shared_folder(client, sample_pdf, monkeypatch, tmp_path):
+    """CHUNKED_UPLOAD_FOLDERを指定した場合、セッションをそこに置き、完了時にアップロードフォルダへ移すかテスト"""
+    import hashlib
+    from app import app
+    shared = tmp_path / 'shared-uploads'
+    monkeypatch.setitem(app.config, 'CHUNKED_UPLOAD_FOLDER', str(shared))
+    with open(sample_pdf, 'rb') as f:
+        data = f.read()
+    
+    upload = client.post('/uploads', json={'filename': 'shared.pdf', 'size': len(data)}).get_json()
+    assert os.listdir(shared) == [upload['upload_id']]
+    response = client.put(f'{upload["upload_url"]}?offset=0', data=data, content_type='application/octet-stream',
+                          headers={'X-Chunk-SHA256': hashlib.sha256(data).hexdigest()})
+    assert response.get_json()['complete'] is True
+    result = client.post(f'{upload["upload_url"]}/complete').get_json()
+    assert os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], result['filename']))
+    assert os.listdir(shared) == []
+    assert not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], '.uploads'))
+
+def test_structured_request_log(client):
+    """ログにリクエストID・ルート・ドキュメントIDと処理時間が記録されるかテスト"""
+    import uuid
+    from app import LOG_PIPELINE
+    request_id = uuid.uuid4().hex
+    response = client.get('/view/missing.pdf', headers={'X-Request-ID': request_id})
+    assert response.status_code == 404
+    
+    LOG_PIPELINE.flush()
+    with open(LOG_PIPELINE.path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if request_id in line]
+    assert len(records) == 2
+    warning, access = records
+    assert warning['level'] == 'WARNING'
+    assert warning['route'] == '/view/<filename>'
+    assert warning['document'] == 'missing.pdf'
+    assert access['status'] == 404
+    assert access['method'] == 'GET'
+    assert access['duration_ms'] >= 0
+
+def test_admission_control(client, sample_pdf, monkeypatch):
+    """重いルートが混雑している場合は503を返し、軽いルートは影響を受けないかテスト"""
+    import shutil
+    import app as app_module
+    from admission import AdmissionController
+    controller = AdmissionController({'/save-annotations': (1, 0)}, on_change=app_module._admission_changed)
+    monkeypatch.setattr(app_module, 'ADMISSION', controller)
+    shutil.copy(sample_pdf, os.path.join(app_module.app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    
+    controller.acquire('/save-annotations')  # 実行中の保存で枠が埋まっている
+    response = client.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': []})
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert client.get('/').status_code == 200
+    
+    metrics = client.get('/metrics').get_data(as_text=True)
+    assert 'pdf_annotator_admission_rejected_total{route="/save-annotations",reason="full"} 1' in metrics
+    assert 'pdf_annotator_admission_running{route="/save-annotations"} 1' in metrics
+    
+    controller.release('/save-annotations')
+    response = client.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': []})
+    assert response.status_code == 200
+    assert controller.stats()['/save-annotations']['running'] == 0
+    
+    # 保持されたコンテキストでも実行枠は1回だけ返される
+    with app_module.app.test_client() as c:
+        c.post('/save-annotations', json={'filename': 'x.pdf', 'annotations': []})
+    assert controller.stats()['/save-annotations']['running'] == 0
+
+def test_concurrent_saves_are_coalesced(client, sample_pdf, monkeypatch):
+    """同じPDFへの同時の保存がまとめられ、連続した保存のファイル名が重ならないかテスト"""
+    import shutil
+    import threading
+    import app as app_module
+    from app import app
+    from admission import AdmissionController
+    upload_folder = app.config['UPLOAD_FOLDER']
+    shutil.copy(sample_pdf, os.path.join(upload_folder, 'sample.pdf'))
+    
+    # 連続して保存しても別々のファイルになる
+    urls = [client.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': []}).get_json()['download_url']
+            for _ in range(2)]
+    assert urls[0] != urls[1]
+    assert len(os.listdir(app.config['ANNOTATION_FOLDER'])) == 2
+    
+    # 保存の実行中に届いた保存は最新の内容で1回にまとめられる
+    original = app_module.apply_annotations_to_pdf
+    started = threading.Event()
+    release = threading.Event()
+    applied = []
+    def slow_apply(pdf_path, annotations, output_path, profile):
+        applied.append(len(annotations))
+        started.set()
+        release.wait(5)
+        return original(pdf_path, annotations, output_path, profile)
+    monkeypatch.setattr(app_module, 'apply_annotations_to_pdf', slow_apply)
+    monkeypatch.setattr(app_module, 'ADMISSION', AdmissionController({}))  # 同時実行数の制限は外す
+    
+    results = {}
+    def save(count):
+        with app.test_client() as c:
+            annotations = [{'page': 1, 'type': 'highlight', 'x': 10 * i, 'y': 30, 'width': 5, 'height': 5} for i in range(count)]
+            results[count] = c.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': annotations}).get_json()
+    key = ('api', os.path.abspath(os.path.join(upload_folder, 'sample.pdf')), app.config['OUTPUT_PROFILE'], 'file')
+    first = threading.Thread(target=save, args=(1,))
+    first.start()
+    started.wait(5)
+    waiters = []
+    for count in (2, 3):
+        waiters.append(threading.Thread(target=save, args=(count,)))
+        waiters[-1].start()
+        while app_module.SAVE_COALESCER.pending(key) < count - 1:
+            threading.Event().wait(0.001)
+    release.set()
+    for thread in [first] + waiters:
+        thread.join(10)
+    
+    assert applied == [1, 3]
+    assert results[1]['coalesced'] == 1
+    assert results[2]['download_url'] == results[3]['download_url'] != results[1]['download_url']
+    assert results[3]['coalesced'] == 2
+
+def test_collab_and_api_saves_are_not_coalesced(client, sample_pdf, monkeypatch):
+    """同じPDFでも操作ログからの保存とビューアからの保存はまとめられず、それぞれの内容で保存されるかテスト"""
+    import shutil
+    import threading
+    import app as app_module
+    from app import app
+    from admission import AdmissionController
+    shutil.copy(sample_pdf, os.path.join(app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    monkeypatch.setattr(app_module, 'ADMISSION', AdmissionController({}))
+    annotation = {'id': 'c', 'type': 'rect', 'page': 1, 'x': 10, 'y': 20, 'width': 30, 'height': 40}
+    client.post('/collab/sample.pdf/ops', json={'ops': [{'op': 'add', 'annotation': annotation}]})
+    
+    original = app_module.apply_annotations_to_pdf
+    release = threading.Event()
+    applied = []
+    def slow_apply(pdf_path, annotations, output_path, profile):
+        applied.append(len(annotations))
+        if len(annotations) == 3:
+            release.wait(5)
+        return original(pdf_path, annotations, output_path, profile)
+    monkeypatch.setattr(app_module, 'apply_annotations_to_pdf', slow_apply)
+    
+    results = {}
+    def save_api():
+        with app.test_client() as c:
+            annotations = [dict(annotation, id=str(i)) for i in range(3)]
+            results['api'] = c.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': annotations}).get_json()
+    api = threading.Thread(target=save_api)
+    api.start()
+    while applied != [3]:
+        threading.Event().wait(0.001)
+    
+    # ビューアからの保存の実行中でも待たずに、操作ログの内容で保存される
+    response = client.post('/collab/sample.pdf/save')
+    release.set()
+    api.join(10)
+    
+    assert applied == [3, 1]
+    assert response.get_json()['coalesced'] == 1
+    assert results['api']['coalesced'] == 1
+    assert response.get_json()['download_url'] != results['api']['download_url']
+
+def test_coalesced_saves_do_not_use_admission_slots(client, sample_pdf, monkeypatch):
+    """同時実行数を超える同じPDFへの保存が断られずにまとめられ、ほかのPDFの保存も妨げないかテスト"""
+    import shutil
+    import threading
+    import app as app_module
+    from app import app
+    from admission import AdmissionController
+    upload_folder = app.config['UPLOAD_FOLDER']
+    for name in ('sample.pdf', 'other.pdf'):
+        shutil.copy(sample_pdf, os.path.join(upload_folder, name))
+    concurrency = 2
+    controller = AdmissionController({'/save-annotations': (concurrency, 0)})
+    monkeypatch.setattr(app_module, 'ADMISSION', controller)
+    
+    original = app_module.apply_annotations_to_pdf
+    started = threading.Event()
+    release = threading.Event()
+    applied = []
+    def slow_apply(pdf_path, annotations, output_path, profile):
+        applied.append((os.path.basename(pdf_path), len(annotations)))
+        if os.path.basename(pdf_path) == 'sample.pdf':
+            started.set()
+            release.wait(5)
+        return original(pdf_path, annotations, output_path, profile)
+    monkeypatch.setattr(app_module, 'apply_annotations_to_pdf', slow_apply)
+    
+    results = {}
+    def save(filename, count):
+        with app.test_client() as c:
+            annotations = [{'page': 1, 'type': 'highlight', 'x': 10 * i, 'y': 30, 'width': 5, 'height': 5} for i in range(count)]
+            response = c.post('/save-annotations', json={'filename': filename, 'annotations': annotations})
+            results[(filename, count)] = (response.status_code, response.get_json())
+    key = ('api', os.path.abspath(os.path.join(upload_folder, 'sample.pdf')), app.config['OUTPUT_PROFILE'], 'file')
+    threads = [threading.Thread(target=save, args=('sample.pdf', 1))]
+    threads[0].start()
+    started.wait(5)
+    # 実行中の保存の後ろに同時実行数より多くの保存が届いても、待機中の1つにまとめられる
+    for count in range(2, concurrency + 4):
+        threads.append(threading.Thread(target=save, args=('sample.pdf', count)))
+        threads[-1].start()
+        while app_module.SAVE_COALESCER.pending(key) < count - 1:
+            threading.Event().wait(0.001)
+    assert controller.stats()['/save-annotations']['running'] == 1
+    # ほかのPDFの保存は枠を使って実行できる
+    save('other.pdf', 1)
+    assert results[('other.pdf', 1)][0] == 200
+    release.set()
+    for thread in threads:
+        thread.join(10)
+    
+    statuses = {status for status, _ in results.values()}
+    assert statuses == {200}
+    assert [a for a in applied if a[0] == 'sample.pdf'] == [('sample.pdf', 1), ('sample.pdf', concurrency + 3)]
+    assert results[('sample.pdf', concurrency + 3)][1]['coalesced'] == concurrency + 2
+    assert controller.stats()['/save-annotations']['running'] == 0
+
+def test_collab_operations_and_events(client, sample_pdf, monkeypatch):
+    """共同編集の操作が操作ログに追記され、イベントストリームで配信されるかテスト"""
+    import shutil
+    from app import app
+    shutil.copy(sample_pdf, os.path.join(app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    monkeypatch.setitem(app.config, 'COLLAB_STREAM_SECONDS', 0.2)
+    annotation = {'id': 1, 'type': 'rect', 'page': 1, 'x': 10, 'y': 20, 'width': 30, 'height': 40}
+    
+    # 最初は最後に保存した注釈から始まる
+    client.post('/save-annotations', json={'filename': 'sample.pdf', 'annotations': [dict(annotation, id='saved')]})
+    state = client.get('/collab/sample.pdf/state').get_json()
+    assert state == {'seq': 0, 'annotations': [dict(annotation, id='saved')]}
+    
+    response = client.post('/collab/sample.pdf/ops', json={'client': 'a', 'ops': [
+        {'op': 'add', 'annotation': annotation},
+        {'op': 'delete', 'id': 'saved'},
+    ]})
+    assert response.get_json() == {'seq': 2, 'count': 2}
+    assert client.post('/collab/sample.pdf/ops', json={'ops': [{'op': 'move'}]}).status_code == 400
+    assert client.get('/collab/missing.pdf/state').status_code == 404
+    
+    # 番号を指定しない場合は現在の状態（reset）から
+    response = client.get('/collab/sample.pdf/events')
+    assert response.mimetype == 'text/event-stream'
+    body = response.get_data(as_text=True)
+    assert 'event: reset' in body
+    assert 'id: 2\n' in body
+    
+    # Last-Event-IDの続きの操作だけが送られる
+    body = client.get('/collab/sample.pdf/events', headers={'Last-Event-ID': '1'}).get_data(as_text=True)
+    events = [block for block in body.split('\n\n') if 'event: op' in block]
+    assert len(events) == 1
+    record = json.loads(events[0].split('data: ', 1)[1])
+    assert record['seq'] == 2 and record['op'] == 'delete' and record['client'] == 'a'
+    
+    # 操作ログの内容で保存する（ビューアは一覧全体を送らない）
+    response = client.post('/collab/sample.pdf/save')
+    assert response.status_code == 200
+    assert response.headers['X-Collab-Seq'] == '2'
+    result = response.get_json()
+    assert result['success'] and result['download_url'].endswith('.pdf')
+    from app import load_latest_annotations
+    assert load_latest_annotations('sample.pdf') == [annotation]
+    response = client.post('/collab/sample.pdf/save', json={'delivery': 'stream'})
+    assert response.mimetype == 'application/pdf'
+    assert client.post('/collab/sample.pdf/save', json={'profile': 'huge'}).status_code == 400
+
+def test_collab_shared_folder(client, sample_pdf, monkeypatch, tmp_path):
+    """COLLAB_FOLDERを指定した場合、操作ログをそこに置き、同じフォルダを開いた別のノードから同じ状態が読めるかテスト"""
+    import shutil
+    from app import app
+    from collab import DocumentLog
+    shared = tmp_path / 'shared-collab'
+    monkeypatch.setitem(app.config, 'COLLAB_FOLDER', str(shared))
+    shutil.copy(sample_pdf, os.path.join(app.config['UPLOAD_FOLDER'], 'shared.pdf'))
+    annotation = {'id': 'a', 'type': 'rect', 'page': 1, 'x': 10, 'y': 20, 'width': 30, 'height': 40}
+    
+    response = client.post('/collab/shared.pdf/ops', json={'ops': [{'op': 'add', 'annotation': annotation}]})
+    assert response.get_json()['seq'] == 1
+    assert os.listdir(shared) == ['shared.pdf']
+    assert DocumentLog(str(shared / 'shared.pdf')).state() == (1, [annotation])
+
+def test_collab_events_subscriber_limit(client, sample_pdf, monkeypatch):
+    """イベントストリームの接続数が上限に達したら503を返し、閉じたストリームの枠が返されるかテスト"""
+    import shutil
+    import app as app_module
+    from app import app
+    from collab import StreamSlots
+    COLLAB_STREAMS = StreamSlots()
+    monkeypatch.setattr(app_module, 'COLLAB_STREAMS', COLLAB_STREAMS)
+    shutil.copy(sample_pdf, os.path.join(app.config['UPLOAD_FOLDER'], 'sample.pdf'))
+    monkeypatch.setitem(app.config, 'COLLAB_STREAM_SECONDS', 0.1)
+    monkeypatch.setitem(app.config, 'COLLAB_MAX_SUBSCRIBERS', 1)
+    
+    # 別のストリームが枠を使っている間は断る
+    assert COLLAB_STREAMS.acquire(1)
+    try:
+        response = client.get('/collab/sample.pdf/events')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+    finally:
+        COLLAB_STREAMS.release()
+    
+    response = client.get('/collab/sample.pdf/events')
+    assert response.status_code == 200
+    assert 'event: reset' in response.get_data(as_text=True)
+    response.close()
+    assert COLLAB_STREAMS.active == 0
+
+def test_storage_backend_shared_between_nodes(client, sample_pdf, monkeypatch):
+    """保存先に送ったPDFと注釈を、ローカルフォルダにないノードでも使えるかテスト"""
+    import app as app_module
+    from app import app
+    from jobs import BackgroundJobs
+    from storage import MemoryStorage
+    monkeypatch.setattr(app_module, 'STORAGE', MemoryStorage())
+    monkeypatch.setattr(app_module, 'BACKGROUND_JOBS', BackgroundJobs(workers=0))
+    
+    with open(sample_pdf, 'rb') as f:
+        response = client.post('/upload', data={'file': (f, 'shared.pdf')}, content_type='multipart/form-data')
+    assert response.status_code == 302
+    filename = response.headers['Location'].rsplit('/', 1)[-1]
+    annotation = {'id': 'a', 'page': 1, 'type': 'highlight', 'x': 10, 'y': 30, 'width': 50, 'height': 10}
+    response = client.post('/save-annotations', json={'filename': filename, 'annotations': [annotation]})
+    download_url = response.get_json()['download_url']
+    assert app_module.STORAGE.list('documents/') == sorted(['documents/' + filename, 'documents/' + download_url.rsplit('/', 1)[-1]])
+    assert len(app_module.STORAGE.list('annotations/')) == 1
+    
+    # 別のノード（ローカルフォルダが空）として同じファイルを使う
+    app_module.DOCUMENT_POOL.clear()
+    for folder in (app.config['UPLOAD_FOLDER'], app.config['ANNOTATION_FOLDER']):
+        for name in os.listdir(folder):
+            if os.path.isfile(os.path.join(folder, name)):
+                os.remove(os.path.join(folder, name))
+    
+    assert client.get(f'/view/{filename}').status_code == 200
+    response = client.get(download_url)
+    assert response.status_code == 200
+    assert response.data.startswith(b'%PDF')
+    response.close()
+    response = client.get(f'/merged/{filename}')
+    assert response.status_code == 200
+    response.close()
+    assert client.get('/view/missing.pdf').status_code == 404
+
+def test_requests_in_progress_returns_to_zero(client):
+    """保持されたコンテキストでも処理中のリクエスト数が1回だけ減らされるかテスト"""
+    import app as app_module
+    before = app_module.REQUESTS_IN_PROGRESS.get(route='/')
+    with app_module.app.test_client() as c:
+        c.get('/')
+        c.get('/')
+    assert app_module.REQUESTS_IN_PROGRESS.get(route='/') == before
+
+def test_search_reports_total_before_limit(client):
+    """limitで切り詰めた場合も一致したページの総数と切り詰めたことを返すかテスト"""
+    import fitz
+    import app as app_module
+    from search_index import write_index
+    pdf_path = os.path.abspath(os.path.join(app_module.app.config['UPLOAD_FOLDER'], 'pages.pdf'))
+    doc = fitz.open()
+    for _ in range(3):
+        doc.new_page().insert_text((72, 72), 'gasket')
+    doc.save(pdf_path)
+    doc.close()
+    write_index(pdf_path)
+    
+    data = client.get('/search/pages.pdf?q=gasket').get_json()
+    assert len(data['results']) == 3 and data['total_pages'] == 3 and data['truncated'] is False
+    data = client.get('/search/pages.pdf?q=gasket&limit=1').get_json()
+    assert [r['page'] for r in data['results']] == [1]
+    assert data['total_pages'] == 3 and data['truncated'] is True
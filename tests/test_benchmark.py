@@ -0,0 +1,24 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from benchmark import run_benchmarks, percentile, OPERATIONS
+
+def test_percentile():
+    """パーセンタイル計算のテスト"""
+    values = [1, 2, 3, 4, 5]
+    assert percentile(values, 50) == 3
+    assert percentile(values, 0) == 1
+    assert percentile(values, 100) == 5
+    assert percentile([7], 99) == 7
+
+def test_run_benchmarks_smoke():
+    """小さなPDFでベンチマークが全操作を計測できるかテスト"""
+    report = run_benchmarks([2], [1], iterations=2)
+    
+    assert report['environment']['python']
+    assert [r['operation'] for r in report['results']] == list(OPERATIONS)
+    for r in report['results']:
+        assert r['pages'] == 2
+        assert r['annotations'] == 2
+        assert r['iterations'] == 2
+        assert r['latency']['p50'] > 0
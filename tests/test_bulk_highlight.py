@@ -0,0 +1,56 @@
+import os
+import sys
+import fitz  # PyMuPDF
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_highlight import normalize_terms, find_occurrences, highlight_terms
+from render_service import RenderService
+
+def _make_manual(path, pages=60):
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((50, 60), f"Section {i + 1}", fontsize=12)
+        if i % 7 == 0:
+            page.insert_text((50, 100), "Replace PN-1234 and PN-1234 gasket.", fontsize=12)
+        if i % 10 == 0:
+            page.insert_text((50, 140), "Torque PN-5678 to spec.", fontsize=12)
+    doc.save(path)
+    doc.close()
+
+def test_normalize_terms():
+    """空の語と重複が取り除かれるかテスト"""
+    assert normalize_terms([' PN-1234 ', '', 'PN-1234', 'PN-5678']) == ['PN-1234', 'PN-5678']
+
+def test_find_occurrences(tmp_path):
+    """ワーカープロセスに分散した検索結果がページ順に集まるかテスト"""
+    pdf_path = str(tmp_path / 'manual.pdf')
+    _make_manual(pdf_path)
+    
+    service = RenderService(workers=2)
+    try:
+        found = find_occurrences(service, pdf_path, 60, ['PN-1234', 'PN-5678'], pages_per_task=8)
+    finally:
+        service.shutdown()
+    
+    pages_1234 = [page for page, term, _ in found if term == 'PN-1234']
+    assert pages_1234 == list(range(0, 60, 7))
+    assert all(len(quads) == 2 for _, term, quads in found if term == 'PN-1234')
+    assert [page for page, term, _ in found if term == 'PN-5678'] == list(range(0, 60, 10))
+    assert [page for page, _, _ in found] == sorted(page for page, _, _ in found)
+
+def test_highlight_terms(tmp_path):
+    """全ページの出現箇所がハイライトされて1つのファイルに保存されるかテスト"""
+    pdf_path = str(tmp_path / 'manual.pdf')
+    output_path = str(tmp_path / 'manual_highlighted.pdf')
+    _make_manual(pdf_path, pages=15)
+    
+    result = highlight_terms(pdf_path, ['PN-1234', 'missing'], output_path, workers=0)
+    assert result['matches'] == {'PN-1234': 6, 'missing': 0}
+    assert result['pages'] == 3
+    assert result['output']['output_bytes'] == os.path.getsize(output_path)
+    
+    with fitz.open(output_path) as doc:
+        annots = [(annot.type[0], annot.info['content'], len(annot.vertices))
+                  for page in doc for annot in page.annots()]
+    # ページごとに1つのハイライト（2箇所 x 4点）
+    assert annots == [(8, 'PN-1234', 8)] * 3
@@ -0,0 +1,124 @@
+import hashlib
+import io
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chunked_upload import (ChunkedUploads, UploadError, UploadNotFound, ChunkHashMismatch,
+                            UploadIncomplete, UploadConflict, merge_ranges, missing_ranges)
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def test_ranges():
+    """受信済みの範囲がまとめられ、未受信の範囲が求められるかテスト"""
+    received = merge_ranges([(10, 20), (0, 5), (5, 8), (15, 30)])
+    assert received == [[0, 8], [10, 30]]
+    assert missing_ranges(received, 40) == [[8, 10], [30, 40]]
+    assert missing_ranges([], 4) == [[0, 4]]
+
+def test_out_of_order_chunks(tmp_path):
+    """順不同に届いたチャンクが該当位置に書き込まれ、完了時に元のファイルと一致するかテスト"""
+    data = os.urandom(100_000)
+    uploads = ChunkedUploads(str(tmp_path / 'uploads'), max_size=1_000_000, chunk_size=30_000)
+    upload_id = uploads.create('plan.pdf', len(data), sha256=_sha256(data))['upload_id']
+    
+    chunks = [(offset, data[offset:offset + 30_000]) for offset in range(0, len(data), 30_000)]
+    for offset, chunk in reversed(chunks[1:]):
+        uploads.write_chunk(upload_id, offset, io.BytesIO(chunk), len(chunk), sha256=_sha256(chunk))
+    status = uploads.status(upload_id)
+    assert status['missing'] == [[0, 30_000]]
+    assert not status['complete']
+    with pytest.raises(UploadIncomplete):
+        uploads.finalize(upload_id, str(tmp_path / 'plan.pdf'))
+    
+    # ハッシュが一致しないチャンクは受信済みにならない
+    with pytest.raises(ChunkHashMismatch):
+        uploads.write_chunk(upload_id, 0, io.BytesIO(b'x' * 30_000), 30_000, sha256=_sha256(chunks[0][1]))
+    assert uploads.status(upload_id)['missing'] == [[0, 30_000]]
+    
+    status = uploads.write_chunk(upload_id, 0, io.BytesIO(chunks[0][1]), 30_000, sha256=_sha256(chunks[0][1]))
+    assert status['complete'] and status['received_bytes'] == len(data)
+    assert uploads.finalize(upload_id, str(tmp_path / 'plan.pdf')) == 'plan.pdf'
+    with open(tmp_path / 'plan.pdf', 'rb') as f:
+        assert f.read() == data
+    with pytest.raises(UploadNotFound):
+        uploads.status(upload_id)
+
+def test_invalid_requests(tmp_path):
+    """上限を超えるサイズ、範囲外のチャンク、不正なIDが拒否され、期限切れのセッションが削除されるかテスト"""
+    uploads = ChunkedUploads(str(tmp_path / 'uploads'), max_size=1000, ttl=60)
+    with pytest.raises(UploadError):
+        uploads.create('big.pdf', 1001)
+    upload_id = uploads.create('small.pdf', 100)['upload_id']
+    with pytest.raises(UploadError):
+        uploads.write_chunk(upload_id, 90, io.BytesIO(b'x' * 20), 20)
+    with pytest.raises(UploadError):
+        uploads.write_chunk(upload_id, 0, io.BytesIO(b'x' * 10), 20, sha256=_sha256(b'x' * 20))
+    with pytest.raises(UploadError):
+        uploads.write_chunk(upload_id, 0, io.BytesIO(b'x' * 20), 20)
+    assert uploads.status(upload_id)['received_bytes'] == 0
+    with pytest.raises(UploadNotFound):
+        uploads.status('../' + upload_id)
+    
+    import time
+    assert uploads.purge_expired(now=time.time() + 30) == 0
+    assert uploads.purge_expired(now=time.time() + 120) == 1
+    with pytest.raises(UploadNotFound):
+        uploads.status(upload_id)
+
+def test_concurrent_finalize(tmp_path, monkeypatch):
+    """同じアップロードの完了要求が並行した場合、1つだけが進み、ほかは UploadConflict になるかテスト"""
+    import shutil
+    import threading
+    import chunked_upload
+    data = os.urandom(1000)
+    uploads = ChunkedUploads(str(tmp_path / 'uploads'), max_size=10_000)
+    upload_id = uploads.create('plan.pdf', len(data))['upload_id']
+    uploads.write_chunk(upload_id, 0, io.BytesIO(data), len(data), sha256=_sha256(data))
+    
+    moving = threading.Event()
+    release = threading.Event()
+    move = shutil.move
+    def slow_move(src, dst):
+        moving.set()
+        release.wait(10)
+        return move(src, dst)
+    monkeypatch.setattr(chunked_upload.shutil, 'move', slow_move)
+    results = []
+    winner = threading.Thread(target=lambda: results.append(uploads.finalize(upload_id, str(tmp_path / 'a.pdf'))))
+    winner.start()
+    assert moving.wait(10)
+    
+    with pytest.raises(UploadConflict):
+        uploads.finalize(upload_id, str(tmp_path / 'b.pdf'))
+    with pytest.raises(UploadConflict):
+        uploads.status(upload_id)
+    release.set()
+    winner.join(10)
+    
+    assert results == ['plan.pdf']
+    with open(tmp_path / 'a.pdf', 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(tmp_path / 'b.pdf')
+    assert os.listdir(tmp_path / 'uploads') == []
+
+def test_corrupt_resend_keeps_received_bytes(tmp_path):
+    """受信済みの範囲に重なる壊れたチャンクを送っても、書き込み済みの内容が変わらないかテスト"""
+    data = os.urandom(2000)
+    uploads = ChunkedUploads(str(tmp_path / 'uploads'), max_size=10_000, chunk_size=1000)
+    upload_id = uploads.create('plan.pdf', len(data), sha256=_sha256(data))['upload_id']
+    for offset in (0, 1000):
+        chunk = data[offset:offset + 1000]
+        uploads.write_chunk(upload_id, offset, io.BytesIO(chunk), len(chunk), sha256=_sha256(chunk))
+    
+    # チャンクの大きさを超える（一時ファイルに受け取る）壊れたチャンク
+    with pytest.raises(ChunkHashMismatch):
+        uploads.write_chunk(upload_id, 500, io.BytesIO(b'x' * 1500), 1500, sha256=_sha256(data[500:]))
+    with pytest.raises(ChunkHashMismatch):
+        uploads.write_chunk(upload_id, 0, io.BytesIO(b'x' * 100), 100, sha256=_sha256(data[:100]))
+    
+    assert uploads.status(upload_id)['complete']
+    uploads.finalize(upload_id, str(tmp_path / 'plan.pdf'))
+    with open(tmp_path / 'plan.pdf', 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import threading
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from collab import DocumentLog, CollabLogs, OperationError, StreamSlots, SNAPSHOT_NAME, LOG_NAME
+
+def rect(id, x=10):
+    return {'id': id, 'type': 'rect', 'page': 1, 'x': x, 'y': 20, 'width': 30, 'height': 40}
+
+def test_operations_are_applied_in_order(tmp_path):
+    """追加・更新・削除がログの順に適用されるかテスト"""
+    log = DocumentLog(str(tmp_path / 'doc'), seed=lambda: [rect('saved')])
+    assert log.state() == (0, [rect('saved')])
+    
+    records = log.append([{'op': 'add', 'annotation': rect(1)}, {'op': 'add', 'annotation': rect(2)}], client='a')
+    assert [r['seq'] for r in records] == [1, 2]
+    log.append([{'op': 'update', 'annotation': rect(1, x=99)}, {'op': 'delete', 'id': 'saved'}], client='b')
+    
+    seq, annotations = log.state()
+    assert seq == 4
+    assert annotations == [rect(1, x=99), rect(2)]
+    assert [r['op'] for r in log.since(2)] == ['update', 'delete']
+    assert log.since(10) is None
+
+def test_invalid_operations(tmp_path):
+    """不正な操作はログに書かれないかテスト"""
+    log = DocumentLog(str(tmp_path / 'doc'))
+    for ops in ([], [{'op': 'move'}], [{'op': 'add', 'annotation': {'x': 1}}], [{'op': 'delete'}]):
+        with pytest.raises(OperationError):
+            log.append(ops)
+    assert log.state() == (0, [])
+
+def test_compaction(tmp_path):
+    """ログが溜まるとスナップショットにまとめられ、古い番号からはリセットになるかテスト"""
+    folder = tmp_path / 'doc'
+    log = DocumentLog(str(folder), compact_every=3)
+    for i in range(4):
+        log.append([{'op': 'add', 'annotation': rect(i)}])
+    
+    with open(folder / SNAPSHOT_NAME, encoding='utf-8') as f:
+        snapshot = json.load(f)
+    assert snapshot['seq'] == 3 and snapshot['generation'] == 1
+    # 1行目は世代
+    lines = (folder / LOG_NAME).read_text(encoding='utf-8').splitlines()
+    assert json.loads(lines[0]) == {'generation': 1}
+    assert len(lines) == 2
+    assert log.since(1) is None
+    assert [r['seq'] for r in log.since(3)] == [4]
+    
+    # 後から開いたログ（別のプロセス）もスナップショットと残りのログから同じ状態になる
+    assert DocumentLog(str(folder)).state() == log.state()
+
+def test_compaction_reports_snapshot(tmp_path):
+    """コンパクションのたびにスナップショットが呼び出し側に渡されるかテスト"""
+    snapshots = []
+    log = DocumentLog(str(tmp_path / 'doc'), compact_every=2, on_compact=lambda *snapshot: snapshots.append(snapshot))
+    log.append([{'op': 'add', 'annotation': rect(1)}])
+    assert snapshots == []
+    log.append([{'op': 'add', 'annotation': rect(2)}])
+    assert snapshots == [(2, [rect(1), rect(2)])]
+    log.append([{'op': 'delete', 'id': '1'}])
+    log.compact()
+    assert snapshots[-1] == (3, [rect(2)])
+
+def test_compaction_by_other_process_is_detected(tmp_path):
+    """別のプロセスのコンパクションをログの世代で検知して、スナップショットから読み直すかテスト"""
+    folder = str(tmp_path / 'doc')
+    first = DocumentLog(folder)
+    second = DocumentLog(folder)
+    first.append([{'op': 'add', 'annotation': rect(1)}, {'op': 'add', 'annotation': rect(2)}])
+    assert second.state()[0] == 2
+    
+    # 読んだ位置より短いログに置き換わっても、世代が変わるので取りこぼさない
+    second.compact()
+    second.append([{'op': 'delete', 'id': '1'}])
+    second.compact()
+    assert first.since(1) is None
+    assert first.state() == second.state() == (3, [rect(2)])
+    
+    first.append([{'op': 'add', 'annotation': rect(3)}])
+    assert second.state() == (4, [rect(2), rect(3)])
+
+def test_appends_from_other_process_are_seen(tmp_path):
+    """別のプロセスが追記した操作を読み進めて番号が重ならないかテスト"""
+    folder = str(tmp_path / 'doc')
+    first = DocumentLog(folder, compact_every=2)
+    second = DocumentLog(folder, compact_every=2)
+    first.append([{'op': 'add', 'annotation': rect(1)}])
+    records = second.append([{'op': 'add', 'annotation': rect(2)}])
+    assert records[0]['seq'] == 2
+    first.append([{'op': 'add', 'annotation': rect(3)}])
+    
+    assert second.state() == first.state() == (3, [rect(1), rect(2), rect(3)])
+
+def test_wait_wakes_up_on_append(tmp_path):
+    """待っている間に追記された操作がすぐに返されるかテスト"""
+    log = DocumentLog(str(tmp_path / 'doc'))
+    log.state()
+    timer = threading.Timer(0.05, lambda: log.append([{'op': 'add', 'annotation': rect(1)}]))
+    timer.start()
+    records = log.wait(0, timeout=5)
+    timer.join()
+    
+    assert [r['seq'] for r in records] == [1]
+    assert log.wait(1, timeout=0.01) == []
+
+def test_one_tailer_wakes_all_waiters(tmp_path):
+    """別のプロセスの追記を1つのテイラーが検知して、待っている配信をすべて起こすかテスト"""
+    folder = str(tmp_path / 'tailed')
+    log = DocumentLog(folder, tail_interval=0.01)
+    other = DocumentLog(folder)  # 別のプロセスのログ
+    log.state()
+    
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(log.wait(0, timeout=5))) for _ in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    while log.waiters < 3:
+        threading.Event().wait(0.01)
+    tailers = [t for t in threading.enumerate() if t.name == 'collab-tail-tailed']
+    assert len(tailers) == 1
+    
+    other.append([{'op': 'add', 'annotation': rect(1)}])
+    for waiter in waiters:
+        waiter.join()
+    assert [[r['seq'] for r in records] for records in results] == [[1], [1], [1]]
+    # 待っている配信がなくなるとテイラーも止まる
+    tailers[0].join(timeout=1)
+    assert not tailers[0].is_alive()
+
+def test_stream_slots():
+    """イベントストリームの同時接続数が上限を超えないかテスト"""
+    slots = StreamSlots()
+    assert slots.acquire(2) and slots.acquire(2)
+    assert not slots.acquire(2)
+    slots.release()
+    assert slots.active == 1
+    assert slots.acquire(2)
+
+def test_logs_are_reused(tmp_path):
+    """同じフォルダのログは使い回されるかテスト"""
+    logs = CollabLogs(max_documents=1)
+    first = logs.get(str(tmp_path / 'a'))
+    assert logs.get(str(tmp_path / 'a')) is first
+    logs.get(str(tmp_path / 'b'))
+    assert logs.get(str(tmp_path / 'a')) is not first
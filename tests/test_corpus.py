@@ -0,0 +1,47 @@
+import os
+import sys
+import json
+import hashlib
+import fitz  # PyMuPDF
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from create_sample_pdf import create_corpus_pdf, create_annotation_payload, create_corpus
+
+def _digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def test_corpus_pdf_is_deterministic(tmp_path):
+    """同じシードから同じPDFが作成されるかテスト"""
+    options = dict(pages=4, seed=7, cjk=True, scan_every=2, scan_size=(120, 160),
+                   vector_shapes=20, annotations_per_page=3)
+    first = create_corpus_pdf(str(tmp_path / 'a.pdf'), **options)
+    second = create_corpus_pdf(str(tmp_path / 'b.pdf'), **options)
+    
+    assert _digest(first['path']) == _digest(second['path'])
+    assert first['scan_pages'] == 2
+    
+    doc = fitz.open(first['path'])
+    assert len(doc) == 4
+    assert len(list(doc[0].annots())) == 3
+    assert doc[1].get_images()
+    assert '図面' in doc[0].get_text() or '仕様' in doc[0].get_text()
+    doc.close()
+
+def test_annotation_payload():
+    """注釈データがビューアーの形式で作成されるかテスト"""
+    payload = create_annotation_payload(3, 2, seed=1)
+    
+    assert len(payload) == 6
+    assert payload == create_annotation_payload(3, 2, seed=1)
+    assert {a['page'] for a in payload} == {1, 2, 3}
+    assert {'type', 'x', 'y', 'width', 'height', 'color'} <= set(payload[0])
+
+def test_create_corpus_manifest(tmp_path):
+    """コーパスのmanifest.jsonが作成されるかテスト"""
+    manifest = create_corpus(str(tmp_path), profiles=['text_small'], payload_density=(0, 2), scale=0.2)
+    
+    with open(tmp_path / 'manifest.json', encoding='utf-8') as f:
+        assert json.load(f) == manifest
+    entry = manifest['documents'][0]
+    assert entry['pages'] == 2
+    assert (tmp_path / entry['payloads']['2']).exists()
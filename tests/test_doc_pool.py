@@ -0,0 +1,123 @@
+import os
+import sys
+import shutil
+import fitz  # PyMuPDF
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from doc_pool import DocumentPool
+
+@pytest.fixture
+def pdf_copy(sample_pdf, tmp_path):
+    path = tmp_path / 'sample.pdf'
+    shutil.copy(sample_pdf, path)
+    return str(path)
+
+def test_checkout_reuses_handle(pdf_copy):
+    """2回目の貸し出しで同じハンドルが再利用されるかテスト"""
+    results = []
+    pool = DocumentPool(on_checkout=results.append)
+    with pool.checkout(pdf_copy) as first:
+        pass
+    with pool.checkout(pdf_copy) as second:
+        assert second is first
+    
+    assert results == ['miss', 'hit']
+    assert len(pool) == 1
+    pool.clear()
+
+def test_modified_handle_is_discarded(pdf_copy):
+    """変更されたハンドルはプールに戻さず、次の貸し出しで開き直すかテスト"""
+    results = []
+    pool = DocumentPool(on_checkout=results.append)
+    with pool.checkout(pdf_copy) as doc:
+        doc[0].add_rect_annot(fitz.Rect(10, 10, 50, 50))
+    assert len(pool) == 0
+    
+    with pool.checkout(pdf_copy) as doc:
+        assert len(list(doc[0].annots())) == 0
+    assert results == ['miss', 'miss']
+    pool.clear()
+
+def test_busy_handle_uses_private_document(pdf_copy):
+    """使用中のハンドルを要求した場合は別のハンドルが返されるかテスト"""
+    results = []
+    pool = DocumentPool(on_checkout=results.append)
+    with pool.checkout(pdf_copy) as first:
+        with pool.checkout(pdf_copy) as second:
+            assert second is not first
+            assert len(second) == len(first)
+    
+    assert results == ['miss', 'busy']
+    pool.clear()
+
+def test_modified_file_is_reopened(pdf_copy):
+    """ファイルが更新された場合は開き直すかテスト"""
+    results = []
+    pool = DocumentPool(on_checkout=results.append)
+    with pool.checkout(pdf_copy) as doc:
+        page_count = len(doc)
+    
+    with fitz.open() as doc:
+        doc.new_page()
+        doc.save(pdf_copy)
+    with pool.checkout(pdf_copy) as doc:
+        assert len(doc) == 1 != page_count
+    
+    assert results == ['miss', 'miss']
+    pool.clear()
+
+def test_eviction_by_count(pdf_copy, tmp_path):
+    """上限を超えたドキュメントが古い順に破棄されるかテスト"""
+    pool = DocumentPool(max_documents=2)
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / f'copy{i}.pdf')
+        shutil.copy(pdf_copy, path)
+        paths.append(path)
+        with pool.checkout(path):
+            pass
+    
+    assert len(pool) == 2
+    assert os.path.abspath(paths[0]) not in pool._entries
+    pool.clear()
+
+def test_mmap_mode(pdf_copy, tmp_path):
+    """メモリマップで開いたドキュメントでも再利用と保存ができるかテスト"""
+    pool = DocumentPool(open_mode='mmap')
+    output = str(tmp_path / 'out.pdf')
+    with pool.checkout(pdf_copy) as first:
+        assert first.name == os.path.abspath(pdf_copy)
+    with pool.checkout(pdf_copy) as second:
+        assert second is first
+    with pool.checkout(pdf_copy, private=True) as doc:
+        doc[0].add_rect_annot(fitz.Rect(10, 10, 50, 50))
+        doc.save(output)
+    
+    with pool.checkout(pdf_copy) as doc:
+        assert doc is first
+        assert len(list(doc[0].annots())) == 0
+    with fitz.open(output) as saved:
+        assert len(list(saved[0].annots())) == 1
+    pool.clear()
+
+def test_unknown_open_mode(pdf_copy):
+    """未対応の開き方はエラーになるかテスト"""
+    pool = DocumentPool(open_mode='bytes')
+    with pytest.raises(ValueError):
+        with pool.checkout(pdf_copy):
+            pass
+
+def test_private_checkout_for_rewriting_save(pdf_copy, tmp_path):
+    """private=Trueではプール外のハンドルに書き換える保存ができるかテスト"""
+    from output_profiles import save_with_profile
+    results = []
+    pool = DocumentPool(on_checkout=results.append)
+    output = str(tmp_path / 'out.pdf')
+    with pool.checkout(pdf_copy, private=True) as doc:
+        doc[0].add_rect_annot(fitz.Rect(10, 10, 50, 50))
+        save_with_profile(doc, output, 'compact', in_place=True)
+    
+    assert results == ['private']
+    assert len(pool) == 0
+    with fitz.open(output) as saved:
+        assert len(list(saved[0].annots())) == 1
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import pytest
+import fitz  # PyMuPDF
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fast_web_view import write_fast_web_copy, current_fast_web_copy, fast_web_path_for, find_qpdf, is_linearized
+
+def make_bloated_pdf(path, pages=5):
+    """圧縮されていないストリームと参照されないオブジェクトを含むPDFを作成"""
+    doc = fitz.open()
+    for i in range(pages * 2):
+        page = doc.new_page()
+        for row in range(40):
+            page.insert_text((40, 40 + row * 18), f"Page {i + 1} line {row} " * 4, fontsize=9)
+    # 半分のページを削除して、参照されないオブジェクトを残す
+    doc.delete_pages(range(pages, pages * 2))
+    doc.save(path, garbage=0, deflate=False)
+    doc.close()
+
+def test_optimized_copy(tmp_path):
+    """最適化したコピーが元のファイルより小さく、同じページ数になるかテスト"""
+    pdf_path = str(tmp_path / 'scan.pdf')
+    make_bloated_pdf(pdf_path)
+    assert current_fast_web_copy(pdf_path) is None
+    
+    result = write_fast_web_copy(pdf_path)
+    assert result['path'] == fast_web_path_for(pdf_path)
+    assert result['linearized'] is False
+    assert result['output_bytes'] < result['input_bytes']
+    with fitz.open(result['path']) as doc:
+        assert len(doc) == 5
+        assert 'Page 3 line 0' in doc[2].get_text()
+    assert current_fast_web_copy(pdf_path) == result['path']
+    assert sorted(os.listdir(tmp_path)) == ['scan.pdf', 'scan.pdf.fastweb.pdf']
+    
+    # 元のファイルが新しくなった場合はコピーを使わない
+    later = time.time() + 10
+    os.utime(pdf_path, (later, later))
+    assert current_fast_web_copy(pdf_path) is None
+
+def test_no_copy_without_benefit(tmp_path):
+    """小さくならず線形化もできない場合はコピーを作らないかテスト"""
+    pdf_path = str(tmp_path / 'small.pdf')
+    make_bloated_pdf(pdf_path)
+    write_fast_web_copy(pdf_path, str(tmp_path / 'optimized.pdf'))
+    
+    result = write_fast_web_copy(str(tmp_path / 'optimized.pdf'))
+    assert result['path'] is None
+    assert not os.path.exists(fast_web_path_for(str(tmp_path / 'optimized.pdf')))
+
+@pytest.mark.skipif(find_qpdf() is None, reason='qpdfがインストールされていません')
+def test_linearized_copy(tmp_path):
+    """qpdfがある場合は線形化されるかテスト"""
+    pdf_path = str(tmp_path / 'scan.pdf')
+    make_bloated_pdf(pdf_path)
+    result = write_fast_web_copy(pdf_path, qpdf=find_qpdf())
+    assert result['linearized'] is True
+    assert is_linearized(result['path'])
@@ -0,0 +1,45 @@
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jobs import BackgroundJobs, PENDING, DONE, FAILED
+
+def test_job_in_worker_process():
+    """ワーカープロセスでジョブを実行し、完了時にコールバックが呼ばれるかテスト"""
+    results = []
+    jobs = BackgroundJobs(workers=1)
+    try:
+        jobs.submit('pid', os.getpid, callback=results.append)
+        pid = jobs.wait('pid', timeout=60)
+        assert pid != os.getpid()
+        assert jobs.status('pid') == DONE
+    finally:
+        jobs.shutdown(wait=True)
+    assert results == [pid]
+
+def test_duplicate_jobs_are_merged():
+    """同じキーの未完了のジョブは重複して投入されないかテスト"""
+    jobs = BackgroundJobs(workers=0)
+    release = threading.Event()
+    first = jobs.submit('key', release.wait, 5)
+    second = jobs.submit('key', release.wait, 5)
+    
+    assert first is second
+    assert jobs.status('key') == PENDING
+    assert jobs.pending == 1
+    release.set()
+    jobs.wait('key', timeout=5)
+    assert jobs.pending == 0
+    jobs.shutdown()
+
+def test_failed_job():
+    """失敗したジョブの状態のテスト"""
+    jobs = BackgroundJobs(workers=0)
+    jobs.submit('fail', int, 'not a number')
+    try:
+        jobs.wait('fail', timeout=5)
+    except ValueError:
+        pass
+    assert jobs.status('fail') == FAILED
+    assert jobs.status('unknown') is None
+    jobs.shutdown()
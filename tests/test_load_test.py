@@ -0,0 +1,23 @@
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from load_test import free_port, start_server, stop_server, run_load_test
+
+def test_load_test_smoke():
+    """ローカルに起動したサーバーに短時間の負荷試験を実行できるかテスト"""
+    workdir = tempfile.mkdtemp()
+    port = free_port()
+    server = start_server(port, workdir)
+    try:
+        report = run_load_test(f'http://127.0.0.1:{port}', users=2, duration=1, pages=2, density=1)
+    finally:
+        stop_server(server)
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    assert report['requests'] > 0
+    assert 'upload' in report['operations']
+    for result in report['operations'].values():
+        assert result['latency']['p50'] > 0
+        assert 0 <= result['error_rate'] <= 1
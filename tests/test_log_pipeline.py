@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from log_pipeline import QueueLogging, SharedRotatingFileHandler, JsonFormatter
+
+def make_logger(name):
+    logger = logging.getLogger(f'test_log_pipeline.{name}')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.handlers.clear()
+    return logger
+
+def read_records(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+def test_json_records_with_context(tmp_path):
+    """リクエストの情報とextraの項目がJSONに含まれるかテスト"""
+    path = str(tmp_path / 'app.log')
+    logger = make_logger('context')
+    pipeline = QueueLogging(logger, path, context=lambda: {'request_id': 'abc', 'document': 'a.pdf'})
+    logger.info('保存 %s', '完了', extra={'duration_ms': 12.5})
+    try:
+        raise ValueError('壊れたPDF')
+    except ValueError:
+        logger.exception('エラー')
+    pipeline.stop()
+    
+    first, second = read_records(path)
+    assert first['message'] == '保存 完了'
+    assert first['level'] == 'INFO'
+    assert first['request_id'] == 'abc'
+    assert first['document'] == 'a.pdf'
+    assert first['duration_ms'] == 12.5
+    assert 'route' not in first
+    assert 'ValueError: 壊れたPDF' in second['exception']
+
+def test_slow_writer_does_not_block(tmp_path):
+    """書き込みが遅くてもログを出したスレッドは待たされないかテスト"""
+    release = threading.Event()
+    
+    class SlowFormatter(JsonFormatter):
+        def format(self, record):
+            release.wait(5)
+            return super().format(record)
+    
+    logger = make_logger('slow')
+    pipeline = QueueLogging(logger, str(tmp_path / 'app.log'), queue_size=10)
+    pipeline.ensure_started()
+    pipeline._listener.handlers[0].setFormatter(SlowFormatter())
+    
+    start = time.perf_counter()
+    for i in range(50):
+        logger.info(f'レコード{i}')
+    elapsed = time.perf_counter() - start
+    release.set()
+    pipeline.stop()
+    
+    assert elapsed < 1
+    assert pipeline.dropped > 0
+    assert len(read_records(str(tmp_path / 'app.log'))) == 50 - pipeline.dropped
+
+def test_rotation_by_size(tmp_path):
+    """サイズを超えたら世代を残してローテーションするかテスト"""
+    path = str(tmp_path / 'app.log')
+    logger = make_logger('rotation')
+    pipeline = QueueLogging(logger, path, max_bytes=2000, backup_count=2)
+    for i in range(100):
+        logger.info(f'レコード{i:03d}')
+    pipeline.stop()
+    
+    assert sorted(os.listdir(tmp_path)) == ['app.log', 'app.log.1', 'app.log.2', 'app.log.lock']
+    assert read_records(path)[-1]['message'] == 'レコード099'
+    assert os.path.getsize(path) <= 2000
+
+def test_reopens_file_rotated_by_other_process(tmp_path):
+    """他のプロセスがローテーションしたファイルには書き続けないかテスト"""
+    path = str(tmp_path / 'app.log')
+    first = SharedRotatingFileHandler(path, maxBytes=10 ** 6)
+    second = SharedRotatingFileHandler(path, maxBytes=10 ** 6)
+    first.emit(logging.makeLogRecord({'msg': 'before'}))
+    os.replace(path, path + '.1')  # もう一方のプロセスのローテーション
+    second.emit(logging.makeLogRecord({'msg': 'after'}))
+    first.close()
+    second.close()
+    
+    with open(path, encoding='utf-8') as f:
+        assert f.read() == 'after\n'
@@ -0,0 +1,59 @@
+import glob
+import multiprocessing
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import Registry
+
+def _worker(registry, metrics, amount, exit_cleanly, ready, done):
+    counter, gauge, histogram = metrics
+    counter.inc(amount, kind='a')
+    gauge.set(amount)
+    histogram.observe(0.1)
+    registry.flush()
+    ready.set()
+    done.wait(10)
+    if exit_cleanly:
+        registry.stop()
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='forkが使えない環境')
+def test_values_are_merged_across_processes(tmp_path):
+    """マルチプロセスモードで、カウンタとヒストグラムは全プロセス、ゲージは動いているプロセスの合計になるかテスト"""
+    registry = Registry(str(tmp_path), sync_interval=60)
+    counter = registry.counter('jobs_total', 'ジョブ数', ('kind',))
+    metrics = (counter, registry.gauge('busy', '処理中'), registry.histogram('seconds', '処理時間', buckets=(0.5,)))
+    # fork前の値は子プロセスに引き継がれない
+    counter.inc(5, kind='a')
+    
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for amount, exit_cleanly in ((1, True), (2, False)):
+        ready, done = context.Event(), context.Event()
+        process = context.Process(target=_worker, args=(registry, metrics, amount, exit_cleanly, ready, done))
+        process.start()
+        assert ready.wait(10)
+        workers.append((process, done))
+    
+    # 1つ目のワーカーは終了し、2つ目は動いている
+    workers[0][1].set()
+    workers[0][0].join(10)
+    body = registry.render()
+    assert 'jobs_total{kind="a"} 8' in body
+    assert '\nbusy 2\n' in body
+    assert 'seconds_count 2' in body
+    
+    # 異常終了したワーカーのカウンタは残り、ゲージは消える
+    workers[1][0].terminate()
+    workers[1][0].join(10)
+    body = registry.render()
+    assert 'jobs_total{kind="a"} 8' in body
+    assert 'seconds_count 2' in body
+    assert '\nbusy ' not in body
+    assert sorted(os.path.basename(p) for p in glob.glob(str(tmp_path / '*.json'))) == [f'{os.getpid()}.json', 'archive.json']
+
+def test_process_local_registry():
+    """ディレクトリを指定しない場合はプロセスの値をそのまま返すかテスト"""
+    registry = Registry()
+    registry.counter('requests_total', 'リクエスト数').inc(3)
+    assert 'requests_total 3' in registry.render()
@@ -0,0 +1,66 @@
+import os
+import sys
+import fitz  # PyMuPDF
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from output_profiles import PROFILES, save_with_profile, format_report
+from doc_pool import DocumentPool
+from test_fast_web_view import make_bloated_pdf
+
+def _make_scan(path, dpi=300):
+    """高解像度の画像を貼ったPDFを作成"""
+    doc = fitz.open()
+    page = doc.new_page()
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, int(8.27 * dpi), int(11.69 * dpi)), False)
+    pix.clear_with(200)
+    page.insert_image(page.rect, pixmap=pix)
+    doc.save(path)
+    doc.close()
+
+def test_profiles_reduce_size(tmp_path):
+    """プロファイルごとに保存し、サイズと所要時間が報告されるかテスト"""
+    pdf_path = str(tmp_path / 'bloated.pdf')
+    make_bloated_pdf(pdf_path)
+    sizes = {}
+    with fitz.open(pdf_path) as doc:
+        for profile in PROFILES:
+            output = str(tmp_path / f'{profile}.pdf')
+            report = save_with_profile(doc, output, profile)
+            assert report['input_bytes'] == os.path.getsize(pdf_path)
+            assert report['output_bytes'] == os.path.getsize(output)
+            assert report['seconds'] >= 0
+            assert profile in format_report(report)
+            sizes[profile] = report['output_bytes']
+            with fitz.open(output) as saved:
+                assert len(saved) == 5
+        with pytest.raises(ValueError):
+            save_with_profile(doc, str(tmp_path / 'x.pdf'), 'unknown')
+    
+    assert sizes['compact'] <= sizes['balanced'] < sizes['default']
+
+def test_compact_downsamples_images(tmp_path):
+    """compactでは閾値を超える解像度の画像が縮小されるかテスト"""
+    pdf_path = str(tmp_path / 'scan.pdf')
+    _make_scan(pdf_path)
+    with fitz.open(pdf_path) as doc:
+        save_with_profile(doc, str(tmp_path / 'balanced.pdf'), 'balanced')
+        save_with_profile(doc, str(tmp_path / 'compact.pdf'), 'compact')
+    
+    with fitz.open(str(tmp_path / 'balanced.pdf')) as doc:
+        assert doc[0].get_images()[0][2] == 2481
+    with fitz.open(str(tmp_path / 'compact.pdf')) as doc:
+        assert doc[0].get_images()[0][2] < 2481
+
+def test_private_document_saved_in_place(tmp_path):
+    """プール外のハンドルにプロファイルで直接保存しても、次の保存に変更が残らないかテスト"""
+    pdf_path = str(tmp_path / 'bloated.pdf')
+    make_bloated_pdf(pdf_path)
+    pool = DocumentPool()
+    for i in range(2):
+        with pool.checkout(pdf_path, private=True) as doc:
+            doc[0].add_highlight_annot(fitz.Rect(10, 10, 100, 100))
+            save_with_profile(doc, str(tmp_path / f'out{i}.pdf'), 'compact', in_place=True)
+    
+    with fitz.open(str(tmp_path / 'out1.pdf')) as saved:
+        assert len(list(saved[0].annots())) == 1
+    pool.clear()
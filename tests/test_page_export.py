@@ -0,0 +1,35 @@
+import io
+import os
+import sys
+import zipfile
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from page_export import parse_page_range, export_pages, main
+
+def test_parse_page_range():
+    """ページ指定の解析のテスト"""
+    assert parse_page_range(None, 3) == [0, 1, 2]
+    assert parse_page_range('1-2,5', 5) == [0, 1, 4]
+    assert parse_page_range('4-', 5) == [3, 4]
+    assert parse_page_range('-2', 5) == [0, 1]
+    with pytest.raises(ValueError):
+        parse_page_range('3-8', 5)
+    with pytest.raises(ValueError):
+        parse_page_range('abc', 5)
+
+def test_export_pages_with_process_pool(sample_pdf):
+    """ワーカープロセスで全ページを書き出せるかテスト"""
+    output = io.BytesIO()
+    count = export_pages(sample_pdf, output, dpi=36, fmt='jpg', workers=2)
+    
+    assert count == 2
+    with zipfile.ZipFile(io.BytesIO(output.getvalue())) as archive:
+        assert archive.namelist() == ['sample_p0001.jpg', 'sample_p0002.jpg']
+        assert archive.read('sample_p0001.jpg')[:2] == b'\xff\xd8'
+
+def test_cli(sample_pdf, tmp_path):
+    """CLIから指定範囲を書き出せるかテスト"""
+    output = tmp_path / 'pages.zip'
+    assert main([sample_pdf, '-o', str(output), '--pages', '2', '--dpi', '36', '--workers', '0']) == 0
+    with zipfile.ZipFile(output) as archive:
+        assert archive.namelist() == ['sample_p0002.png']
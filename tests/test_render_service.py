@@ -0,0 +1,82 @@
+import os
+import sys
+import threading
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from render_service import RenderService, RenderBusy, PageNotFound
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def test_render_in_worker_process(sample_pdf):
+    """ワーカープロセスでページをレンダリングできるかテスト"""
+    service = RenderService(workers=2)
+    try:
+        data = service.render(sample_pdf, 0, dpi=36)
+        assert data.startswith(PNG_SIGNATURE)
+        assert service.render(sample_pdf, 1, dpi=36, fmt='jpg')[:2] == b'\xff\xd8'
+        with pytest.raises(PageNotFound):
+            service.render(sample_pdf, 5)
+    finally:
+        service.shutdown()
+
+def test_render_inline(sample_pdf):
+    """workers=0の場合は呼び出し元のスレッドでレンダリングされるかテスト"""
+    service = RenderService(workers=0)
+    assert service.render(sample_pdf, 0, dpi=36).startswith(PNG_SIGNATURE)
+
+def test_backpressure():
+    """待ち行列が一杯の場合はRenderBusyになるかテスト"""
+    service = RenderService(workers=0, max_pending=1)
+    started = threading.Event()
+    release = threading.Event()
+    
+    def block():
+        started.set()
+        release.wait(5)
+    
+    thread = threading.Thread(target=service.submit, args=(block,))
+    thread.start()
+    started.wait(5)
+    try:
+        assert service.pending == 1
+        with pytest.raises(RenderBusy):
+            service.submit(lambda: None)
+    finally:
+        release.set()
+        thread.join()
+    assert service.pending == 0
+
+def test_timeout_keeps_slot_until_finished():
+    """タイムアウトしても実行中のレンダリングが終わるまで枠を返さないかテスト"""
+    import time
+    from render_service import RenderTimeout
+    service = RenderService(workers=1, max_pending=1)
+    try:
+        service.submit(len, b'')  # ワーカーを起動しておく
+        with pytest.raises(RenderTimeout):
+            service.submit(time.sleep, 1.0, timeout=0.1)
+        assert service.pending == 1
+        with pytest.raises(RenderBusy):
+            service.submit(len, b'')
+        for _ in range(500):
+            if service.pending == 0:
+                break
+            time.sleep(0.01)
+        assert service.pending == 0
+        assert service.submit(len, b'abc') == 3
+    finally:
+        service.shutdown()
+
+def test_render_inline_from_threads(sample_pdf):
+    """workers=0で複数のスレッドから同時にレンダリングできるかテスト"""
+    service = RenderService(workers=0, max_pending=16)
+    results = []
+    def render(page_number):
+        for _ in range(5):
+            results.append(service.render(sample_pdf, page_number, dpi=36))
+    threads = [threading.Thread(target=render, args=(i % 2,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert len(results) == 30 and all(r.startswith(PNG_SIGNATURE) for r in results)
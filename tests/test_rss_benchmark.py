@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from rss_benchmark import make_large_pdf, measure
+from mapped_pdf import memory_usage
+
+@pytest.mark.skipif(memory_usage() is None, reason='/proc/<pid>/smaps_rollup が必要')
+def test_measure_smoke(tmp_path):
+    """小さなPDFで各開き方のメモリ使用量を計測できるかテスト"""
+    path = str(tmp_path / 'large.pdf')
+    assert make_large_pdf(path, size_mb=1, side=200) > 1
+    
+    for mode in ('path', 'mmap', 'bytes'):
+        result = measure(path, mode, workers=2, pages=2)
+        assert result['mode'] == mode
+        assert len(result['per_worker']) == 2
+        assert result['total']['rss'] > 0
+        assert result['total']['pss'] > 0
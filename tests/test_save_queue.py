@@ -0,0 +1,79 @@
+import os
+import sys
+import threading
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from save_queue import SaveCoalescer
+
+def wait_until(condition):
+    for _ in range(5000):
+        if condition():
+            return
+        threading.Event().wait(0.001)
+    raise AssertionError('タイムアウト')
+
+def test_single_save_runs_immediately():
+    """他に保存がなければそのまま実行されるかテスト"""
+    coalescer = SaveCoalescer()
+    assert coalescer.submit('a.pdf', 1, lambda payload: payload * 10) == (10, 1)
+    assert coalescer._slots == {}
+
+def test_waiting_saves_are_coalesced():
+    """実行中に届いた保存が最新の内容で1回にまとめられるかテスト"""
+    coalesced = []
+    coalescer = SaveCoalescer(on_coalesce=lambda: coalesced.append(1))
+    release = threading.Event()
+    executed = []
+    
+    def save(payload):
+        executed.append(payload)
+        if payload == 'first':
+            release.wait(5)
+        return f'saved {payload}'
+    
+    results = {}
+    def submit(payload):
+        results[payload] = coalescer.submit('a.pdf', payload, save)
+    
+    first = threading.Thread(target=submit, args=('first',))
+    first.start()
+    wait_until(lambda: executed == ['first'])
+    
+    waiters = []
+    for i, payload in enumerate(('second', 'third', 'fourth')):
+        waiter = threading.Thread(target=submit, args=(payload,))
+        waiter.start()
+        waiters.append(waiter)
+        wait_until(lambda: coalescer.pending('a.pdf') == i + 1)
+    release.set()
+    for thread in [first] + waiters:
+        thread.join(5)
+    
+    assert executed == ['first', 'fourth']
+    assert results['first'] == ('saved first', 1)
+    for payload in ('second', 'third', 'fourth'):
+        assert results[payload] == ('saved fourth', 3)
+    assert len(coalesced) == 2
+    assert coalescer._slots == {}
+
+def test_other_documents_are_not_serialized():
+    """別のドキュメントの保存は待たされないかテスト"""
+    coalescer = SaveCoalescer()
+    release = threading.Event()
+    blocked = threading.Thread(target=coalescer.submit, args=('a.pdf', None, lambda payload: release.wait(5)))
+    blocked.start()
+    wait_until(lambda: 'a.pdf' in coalescer._slots)
+    
+    assert coalescer.submit('b.pdf', 2, lambda payload: payload) == (2, 1)
+    release.set()
+    blocked.join(5)
+
+def test_error_is_raised():
+    """保存が失敗した場合は例外が返り、次の保存は実行できるかテスト"""
+    def broken(payload):
+        raise ValueError('壊れたPDF')
+    
+    coalescer = SaveCoalescer()
+    with pytest.raises(ValueError):
+        coalescer.submit('a.pdf', None, broken)
+    assert coalescer.submit('a.pdf', 3, lambda payload: payload) == (3, 1)
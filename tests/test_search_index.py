@@ -0,0 +1,54 @@
+import os
+import sys
+import fitz  # PyMuPDF
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search_index import build_index, write_index, SearchIndex, IndexCache, normalize
+
+def _make_pdf(path):
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 50), "Valve assembly PN-1234 torque", fontsize=12)
+    page = doc.new_page()
+    page.insert_text((50, 50), "Bolt PN-1234, flange valve.", fontsize=12)
+    page = doc.new_page()
+    page.insert_text((50, 50), "部品番号の一覧と検査仕様", fontsize=12, fontname='japan')
+    doc.save(path)
+    doc.close()
+
+def test_normalize():
+    """検索語の正規化のテスト"""
+    assert normalize('Valve,') == 'valve'
+    assert normalize('ＰＮ－１２３４') == 'pn-1234'
+
+def test_search(tmp_path):
+    """語・前方一致・複数語・日本語の部分一致で検索できるかテスト"""
+    pdf_path = str(tmp_path / 'spec.pdf')
+    _make_pdf(pdf_path)
+    index = SearchIndex(build_index(pdf_path))
+    
+    assert [r['page'] for r in index.search('pn-1234')] == [1, 2]
+    assert [r['page'] for r in index.search('VALV')] == [1, 2]
+    assert [r['page'] for r in index.search('valve torque')] == [1]
+    assert [r['page'] for r in index.search('検査仕様')] == [3]
+    assert [r['page'] for r in index.search('部品')] == [3]
+    assert index.search('missing') == []
+    
+    # limitで切り詰めても一致したページの総数はわかる
+    results, total = index.search_with_total('pn-1234', limit=1)
+    assert [r['page'] for r in results] == [1] and total == 2
+    
+    rect = index.search('torque')[0]['rects'][0]
+    assert rect[0] < rect[2] and rect[1] < rect[3]
+
+def test_write_and_cache(tmp_path):
+    """索引ファイルの保存と読み込みキャッシュのテスト"""
+    pdf_path = str(tmp_path / 'spec.pdf')
+    _make_pdf(pdf_path)
+    cache = IndexCache()
+    assert cache.get(pdf_path + '.index.json') is None
+    
+    result = write_index(pdf_path)
+    assert result['pages'] == 3
+    index = cache.get(result['path'])
+    assert cache.get(result['path']) is index
+    assert index.search('flange')[0]['page'] == 2
@@ -0,0 +1,51 @@
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import serve
+
+def test_serve_options():
+    """serveコマンドの引数がgunicornの設定に反映されるかテスト"""
+    if serve.BaseApplication is None:
+        pytest.skip('gunicornがインストールされていません')
+    from app import app
+    args = serve.build_parser().parse_args(['--workers', '3', '--threads', '2', '--max-requests', '50'])
+    server = serve.AnnotatorServer(app, {
+        'workers': args.workers,
+        'threads': args.threads,
+        'max_requests': args.max_requests,
+        'preload_app': True,
+    })
+    
+    assert server.cfg.workers == 3
+    assert server.cfg.threads == 2
+    assert server.cfg.max_requests == 50
+    assert server.cfg.preload_app
+    assert server.load() is app
+
+def test_warm_up_engine():
+    """fork前のPyMuPDFの初期化が例外なく終わるかテスト"""
+    serve.warm_up_engine()
+
+def test_collab_subscriber_budget():
+    """イベントストリームの上限がスレッドの半分（少なくとも1）になるかテスト"""
+    assert serve.collab_subscriber_budget(4) == 2
+    assert serve.collab_subscriber_budget(1) == 1
+
+def test_render_workers_per_process(monkeypatch):
+    """レンダリングのワーカー数の既定値がCPUコア数をWebのワーカー数で分けた数になるかテスト"""
+    from render_service import render_workers_per_process
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    assert render_workers_per_process(1) == 8
+    assert render_workers_per_process(4) == 2
+    assert render_workers_per_process(16) == 1
+    assert render_workers_per_process(0) == 8
+
+def test_app_script_runs_serve_as_main():
+    """python app.py serve がserve.pyをメインのスクリプトにして起動し直すかテスト"""
+    import subprocess
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, 'app.py', 'serve', '--help'], cwd=root,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0
+    assert '--dev' in result.stdout
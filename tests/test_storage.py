@@ -0,0 +1,132 @@
+import io
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import LocalStorage, MemoryStorage, ReadCache, StorageFolder, StorageError, create_storage
+
+@pytest.fixture(params=['fs', 'memory'])
+def backend(request, tmp_path):
+    if request.param == 'fs':
+        return LocalStorage(str(tmp_path / 'store'))
+    return MemoryStorage()
+
+def test_put_open_list_delete(backend):
+    """バックエンドに書き込んだオブジェクトを読み込み・一覧・削除できるかテスト"""
+    backend.put('documents/a.pdf', io.BytesIO(b'abc'))
+    backend.put('documents/b.pdf', io.BytesIO(b'de'))
+    backend.put('annotations/a.json', io.BytesIO(b'[]'))
+    with backend.open('documents/a.pdf') as f:
+        assert f.read() == b'abc'
+    assert backend.size('documents/b.pdf') == 2
+    assert backend.size('documents/missing.pdf') is None
+    assert backend.list('documents/') == ['documents/a.pdf', 'documents/b.pdf']
+    backend.delete('documents/a.pdf')
+    backend.delete('documents/a.pdf')
+    assert backend.list('documents/') == ['documents/b.pdf']
+    with pytest.raises(FileNotFoundError):
+        backend.open('documents/a.pdf')
+
+def test_local_storage_rejects_traversal(tmp_path):
+    """保存先のディレクトリの外を指すキーを拒否するかテスト"""
+    with pytest.raises(StorageError):
+        LocalStorage(str(tmp_path)).put('../outside.pdf', io.BytesIO(b'x'))
+
+def test_create_storage(tmp_path):
+    """設定に応じたバックエンドが作られるかテスト"""
+    assert create_storage({'STORAGE_BACKEND': ''}) is None
+    assert isinstance(create_storage({'STORAGE_BACKEND': 'memory'}), MemoryStorage)
+    assert isinstance(create_storage({'STORAGE_BACKEND': 'fs', 'STORAGE_ROOT': str(tmp_path)}), LocalStorage)
+    with pytest.raises(StorageError):
+        create_storage({'STORAGE_BACKEND': 'fs'})
+    with pytest.raises(StorageError):
+        create_storage({'STORAGE_BACKEND': 'ftp'})
+
+def test_folder_reads_through(tmp_path):
+    """ローカルにないファイルをバックエンドから取得し、以降はローカルから読むかテスト"""
+    backend = MemoryStorage()
+    writer = StorageFolder(backend, str(tmp_path / 'node1'), 'documents/')
+    reader = StorageFolder(backend, str(tmp_path / 'node2'), 'documents/')
+    os.makedirs(writer.folder)
+    os.makedirs(reader.folder)
+    with open(os.path.join(writer.folder, 'a.pdf'), 'wb') as f:
+        f.write(b'%PDF-a')
+    writer.publish('a.pdf')
+    
+    path = reader.local_path('a.pdf')
+    assert path == os.path.join(reader.folder, 'a.pdf')
+    with open(path, 'rb') as f:
+        assert f.read() == b'%PDF-a'
+    backend.delete('documents/a.pdf')
+    assert reader.local_path('a.pdf') == path
+    assert reader.local_path('missing.pdf') is None
+    assert os.listdir(reader.folder) == ['a.pdf']
+
+def test_folder_without_backend(tmp_path):
+    """バックエンドがない場合はローカルフォルダだけを使うかテスト"""
+    folder = StorageFolder(None, str(tmp_path), 'documents/')
+    (tmp_path / 'a.json').write_text('[]')
+    (tmp_path / 'collab').mkdir()
+    folder.publish('a.json')
+    assert folder.names() == ['a.json']
+    assert folder.local_path('a.json') == os.path.join(str(tmp_path), 'a.json')
+    assert folder.local_path('b.json') is None
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    """取得したファイルの合計が上限を超えたら使われていない順に削除するかテスト"""
+    backend = MemoryStorage()
+    for name in ('a', 'b', 'c'):
+        backend.put(f'documents/{name}.pdf', io.BytesIO(b'x' * 10))
+    folder = StorageFolder(backend, str(tmp_path), 'documents/', ReadCache(25))
+    
+    folder.local_path('a.pdf')
+    folder.local_path('b.pdf')
+    folder.local_path('a.pdf')  # bより最近使った
+    folder.local_path('c.pdf')
+    assert sorted(os.listdir(tmp_path)) == ['a.pdf', 'c.pdf']
+    # 削除されたファイルは必要になったら取得し直す
+    assert folder.local_path('b.pdf') is not None
+    assert sorted(os.listdir(tmp_path)) == ['b.pdf', 'c.pdf']
+    assert folder.names() == ['a.pdf', 'b.pdf', 'c.pdf']
+
+def test_names_with_prefix(tmp_path):
+    """ファイル名の接頭辞をバックエンドの一覧の問い合わせに渡すかテスト"""
+    class RecordingStorage(MemoryStorage):
+        def list(self, prefix):
+            self.listed = prefix
+            return super().list(prefix)
+    backend = RecordingStorage()
+    for name in ('a_annotations_1.json', 'a_annotations_2.json', 'ab_annotations_1.json'):
+        backend.put(f'annotations/{name}', io.BytesIO(b'[]'))
+    folder = StorageFolder(backend, str(tmp_path / 'remote'), 'annotations/')
+    assert folder.names('a_annotations_') == ['a_annotations_1.json', 'a_annotations_2.json']
+    assert backend.listed == 'annotations/a_annotations_'
+    
+    local = StorageFolder(None, str(tmp_path), 'annotations/')
+    (tmp_path / 'a_annotations_1.json').write_text('[]')
+    (tmp_path / 'b_annotations_1.json').write_text('[]')
+    assert local.names('a_annotations_') == ['a_annotations_1.json']
+
+def test_cache_keeps_entry_when_remove_fails(tmp_path, monkeypatch):
+    """削除できなかったファイルを一覧に残し、次の追加時に削除し直すかテスト"""
+    paths = []
+    for name in ('a', 'b', 'c'):
+        path = tmp_path / f'{name}.pdf'
+        path.write_bytes(b'x' * 10)
+        paths.append(str(path))
+    cache = ReadCache(25)
+    cache.add(paths[0], 10)
+    cache.add(paths[1], 10)
+    
+    real_remove = os.remove
+    def locked_remove(path):
+        raise PermissionError(13, 'ファイルは使用中です', path)
+    monkeypatch.setattr(os, 'remove', locked_remove)
+    assert cache.add(paths[2], 10) == []
+    assert os.path.exists(paths[0])
+    
+    monkeypatch.setattr(os, 'remove', real_remove)
+    cache.touch(paths[2])
+    (tmp_path / 'd.pdf').write_bytes(b'x' * 10)
+    assert cache.add(str(tmp_path / 'd.pdf'), 10) == [paths[0], paths[1]]
+    assert sorted(os.listdir(tmp_path)) == ['c.pdf', 'd.pdf']
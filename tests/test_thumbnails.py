@@ -0,0 +1,49 @@
+import os
+import sys
+import fitz  # PyMuPDF
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from thumbnails import write_thumbnails, load_index, thumbs_dir_for
+
+def _make_pdf(path, pages):
+    doc = fitz.open()
+    for i in range(pages):
+        # 途中に横長のページを混ぜる
+        page = doc.new_page(width=842, height=595) if i == 3 else doc.new_page()
+        page.draw_rect(page.rect + (20, 20, -20, -20), color=(0, 0, 0), fill=(0, 0, 0))
+    doc.save(path)
+    doc.close()
+
+def test_write_thumbnails(tmp_path):
+    """全ページのサムネイルがスプライト画像に並び、索引に位置が記録されるかテスト"""
+    pdf_path = str(tmp_path / 'drawing.pdf')
+    _make_pdf(pdf_path, 7)
+    assert load_index(thumbs_dir_for(pdf_path)) is None
+    
+    result = write_thumbnails(pdf_path, width=60, columns=2, rows=2)
+    assert result == {'path': thumbs_dir_for(pdf_path), 'pages': 7, 'sheets': 2}
+    
+    index = load_index(result['path'])
+    assert index['pages'] == 7
+    assert index['sheets'] == ['sprite_000.jpg', 'sprite_001.jpg']
+    cell_w, cell_h = index['cell']
+    assert cell_w == 60 and cell_h > cell_w
+    assert [t[:3] for t in index['thumbs']] == [
+        [0, 0, 0], [0, 60, 0], [0, 0, cell_h], [0, 60, cell_h],
+        [1, 0, 0], [1, 60, 0], [1, 0, cell_h]]
+    # 横長のページはセルの幅に合わせて縮小される
+    assert index['thumbs'][3][3] == 60 and index['thumbs'][3][4] < cell_h
+    
+    sprite = fitz.Pixmap(os.path.join(result['path'], 'sprite_000.jpg'))
+    assert (sprite.width, sprite.height) == (120, 2 * cell_h)
+    # ページの中央は塗りつぶした矩形で黒い
+    assert max(sprite.pixel(30, cell_h // 2)) < 64
+
+def test_rewrite_replaces(tmp_path):
+    """作り直すと前回の出力が置き換わるかテスト"""
+    pdf_path = str(tmp_path / 'drawing.pdf')
+    _make_pdf(pdf_path, 3)
+    out_dir = str(tmp_path / 'thumbs')
+    write_thumbnails(pdf_path, out_dir, columns=1, rows=1)
+    assert len(load_index(out_dir)['sheets']) == 3
+    write_thumbnails(pdf_path, out_dir, fmt='png')
+    assert sorted(os.listdir(out_dir)) == ['index.json', 'sprite_000.png']
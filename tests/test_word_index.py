@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import fitz  # PyMuPDF
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from word_index import PageWords, WordIndex
+
+def _make_page():
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 100), "Check valve PN-1234 torque", fontsize=12)
+    page.insert_text((50, 120), "before assembly of the flange.", fontsize=12)
+    page.insert_text((50, 300), "Unrelated footer text", fontsize=12)
+    return doc, page
+
+def test_snap_to_lines():
+    """描いた矩形が覆われた単語の行ごとの矩形に置き換わるかテスト"""
+    doc, page = _make_page()
+    words = PageWords(page.get_text('words'))
+    
+    # 2行にまたがる矩形（footerは含まない）
+    lines = words.snap((40, 85, 400, 125))
+    assert [line['text'] for line in lines] == [
+        'Check valve PN-1234 torque', 'before assembly of the flange.']
+    for line in lines:
+        x0, y0, x1, y1 = line['rect']
+        assert line['quad'] == [x0, y0, x1, y0, x0, y1, x1, y1]
+    assert lines[0]['rect'][3] <= lines[1]['rect'][1] + 1
+    
+    # 単語の半分未満しか覆っていない場合は含まない
+    valve = [w for w in page.get_text('words') if w[4] == 'valve'][0]
+    lines = words.snap((valve[0] - 1, valve[1], valve[2] + 1, valve[3]))
+    assert [line['text'] for line in lines] == ['valve']
+    assert words.snap((valve[0], valve[1], (valve[0] + valve[2]) / 2 - 1, valve[3])) == []
+    
+    # 逆向きに描いた矩形
+    assert words.snap((400, 125, 40, 85))[0]['text'] == 'Check valve PN-1234 torque'
+    doc.close()
+
+def test_cache_loads_once():
+    """ページの単語は最初の問い合わせのときだけ抽出されるかテスト"""
+    doc, page = _make_page()
+    calls = []
+    def loader():
+        calls.append(1)
+        return page.get_text('words')
+    
+    index = WordIndex(max_pages=1)
+    index.snap(0, loader, (40, 85, 400, 105))
+    index.snap(0, loader, (40, 290, 400, 310))
+    assert len(calls) == 1
+    index.snap(1, loader, (0, 0, 10, 10))
+    index.snap(0, loader, (0, 0, 10, 10))
+    assert len(calls) == 3
+    assert len(index) == 1
+    doc.close()
+
+def test_snap_dense_page():
+    """文字の多いページでも問い合わせが数ミリ秒で終わるかテスト"""
+    doc = fitz.open()
+    page = doc.new_page(width=1190, height=1684)
+    for row in range(200):
+        page.insert_text((20, 10 + row * 8), ' '.join(f'w{row}-{col}' for col in range(40)), fontsize=6)
+    words = PageWords(page.get_text('words'))
+    assert len(words) > 5000
+    
+    start = time.perf_counter()
+    for i in range(100):
+        lines = words.snap((20, 400 + i, 600, 440 + i))
+    elapsed = (time.perf_counter() - start) / 100
+    assert lines
+    assert elapsed < 0.005
+    doc.close()
@@ -0,0 +1,83 @@
+import os
+import re
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from xfdf import annotations_to_xfdf, annotations_to_fdf, import_annotations, merge_annotations, detect_format
+
+HEIGHTS = [842, 842]
+
+ANNOTATIONS = [
+    {'id': 1, 'type': 'highlight', 'page': 1, 'x': 50, 'y': 30, 'width': 100, 'height': 20,
+     'color': '#ff0000', 'opacity': 0.3, 'text': '行 (1)'},
+    {'id': 2, 'type': 'rect', 'page': 2, 'x': 10, 'y': 10, 'width': 40, 'height': 40,
+     'color': '#00ff00', 'opacity': 0.5},
+    {'id': 3, 'type': 'text', 'page': 1, 'x': 100, 'y': 200, 'width': 'auto', 'height': 'auto',
+     'color': '#0000ff', 'text': 'メモ'},
+]
+
+@pytest.mark.parametrize('export', [annotations_to_xfdf, annotations_to_fdf])
+def test_round_trip(export):
+    """書き出した注釈を読み込むと同じ注釈に戻るかテスト"""
+    data = export(ANNOTATIONS + [{'id': 4, 'type': 'pen', 'page': 1}, {'id': 5, 'type': 'rect', 'page': 3}],
+                  HEIGHTS, 'sample.pdf')
+    assert len(data) < 2048
+    fmt, annotations, skipped = import_annotations(data, HEIGHTS)
+    assert fmt == detect_format(data)
+    assert skipped == 0
+    assert len(annotations) == len(ANNOTATIONS)
+    for original, restored in zip(ANNOTATIONS, annotations):
+        for key, value in original.items():
+            assert restored[key] == value, key
+
+def test_import_multiline_highlight():
+    """複数行のハイライトが行ごとの注釈に分かれ、未対応の注釈は読み飛ばされるかテスト"""
+    xfdf = b'''<?xml version="1.0" encoding="UTF-8"?>
+<xfdf xmlns="http://ns.adobe.com/xfdf/"><annots>
+<highlight page="0" rect="10,700,200,760" color="#FFFF00" name="h1"
+  coords="10,760,200,760,10,740,200,740,10,720,120,720,10,700,120,700"/>
+<ink page="0" rect="0,0,10,10"/>
+<square page="5" rect="0,0,10,10"/>
+</annots></xfdf>'''
+    fmt, annotations, skipped = import_annotations(xfdf, HEIGHTS)
+    assert fmt == 'xfdf'
+    assert skipped == 2
+    assert [a['id'] for a in annotations] == ['h1_0', 'h1_1']
+    assert annotations[1]['y'] == 842 - 720 and annotations[1]['width'] == 110
+
+def test_import_invalid():
+    """XFDF / FDFでないデータはValueErrorになるかテスト"""
+    with pytest.raises(ValueError):
+        import_annotations(b'%PDF-1.7', HEIGHTS)
+    with pytest.raises(ValueError):
+        import_annotations(b'<xfdf><annots>', HEIGHTS)
+
+def test_merge_annotations():
+    """同じIDの注釈は置き換えられ、新しい注釈は追加されるかテスト"""
+    merged = merge_annotations([{'id': 1, 'x': 0}, {'id': 2, 'x': 0}], [{'id': '2', 'x': 5}, {'id': 3, 'x': 9}])
+    assert merged == [{'id': 1, 'x': 0}, {'id': '2', 'x': 5}, {'id': 3, 'x': 9}]
+
+@pytest.mark.parametrize('export', [annotations_to_xfdf, annotations_to_fdf])
+def test_offset_mediabox(export):
+    """MediaBoxの原点が (0, 0) でないページでも、PDFに追加した注釈と同じ位置で書き出し・読み込みするかテスト"""
+    import fitz
+    doc = fitz.open()
+    page = doc.new_page(width=612, height=792)
+    page.set_mediabox(fitz.Rect(50, 100, 662, 892))
+    annotation = {'id': 'r', 'type': 'rect', 'page': 1, 'x': 10, 'y': 20, 'width': 100, 'height': 50,
+                  'color': '#00ff00', 'opacity': 0.5}
+    annot = page.add_rect_annot(fitz.Rect(10, 20, 110, 70))
+    # PDFの/Rectは枠線の太さ（1pt）の分だけ外側に広がる
+    pdf_rect = [float(v) for v in doc.xref_get_key(annot.xref, 'Rect')[1].strip('[]').split()]
+    
+    matrices = [page.transformation_matrix]
+    data = export([annotation], matrices)
+    fmt, annotations, skipped = import_annotations(data, matrices)
+    text = data.decode('latin-1')
+    if fmt == 'xfdf':
+        exported = [float(v) for v in re.search(r'rect="([^"]+)"', text).group(1).split(',')]
+    else:
+        exported = [float(v) for v in re.search(r'/Rect \[([^\]]+)\]', text).group(1).split()]
+    assert exported == pytest.approx(pdf_rect, abs=1)
+    for key in ('x', 'y', 'width', 'height'):
+        assert annotations[0][key] == pytest.approx(annotation[key])
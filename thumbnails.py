@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""ページのサムネイルをスプライト画像にまとめる
+
+全ページを低解像度でレンダリングし、決まった大きさのセルに並べた
+スプライト画像（1枚につき最大 columns × rows ページ）と、各ページの
+位置を記した ``index.json`` を作成する。ビューアはスプライト画像を
+数枚読み込むだけでページ一覧を表示できる。
+
+出力先はアップロードしたPDFの隣の ``<ファイル名>.thumbs/`` ディレクトリ。
+``index.json`` は最後に書き込むため、これが存在すれば作成は完了している。
+"""
+import json
+import os
+import shutil
+
+import fitz  # PyMuPDF
+
+THUMBS_SUFFIX = '.thumbs'
+INDEX_NAME = 'index.json'
+INDEX_VERSION = 1
+
+# セルの幅（ピクセル）と、縦横比の上限（極端に細長いページでセルが大きくならないように）
+THUMB_WIDTH = 120
+MAX_ASPECT = 2.0
+
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+SPRITE_FORMATS = ('jpg', 'png')
+
+
+def thumbs_dir_for(pdf_path):
+    return pdf_path + THUMBS_SUFFIX
+
+
+def sprite_name(sheet, fmt):
+    return f'sprite_{sheet:03d}.{fmt}'
+
+
+def write_thumbnails(pdf_path, out_dir=None, width=THUMB_WIDTH, columns=SPRITE_COLUMNS,
+                     rows=SPRITE_ROWS, fmt='jpg', jpg_quality=75):
+    """サムネイルのスプライト画像と索引を作成する（別プロセスから呼ばれる）
+
+    Returns:
+        dict: 出力先ディレクトリ、ページ数、スプライト画像の枚数
+    """
+    if fmt not in SPRITE_FORMATS:
+        raise ValueError(f'未対応の形式です: {fmt}')
+    out_dir = out_dir or thumbs_dir_for(pdf_path)
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    per_sheet = columns * rows
+    thumbs = []
+    sheets = []
+    try:
+        with fitz.open(pdf_path) as doc:
+            page_count = len(doc)
+            # すべてのページが収まるセルの高さ（最も縦長のページに合わせる）
+            aspect = max((min(page.rect.height / page.rect.width, MAX_ASPECT) for page in doc
+                          if page.rect.width > 0), default=1.0)
+            cell_w, cell_h = width, int(round(width * aspect))
+
+            for first in range(0, page_count, per_sheet):
+                count = min(per_sheet, page_count - first)
+                sheet_cols = min(columns, count)
+                sheet_rows = (count + columns - 1) // columns
+                sprite = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, sheet_cols * cell_w, sheet_rows * cell_h), False)
+                sprite.clear_with(255)
+                sheet = len(sheets)
+                for i in range(count):
+                    page = doc[first + i]
+                    scale = min(cell_w / page.rect.width, cell_h / page.rect.height) if page.rect.width > 0 else 1
+                    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+                    x = (i % columns) * cell_w
+                    y = (i // columns) * cell_h
+                    pix.set_origin(x, y)
+                    sprite.copy(pix, pix.irect)
+                    thumbs.append([sheet, x, y, pix.width, pix.height])
+                name = sprite_name(sheet, fmt)
+                if fmt == 'jpg':
+                    sprite.save(os.path.join(tmp_dir, name), jpg_quality=jpg_quality)
+                else:
+                    sprite.save(os.path.join(tmp_dir, name))
+                sheets.append(name)
+
+        index = {
+            'version': INDEX_VERSION,
+            'pages': page_count,
+            'cell': [cell_w, cell_h],
+            'columns': columns,
+            'sheets': sheets,
+            'thumbs': thumbs,  # ページ順の [スプライト番号, x, y, 幅, 高さ]
+        }
+        with open(os.path.join(tmp_dir, INDEX_NAME), 'w', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'))
+        # 作成済みのものがあれば置き換える
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.replace(tmp_dir, out_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return {'path': out_dir, 'pages': page_count, 'sheets': len(sheets)}
+
+
+def load_index(out_dir):
+    """索引を読み込む（作成が完了していなければNone）"""
+    try:
+        with open(os.path.join(out_dir, INDEX_NAME), encoding='utf-8') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""ページごとの単語矩形の索引（テキストへの吸着用）
+
+ドラッグで描いた矩形を、その矩形が覆っている単語の行ごとの矩形（QuadPoints）に
+置き換えるために使う。単語の抽出（page.get_text("words")）はページを初めて
+問い合わせたときにだけ行い、結果をLRUキャッシュに保持する。
+
+単語は上端のy座標で並べておき、問い合わせ矩形と縦方向に重なり得る範囲だけを
+二分探索で取り出して調べるため、文字の多いページでも1回数ミリ秒で答えられる。
+"""
+import bisect
+import threading
+from collections import OrderedDict
+
+# 単語の面積のうち、この割合以上が矩形に含まれていれば覆われているとみなす
+MIN_OVERLAP = 0.5
+
+
+class PageWords:
+    """1ページ分の単語矩形
+
+    Args:
+        words: page.get_text("words") の結果
+            ``(x0, y0, x1, y1, text, block_no, line_no, word_no)``
+    """
+
+    def __init__(self, words):
+        self.words = sorted(
+            (tuple(w[:4]) + (w[4], w[5], w[6], w[7]) for w in words if w[4].strip()),
+            key=lambda w: w[1]
+        )
+        self._tops = [w[1] for w in self.words]
+        self._max_height = max((w[3] - w[1] for w in self.words), default=0)
+
+    def __len__(self):
+        return len(self.words)
+
+    def covered(self, rect, min_overlap=MIN_OVERLAP):
+        """矩形に覆われた単語を読み順で返す"""
+        x0, y0, x1, y1 = rect
+        if x0 > x1:
+            x0, x1 = x1, x0
+        if y0 > y1:
+            y0, y1 = y1, y0
+        start = bisect.bisect_left(self._tops, y0 - self._max_height)
+        end = bisect.bisect_right(self._tops, y1)
+        found = []
+        for word in self.words[start:end]:
+            wx0, wy0, wx1, wy1 = word[:4]
+            area = (wx1 - wx0) * (wy1 - wy0)
+            if area <= 0:
+                continue
+            overlap = max(0, min(x1, wx1) - max(x0, wx0)) * max(0, min(y1, wy1) - max(y0, wy0))
+            if overlap / area >= min_overlap:
+                found.append(word)
+        found.sort(key=lambda w: (w[5], w[6], w[7]))
+        return found
+
+    def snap(self, rect, min_overlap=MIN_OVERLAP):
+        """矩形に覆われた単語を行ごとにまとめる
+
+        Returns:
+            list: [{'rect': [x0, y0, x1, y1], 'quad': [ul, ur, ll, lrの順に8個の座標], 'text': 行の文字列}, ...]
+        """
+        lines = OrderedDict()  # (block_no, line_no) -> 単語のリスト
+        for word in self.covered(rect, min_overlap):
+            lines.setdefault((word[5], word[6]), []).append(word)
+        result = []
+        for line_words in lines.values():
+            x0 = min(w[0] for w in line_words)
+            y0 = min(w[1] for w in line_words)
+            x1 = max(w[2] for w in line_words)
+            y1 = max(w[3] for w in line_words)
+            result.append({
+                'rect': [x0, y0, x1, y1],
+                'quad': [x0, y0, x1, y0, x0, y1, x1, y1],
+                'text': ' '.join(w[4] for w in line_words)
+            })
+        return result
+
+
+class WordIndex:
+    """ページの単語矩形を遅延作成して保持するLRUキャッシュ
+
+    キーは呼び出し側が決める（サーバーでは (パス, 更新日時, サイズ, ページ番号)、
+    デスクトップ版ではページ番号）。loaderは単語のリストを返す関数で、
+    キャッシュにないときだけ呼ばれる。
+    """
+
+    def __init__(self, max_pages=256):
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()  # キー -> PageWords
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pages)
+
+    def page(self, key, loader):
+        with self._lock:
+            words = self._pages.get(key)
+            if words is not None:
+                self._pages.move_to_end(key)
+                return words
+        words = PageWords(loader())
+        with self._lock:
+            self._pages[key] = words
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+        return words
+
+    def snap(self, key, loader, rect, min_overlap=MIN_OVERLAP):
+        """矩形を覆われた単語の行ごとの矩形に吸着させる"""
+        return self.page(key, loader).snap(rect, min_overlap)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""注釈レイヤーだけをXFDF / FDFで書き出し・読み込みする
+
+ビューアの注釈（JSON）と、他のPDFツールと注釈を受け渡すための
+XFDF（XML）・FDF（PDFと同じ構文）を相互に変換する。PDF全体ではなく
+注釈だけを数キロバイトでやり取りできる。
+
+座標の扱い:
+    ビューアの注釈はページ左上を原点とする座標（PyMuPDFと同じ）、
+    XFDF / FDFはPDFの座標系（左下が原点）なので、各ページの変換行列
+    （``page.transformation_matrix``）で変換する。MediaBox / CropBoxの原点が
+    (0, 0) でないページも、PyMuPDFが注釈を追加するときと同じ位置になる。
+    ページ番号はビューアが1始まり、XFDF / FDFは0始まり。
+
+対応する注釈:
+    ビューアの highlight / rect / text を XFDF の highlight / square / text に対応させる。
+    読み込み時は freetext も text として扱い、それ以外の種類は読み飛ばす。
+"""
+import xml.etree.ElementTree as ET
+
+import fitz  # PyMuPDF
+
+XFDF_NS = 'http://ns.adobe.com/xfdf/'
+XFDF_MIMETYPE = 'application/vnd.adobe.xfdf'
+FDF_MIMETYPE = 'application/vnd.fdf'
+FORMATS = ('xfdf', 'fdf')
+
+# テキスト注釈（付箋）のアイコンの大きさ（ポイント）
+TEXT_ICON_SIZE = 20
+
+# ビューアの種類 -> XFDFの要素名 / FDFのSubtype
+_EXPORT_TYPES = {'highlight': 'highlight', 'rect': 'square', 'text': 'text'}
+_IMPORT_TYPES = {'highlight': 'highlight', 'square': 'rect', 'text': 'text', 'freetext': 'text'}
+_FDF_SUBTYPES = {'highlight': 'Highlight', 'square': 'Square', 'text': 'Text'}
+
+
+def detect_format(data):
+    """内容からXFDFかFDFかを判定する（どちらでもなければNone）"""
+    head = data[:1024].lstrip(b'\xef\xbb\xbf \t\r\n')
+    if head.startswith(b'%FDF'):
+        return 'fdf'
+    if head.startswith(b'<') and b'xfdf' in head:
+        return 'xfdf'
+    return None
+
+
+def hex_color(color, default='#ffff00'):
+    """'#rrggbb' を小文字にそろえる（不正な値は既定値）"""
+    if isinstance(color, str) and len(color) == 7 and color.startswith('#'):
+        try:
+            int(color[1:], 16)
+            return color.lower()
+        except ValueError:
+            pass
+    return default
+
+
+def _rgb(color):
+    color = hex_color(color)
+    return tuple(int(color[i:i + 2], 16) / 255.0 for i in (1, 3, 5))
+
+
+def _hex_from_rgb(values, default='#ffff00'):
+    if len(values) != 3:
+        return default
+    return '#' + ''.join(f'{max(0, min(255, round(v * 255))):02x}' for v in values)
+
+
+def _number(value):
+    """整数で表せる座標は小数点を付けずに書き出す"""
+    value = round(float(value), 3)
+    return str(int(value)) if value == int(value) else str(value)
+
+
+def page_matrix(page):
+    """ページのPDF座標からビューアの座標への変換行列
+
+    page.transformation_matrix（またはその6要素）を渡す。
+    数値を渡した場合は、原点が (0, 0) でその高さのページとして上下の反転だけを行う。
+    """
+    if isinstance(page, (int, float)):
+        return fitz.Matrix(1, 0, 0, -1, 0, page)
+    return fitz.Matrix(page)
+
+
+def _to_pdf_rect(annotation, matrix):
+    """ビューアの注釈の矩形をPDF座標の [x0, y0, x1, y1] にする"""
+    x = float(annotation.get('x', 0))
+    y = float(annotation.get('y', 0))
+    if annotation.get('type') == 'text':
+        width = height = TEXT_ICON_SIZE
+    else:
+        width = float(annotation.get('width', 0))
+        height = float(annotation.get('height', 0))
+    rect = fitz.Rect(x, y, x + width, y + height) * ~matrix
+    rect.normalize()
+    return [rect.x0, rect.y0, rect.x1, rect.y1]
+
+
+def _from_pdf_rect(rect, matrix):
+    """PDF座標の [x0, y0, x1, y1] をビューアの x, y, width, height にする"""
+    rect = fitz.Rect(rect)
+    rect.normalize()
+    rect = rect * matrix
+    rect.normalize()
+    return {'x': rect.x0, 'y': rect.y0, 'width': rect.width, 'height': rect.height}
+
+
+def _quad_rects(coords):
+    """QuadPoints（8個ずつ）を矩形のリストにする"""
+    rects = []
+    for i in range(0, len(coords) - 7, 8):
+        xs = coords[i:i + 8:2]
+        ys = coords[i + 1:i + 8:2]
+        rects.append([min(xs), min(ys), max(xs), max(ys)])
+    return rects
+
+
+def _exportable(annotations, page_matrices):
+    """書き出せる注釈を (注釈, 0始まりのページ番号, ページの変換行列) で返す"""
+    for annotation in annotations:
+        if annotation.get('type') not in _EXPORT_TYPES:
+            continue
+        page = annotation.get('page')
+        if not isinstance(page, int) or page < 1 or page > len(page_matrices):
+            continue
+        yield annotation, page - 1, page_matrix(page_matrices[page - 1])
+
+
+def _make_annotation(kind, page, rect, matrix, name, color, opacity, contents, index=None):
+    annotation = {
+        'id': name if index is None else f'{name}_{index}',
+        'type': kind,
+        'page': page + 1,
+        'color': color,
+    }
+    annotation.update(_from_pdf_rect(rect, matrix))
+    if kind == 'text':
+        annotation.update(width='auto', height='auto', text=contents or '')
+    else:
+        annotation['opacity'] = opacity
+        if contents:
+            annotation['text'] = contents
+    return annotation
+
+
+def _annotations_from(kind, page, rect, coords, matrix, name, color, opacity, contents):
+    """読み込んだ1つの注釈をビューアの注釈のリストにする
+
+    複数行のハイライトは行（QuadPoints）ごとに1つの注釈に分ける。
+    """
+    if kind == 'highlight' and coords:
+        rects = _quad_rects(coords)
+        if len(rects) > 1:
+            return [_make_annotation(kind, page, r, matrix, name, color, opacity, contents, i)
+                    for i, r in enumerate(rects)]
+        if rects:
+            rect = rects[0]
+    return [_make_annotation(kind, page, rect, matrix, name, color, opacity, contents)]
+
+
+def _parse_id(name, fallback):
+    if not name:
+        return fallback
+    return int(name) if name.isdigit() else name
+
+
+# ---- XFDF ----
+
+def annotations_to_xfdf(annotations, page_matrices, pdf_name=None):
+    """ビューアの注釈をXFDFにする
+
+    Args:
+        annotations: ビューアの注釈のリスト
+        page_matrices: 元のPDFの各ページの変換行列（page_matrix を参照）
+        pdf_name: 元のPDFのファイル名（<f href>に書く）
+
+    Returns:
+        bytes: UTF-8のXFDF
+    """
+    root = ET.Element('xfdf', {'xmlns': XFDF_NS, 'xml:space': 'preserve'})
+    if pdf_name:
+        ET.SubElement(root, 'f', {'href': pdf_name})
+    annots = ET.SubElement(root, 'annots')
+    for annotation, page, matrix in _exportable(annotations, page_matrices):
+        rect = _to_pdf_rect(annotation, matrix)
+        attrs = {
+            'page': str(page),
+            'rect': ','.join(_number(v) for v in rect),
+            'color': hex_color(annotation.get('color')).upper(),
+        }
+        if annotation.get('id') is not None:
+            attrs['name'] = str(annotation['id'])
+        if annotation['type'] != 'text' and annotation.get('opacity') is not None:
+            attrs['opacity'] = _number(annotation['opacity'])
+        if annotation['type'] == 'highlight':
+            x0, y0, x1, y1 = rect
+            attrs['coords'] = ','.join(_number(v) for v in (x0, y1, x1, y1, x0, y0, x1, y0))
+        element = ET.SubElement(annots, _EXPORT_TYPES[annotation['type']], attrs)
+        if annotation.get('text'):
+            ET.SubElement(element, 'contents').text = annotation['text']
+    return ET.tostring(root, encoding='utf-8', xml_declaration=True)
+
+
+def xfdf_to_annotations(data, page_matrices):
+    """XFDFをビューアの注釈にする
+
+    Returns:
+        tuple: (注釈のリスト, 読み飛ばした注釈の数)
+    """
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError as e:
+        raise ValueError(f'XFDFを解析できません: {e}') from e
+    if _local_name(root.tag) != 'xfdf':
+        raise ValueError('XFDFではありません')
+
+    annotations = []
+    skipped = 0
+    for annots in root:
+        if _local_name(annots.tag) != 'annots':
+            continue
+        for position, element in enumerate(annots):
+            kind = _IMPORT_TYPES.get(_local_name(element.tag))
+            page, rect, coords = -1, [], []
+            try:
+                page = int(element.get('page', '0'))
+                rect = [float(v) for v in element.get('rect', '').split(',')]
+                coords = [float(v) for v in element.get('coords', '').split(',') if v.strip()]
+                opacity = float(element.get('opacity', '0.3' if kind == 'highlight' else '1'))
+            except ValueError:
+                kind = None
+            if kind is None or len(rect) != 4 or not 0 <= page < len(page_matrices):
+                skipped += 1
+                continue
+            contents = None
+            for child in element:
+                if _local_name(child.tag) == 'contents':
+                    contents = child.text
+            annotations.extend(_annotations_from(
+                kind, page, rect, coords, page_matrix(page_matrices[page]),
+                _parse_id(element.get('name'), f'xfdf_{position}'),
+                hex_color(element.get('color')), opacity, contents
+            ))
+    return annotations, skipped
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1].lower()
+
+
+# ---- FDF ----
+
+def _pdf_string(text):
+    """PDFの文字列（ASCII以外を含む場合はUTF-16BEの16進文字列）"""
+    if text.isascii():
+        escaped = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)').replace('\r', '\\r').replace('\n', '\\n')
+        return f'({escaped})'
+    return '<FEFF' + text.encode('utf-16-be').hex().upper() + '>'
+
+
+def annotations_to_fdf(annotations, page_matrices, pdf_name=None):
+    """ビューアの注釈をFDFにする
+
+    Returns:
+        bytes: FDF
+    """
+    objects = []
+    for annotation, page, matrix in _exportable(annotations, page_matrices):
+        kind = _EXPORT_TYPES[annotation['type']]
+        rect = _to_pdf_rect(annotation, matrix)
+        entries = [
+            '/Type /Annot',
+            f'/Subtype /{_FDF_SUBTYPES[kind]}',
+            f'/Page {page}',
+            '/Rect [' + ' '.join(_number(v) for v in rect) + ']',
+            '/C [' + ' '.join(_number(v) for v in _rgb(annotation.get('color'))) + ']',
+        ]
+        if annotation.get('id') is not None:
+            entries.append(f'/NM {_pdf_string(str(annotation["id"]))}')
+        if kind != 'text' and annotation.get('opacity') is not None:
+            entries.append(f'/CA {_number(annotation["opacity"])}')
+        if kind == 'highlight':
+            x0, y0, x1, y1 = rect
+            entries.append('/QuadPoints [' + ' '.join(_number(v) for v in (x0, y1, x1, y1, x0, y0, x1, y0)) + ']')
+        if annotation.get('text'):
+            entries.append(f'/Contents {_pdf_string(annotation["text"])}')
+        objects.append('<< ' + ' '.join(entries) + ' >>')
+
+    refs = ' '.join(f'{i + 2} 0 R' for i in range(len(objects)))
+    fdf = f'/F {_pdf_string(pdf_name)} ' if pdf_name else ''
+    lines = ['%FDF-1.2', '1 0 obj', f'<< /FDF << {fdf}/Annots [{refs}] >> >>', 'endobj']
+    for i, body in enumerate(objects):
+        lines += [f'{i + 2} 0 obj', body, 'endobj']
+    lines += ['trailer', '<< /Root 1 0 R >>', '%%EOF', '']
+    return '\n'.join(lines).encode('latin-1')
+
+
+def fdf_to_annotations(data, page_matrices):
+    """FDFをビューアの注釈にする
+
+    FDFはPDFと同じ構文なので、MuPDFでオブジェクトを読み込んで解釈する。
+
+    Returns:
+        tuple: (注釈のリスト, 読み飛ばした注釈の数)
+    """
+    try:
+        doc = fitz.open('pdf', data)
+    except Exception as e:
+        raise ValueError(f'FDFを解析できません: {e}') from e
+    with doc:
+        root = _xref_of(doc.xref_get_key(-1, 'Root'))
+        kind, value = doc.xref_get_key(root, 'FDF/Annots') if root else ('null', '')
+        if kind != 'array':
+            raise ValueError('FDFに注釈がありません')
+        refs = value.strip('[] ').split()
+        xrefs = [int(refs[i]) for i in range(0, len(refs) - 2, 3) if refs[i + 2] == 'R']
+
+        annotations = []
+        skipped = 0
+        for position, xref in enumerate(xrefs):
+            subtype = doc.xref_get_key(xref, 'Subtype')[1].lstrip('/').lower()
+            kind = _IMPORT_TYPES.get(subtype)
+            page, rect, coords = -1, [], []
+            try:
+                page = int(doc.xref_get_key(xref, 'Page')[1])
+                rect = _numbers(doc.xref_get_key(xref, 'Rect'))
+                coords = _numbers(doc.xref_get_key(xref, 'QuadPoints'))
+            except ValueError:
+                kind = None
+            if kind is None or len(rect) != 4 or not 0 <= page < len(page_matrices):
+                skipped += 1
+                continue
+            opacity = doc.xref_get_key(xref, 'CA')
+            contents = doc.xref_get_key(xref, 'Contents')
+            name = doc.xref_get_key(xref, 'NM')
+            annotations.extend(_annotations_from(
+                kind, page, rect, coords, page_matrix(page_matrices[page]),
+                _parse_id(name[1] if name[0] == 'string' else None, f'fdf_{position}'),
+                _hex_from_rgb(_numbers(doc.xref_get_key(xref, 'C'))),
+                float(opacity[1]) if opacity[0] in ('int', 'float') else (0.3 if kind == 'highlight' else 1.0),
+                contents[1] if contents[0] == 'string' else None
+            ))
+    return annotations, skipped
+
+
+def _xref_of(key):
+    kind, value = key
+    return int(value.split()[0]) if kind == 'xref' else 0
+
+
+def _numbers(key):
+    kind, value = key
+    if kind != 'array':
+        return []
+    return [float(v) for v in value.strip('[] ').split()]
+
+
+# ---- 共通 ----
+
+def export_annotations(annotations, page_matrices, fmt, pdf_name=None):
+    """指定した形式（xfdf / fdf）で書き出す"""
+    if fmt == 'xfdf':
+        return annotations_to_xfdf(annotations, page_matrices, pdf_name)
+    if fmt == 'fdf':
+        return annotations_to_fdf(annotations, page_matrices, pdf_name)
+    raise ValueError(f'未対応の形式です: {fmt}')
+
+
+def import_annotations(data, page_matrices):
+    """XFDF / FDFを判定して読み込む
+
+    Returns:
+        tuple: (形式, 注釈のリスト, 読み飛ばした注釈の数)
+    """
+    fmt = detect_format(data)
+    if fmt == 'xfdf':
+        return (fmt,) + xfdf_to_annotations(data, page_matrices)
+    if fmt == 'fdf':
+        return (fmt,) + fdf_to_annotations(data, page_matrices)
+    raise ValueError('XFDFまたはFDFのファイルではありません')
+
+
+def merge_annotations(existing, imported):
+    """同じIDの注釈は読み込んだもので置き換え、新しい注釈は末尾に追加する"""
+    imported_ids = {str(a.get('id')) for a in imported}
+    return [a for a in existing if str(a.get('id')) not in imported_ids] + list(imported)